@@ -6,197 +6,243 @@ Execute com: streamlit run app.py
 """
 
 import streamlit as st
+from streamlit.runtime import Runtime
 import pandas as pd
 import json
+import logging
+import csv
+import html
+import argparse
 import io
 import zipfile
+import gzip
 import tempfile
+import shutil
+import sqlite3
+import hashlib
+import mmap
+import struct
+import os
+import sys
+import importlib
+import threading
+import time
+import socket
+import multiprocessing
+import weakref
+from collections import deque
+from xml.etree import ElementTree
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 from datetime import datetime
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, field, asdict, astuple, fields as dataclass_fields
 from decimal import Decimal, ROUND_HALF_UP
-from typing import Dict, List, Optional, Generator, Tuple
+from typing import BinaryIO, Callable, Dict, List, Optional, Generator, Tuple
 import re
+import unicodedata
+from copy import copy
+from functools import cached_property, lru_cache, partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from operator import itemgetter
 
-from openpyxl import Workbook
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from openpyxl import Workbook, load_workbook
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-from openpyxl.utils import get_column_letter
+from openpyxl.utils import column_index_from_string, get_column_letter
+from openpyxl.utils.datetime import CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900, from_excel
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import cm
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
 
+# Diagnósticos (workers do spool, plano de execução, exportação de métricas) vão para o log do processo
+logger = logging.getLogger('icmsst')
+
+
+def setup_logging() -> None:
+    """Log em stderr com data e nível; não altera uma configuração já existente"""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
 
 # =============================================================================
 # CONFIGURAÇÃO DA PÁGINA
 # =============================================================================
 
-st.set_page_config(
-    page_title="OmniAI Fiscal - Exclusão ICMS-ST",
-    page_icon="🧾",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
+def setup_page():
+    """Configura a página e o CSS customizado"""
+    # Chamada por main(): importar o módulo (como fazem os processos do pool) não toca a interface
+    st.set_page_config(
+        page_title="OmniAI Fiscal - Exclusão ICMS-ST",
+        page_icon="🧾",
+        layout="wide",
+        initial_sidebar_state="expanded"
+    )
 
-# CSS Customizado
-st.markdown("""
-<style>
-    /* Tema geral */
-    .main {
-        background: linear-gradient(135deg, #f8fafc 0%, #e2e8f0 100%);
-    }
+    # CSS Customizado
+    st.markdown("""
+    <style>
+        /* Tema geral */
+        .main {
+            background: linear-gradient(135deg, #f8fafc 0%, #e2e8f0 100%);
+        }
     
-    /* Header */
-    .header-container {
-        background: linear-gradient(135deg, #1e3a5f 0%, #2d5a87 100%);
-        padding: 2rem;
-        border-radius: 16px;
-        margin-bottom: 2rem;
-        box-shadow: 0 10px 40px rgba(30, 58, 95, 0.3);
-    }
+        /* Header */
+        .header-container {
+            background: linear-gradient(135deg, #1e3a5f 0%, #2d5a87 100%);
+            padding: 2rem;
+            border-radius: 16px;
+            margin-bottom: 2rem;
+            box-shadow: 0 10px 40px rgba(30, 58, 95, 0.3);
+        }
     
-    .header-title {
-        color: white;
-        font-size: 2.5rem;
-        font-weight: 700;
-        margin: 0;
-        text-shadow: 2px 2px 4px rgba(0,0,0,0.2);
-    }
+        .header-title {
+            color: white;
+            font-size: 2.5rem;
+            font-weight: 700;
+            margin: 0;
+            text-shadow: 2px 2px 4px rgba(0,0,0,0.2);
+        }
     
-    .header-subtitle {
-        color: #94a3b8;
-        font-size: 1.1rem;
-        margin-top: 0.5rem;
-    }
+        .header-subtitle {
+            color: #94a3b8;
+            font-size: 1.1rem;
+            margin-top: 0.5rem;
+        }
     
-    /* Cards de métricas */
-    .metric-card {
-        background: white;
-        padding: 1.5rem;
-        border-radius: 12px;
-        box-shadow: 0 4px 20px rgba(0,0,0,0.08);
-        border-left: 4px solid #10b981;
-        transition: transform 0.2s, box-shadow 0.2s;
-    }
+        /* Cards de métricas */
+        .metric-card {
+            background: white;
+            padding: 1.5rem;
+            border-radius: 12px;
+            box-shadow: 0 4px 20px rgba(0,0,0,0.08);
+            border-left: 4px solid #10b981;
+            transition: transform 0.2s, box-shadow 0.2s;
+        }
     
-    .metric-card:hover {
-        transform: translateY(-2px);
-        box-shadow: 0 8px 30px rgba(0,0,0,0.12);
-    }
+        .metric-card:hover {
+            transform: translateY(-2px);
+            box-shadow: 0 8px 30px rgba(0,0,0,0.12);
+        }
     
-    .metric-value {
-        font-size: 2rem;
-        font-weight: 700;
-        color: #10b981;
-        margin: 0;
-    }
+        .metric-value {
+            font-size: 2rem;
+            font-weight: 700;
+            color: #10b981;
+            margin: 0;
+        }
     
-    .metric-label {
-        color: #64748b;
-        font-size: 0.9rem;
-        text-transform: uppercase;
-        letter-spacing: 0.05em;
-    }
+        .metric-label {
+            color: #64748b;
+            font-size: 0.9rem;
+            text-transform: uppercase;
+            letter-spacing: 0.05em;
+        }
     
-    /* Upload area */
-    .upload-area {
-        border: 2px dashed #cbd5e1;
-        border-radius: 12px;
-        padding: 2rem;
-        text-align: center;
-        background: #f8fafc;
-        transition: all 0.3s;
-    }
+        /* Upload area */
+        .upload-area {
+            border: 2px dashed #cbd5e1;
+            border-radius: 12px;
+            padding: 2rem;
+            text-align: center;
+            background: #f8fafc;
+            transition: all 0.3s;
+        }
     
-    .upload-area:hover {
-        border-color: #3b82f6;
-        background: #eff6ff;
-    }
+        .upload-area:hover {
+            border-color: #3b82f6;
+            background: #eff6ff;
+        }
     
-    /* Tabela de resultados */
-    .results-table {
-        background: white;
-        border-radius: 12px;
-        overflow: hidden;
-        box-shadow: 0 4px 20px rgba(0,0,0,0.08);
-    }
+        /* Tabela de resultados */
+        .results-table {
+            background: white;
+            border-radius: 12px;
+            overflow: hidden;
+            box-shadow: 0 4px 20px rgba(0,0,0,0.08);
+        }
     
-    /* Botões */
-    .stButton>button {
-        background: linear-gradient(135deg, #10b981 0%, #059669 100%);
-        color: white;
-        border: none;
-        padding: 0.75rem 2rem;
-        border-radius: 8px;
-        font-weight: 600;
-        transition: all 0.3s;
-    }
+        /* Botões */
+        .stButton>button {
+            background: linear-gradient(135deg, #10b981 0%, #059669 100%);
+            color: white;
+            border: none;
+            padding: 0.75rem 2rem;
+            border-radius: 8px;
+            font-weight: 600;
+            transition: all 0.3s;
+        }
     
-    .stButton>button:hover {
-        transform: translateY(-2px);
-        box-shadow: 0 8px 20px rgba(16, 185, 129, 0.4);
-    }
+        .stButton>button:hover {
+            transform: translateY(-2px);
+            box-shadow: 0 8px 20px rgba(16, 185, 129, 0.4);
+        }
     
-    /* Progress bar */
-    .stProgress > div > div {
-        background: linear-gradient(90deg, #10b981, #3b82f6);
-    }
+        /* Progress bar */
+        .stProgress > div > div {
+            background: linear-gradient(90deg, #10b981, #3b82f6);
+        }
     
-    /* Sidebar */
-    .css-1d391kg {
-        background: #1e293b;
-    }
+        /* Sidebar */
+        .css-1d391kg {
+            background: #1e293b;
+        }
     
-    /* Info boxes */
-    .info-box {
-        background: #eff6ff;
-        border: 1px solid #bfdbfe;
-        border-radius: 8px;
-        padding: 1rem;
-        margin: 1rem 0;
-    }
+        /* Info boxes */
+        .info-box {
+            background: #eff6ff;
+            border: 1px solid #bfdbfe;
+            border-radius: 8px;
+            padding: 1rem;
+            margin: 1rem 0;
+        }
     
-    .warning-box {
-        background: #fef3c7;
-        border: 1px solid #fcd34d;
-        border-radius: 8px;
-        padding: 1rem;
-        margin: 1rem 0;
-    }
+        .warning-box {
+            background: #fef3c7;
+            border: 1px solid #fcd34d;
+            border-radius: 8px;
+            padding: 1rem;
+            margin: 1rem 0;
+        }
     
-    .success-box {
-        background: #d1fae5;
-        border: 1px solid #6ee7b7;
-        border-radius: 8px;
-        padding: 1rem;
-        margin: 1rem 0;
-    }
+        .success-box {
+            background: #d1fae5;
+            border: 1px solid #6ee7b7;
+            border-radius: 8px;
+            padding: 1rem;
+            margin: 1rem 0;
+        }
     
-    /* Hide Streamlit branding */
-    #MainMenu {visibility: hidden;}
-    footer {visibility: hidden;}
+        /* Hide Streamlit branding */
+        #MainMenu {visibility: hidden;}
+        footer {visibility: hidden;}
     
-    /* Custom scrollbar */
-    ::-webkit-scrollbar {
-        width: 8px;
-        height: 8px;
-    }
+        /* Custom scrollbar */
+        ::-webkit-scrollbar {
+            width: 8px;
+            height: 8px;
+        }
     
-    ::-webkit-scrollbar-track {
-        background: #f1f5f9;
-    }
+        ::-webkit-scrollbar-track {
+            background: #f1f5f9;
+        }
     
-    ::-webkit-scrollbar-thumb {
-        background: #94a3b8;
-        border-radius: 4px;
-    }
+        ::-webkit-scrollbar-thumb {
+            background: #94a3b8;
+            border-radius: 4px;
+        }
     
-    ::-webkit-scrollbar-thumb:hover {
-        background: #64748b;
-    }
-</style>
-""", unsafe_allow_html=True)
+        ::-webkit-scrollbar-thumb:hover {
+            background: #64748b;
+        }
+    </style>
+    """, unsafe_allow_html=True)
 
 
 # =============================================================================
@@ -223,8 +269,47 @@ class ProductInfo:
     aliq_icms: Optional[Decimal] = None
 
 
+@dataclass(frozen=True)
+class SalesRegister:
+    """Layout de um registro de receita com PIS/COFINS por item.
+
+    Posições dos campos contam a partir de REG = 0; campos que o registro não
+    tem ficam ``None`` (C181/C485 só trazem PIS ou só COFINS, C481/A170 não
+    trazem CFOP). Sem COD_ITEM próprio, o item vem do último registro
+    ``parent`` lido (campo ``parent_cod_item``).
+    """
+    register: str
+    description: str
+    cod_item: Optional[int]
+    cfop: Optional[int]
+    vl_item: int
+    vl_desc: Optional[int] = None
+    cst_pis: Optional[int] = None
+    vl_bc_pis: Optional[int] = None
+    aliq_pis: Optional[int] = None
+    vl_pis: Optional[int] = None
+    cst_cofins: Optional[int] = None
+    vl_bc_cofins: Optional[int] = None
+    aliq_cofins: Optional[int] = None
+    vl_cofins: Optional[int] = None
+    cod_cta: Optional[int] = None
+    parent: Optional[str] = None
+    parent_cod_item: Optional[int] = None
+
+    @cached_property
+    def width(self) -> int:
+        """Campos lidos por ``SpedParser.parse_record``: a linha é completada até aqui, mais um vazio"""
+        return max(p for p in astuple(self)[2:15] if isinstance(p, int)) + 1
+
+    @cached_property
+    def extract(self) -> Callable[[List[str]], Tuple[str, ...]]:
+        """Campos de COD_ITEM a COD_CTA; campos ausentes apontam para o vazio do fim da linha completada"""
+        return itemgetter(*(-1 if p is None else p for p in astuple(self)[2:15]))
+
+
 @dataclass
-class C870Record:
+class SalesRecord:
+    register: str
     line_number: int
     cod_item: str
     cfop: str
@@ -239,7 +324,7 @@ class C870Record:
     aliq_cofins: Decimal
     vl_cofins: Decimal
     cod_cta: str
-    raw_line: str
+    raw_line: bytes
 
 
 @dataclass
@@ -286,19 +371,134 @@ class MonthSummary:
     savings_percentage: Decimal
 
 
+@dataclass
+class GroupSummary:
+    dimension: str
+    key: str
+    ncm: str = ''
+    total_records: int = 0
+    total_calculated: int = 0
+    pis_original: Decimal = Decimal('0')
+    pis_credit: Decimal = Decimal('0')
+    cofins_original: Decimal = Decimal('0')
+    cofins_credit: Decimal = Decimal('0')
+    valor_icms_st: Decimal = Decimal('0')
+    total_credit: Decimal = Decimal('0')
+    months: int = 0
+
+
+@dataclass
+class Scenario:
+    name: str
+    use_mva_adjusted: bool = False
+    aliq_icms: Optional[Decimal] = None
+    cfops: Optional[frozenset] = None
+
+
 # =============================================================================
 # CLASSES DE PROCESSAMENTO
 # =============================================================================
 
+SALES_REGISTERS: Dict[str, SalesRegister] = {}
+
+
+def register_sales_layout(layout: SalesRegister) -> None:
+    """Inclui um registro de receita no parser; não acrescenta leituras do arquivo"""
+    SALES_REGISTERS[layout.register] = layout
+
+
+register_sales_layout(SalesRegister(
+    'C870', 'C870 - Consolidação por item (PIS/COFINS)', cod_item=1, cfop=2, vl_item=3, vl_desc=4,
+    cst_pis=5, vl_bc_pis=6, aliq_pis=7, vl_pis=8, cst_cofins=9, vl_bc_cofins=10, aliq_cofins=11, vl_cofins=12,
+    cod_cta=13))
+register_sales_layout(SalesRegister(
+    'C170', 'C170 - Itens do documento (NF-e)', cod_item=2, cfop=10, vl_item=6, vl_desc=7,
+    cst_pis=24, vl_bc_pis=25, aliq_pis=26, vl_pis=29, cst_cofins=30, vl_bc_cofins=31, aliq_cofins=32, vl_cofins=35,
+    cod_cta=36))
+register_sales_layout(SalesRegister(
+    'C181', 'C181 - NF-e consolidada por item, PIS (C180)', cod_item=None, cfop=2, vl_item=3, vl_desc=4,
+    cst_pis=1, vl_bc_pis=5, aliq_pis=6, vl_pis=9, cod_cta=10, parent='C180', parent_cod_item=4))
+register_sales_layout(SalesRegister(
+    'C185', 'C185 - NF-e consolidada por item, COFINS (C180)', cod_item=None, cfop=2, vl_item=3, vl_desc=4,
+    cst_cofins=1, vl_bc_cofins=5, aliq_cofins=6, vl_cofins=9, cod_cta=10, parent='C180', parent_cod_item=4))
+register_sales_layout(SalesRegister(
+    'C481', 'C481 - ECF por item, PIS', cod_item=8, cfop=None, vl_item=2,
+    cst_pis=1, vl_bc_pis=3, aliq_pis=4, vl_pis=7, cod_cta=9))
+register_sales_layout(SalesRegister(
+    'C485', 'C485 - ECF por item, COFINS', cod_item=8, cfop=None, vl_item=2,
+    cst_cofins=1, vl_bc_cofins=3, aliq_cofins=4, vl_cofins=7, cod_cta=9))
+register_sales_layout(SalesRegister(
+    'A170', 'A170 - Itens do documento de serviço', cod_item=2, cfop=None, vl_item=4, vl_desc=5,
+    cst_pis=8, vl_bc_pis=9, aliq_pis=10, vl_pis=11, cst_cofins=12, vl_bc_cofins=13, aliq_cofins=14, vl_cofins=15,
+    cod_cta=16))
+
+DEFAULT_REGISTERS = ('C870',)
+
+
 class SpedParser:
-    """Parser de arquivos SPED Contribuições"""
+    """Parser de arquivos SPED Contribuições.
+
+    Trabalha sobre ``bytes`` e lê o arquivo uma única vez, linha a linha, sem
+    guardá-lo: o tipo de registro é identificado sem decodificar a linha e
+    cada linha é despachada por um dicionário de handlers: 0000 e 0200, os
+    registros de receita pedidos em ``registers`` (layouts de
+    ``SALES_REGISTERS``) e os seus registros pai. Dos registros de receita
+    ficam só a linha crua, com o seu terminador (``\n`` ou ``\r\n``), e a
+    posição em bytes no arquivo, usada pelo ``SpedWriter``; as demais linhas
+    são descartadas após a consulta ao dicionário.
+    """
     
-    def __init__(self):
+    def __init__(self, registers: Tuple[str, ...] = DEFAULT_REGISTERS):
         self.header: Optional[SpedHeader] = None
         self.products: Dict[str, ProductInfo] = {}
-        self.lines: List[str] = []
         self.line_count = 0
-        self.c870_count = 0
+        self.record_count = 0
+        # Números (base 1), linhas cruas e posições em bytes dos registros de receita, na ordem do arquivo
+        self.record_lines: List[int] = []
+        self.record_raw: List[bytes] = []
+        self.record_offsets: List[int] = []
+        # COD_ITEM herdado do registro pai, por linha (só registros sem COD_ITEM próprio)
+        self.record_parent_items: Dict[int, str] = {}
+        self._parent_items: Dict[str, str] = {}
+        # Registros de receita vão direto para ``record_lines``; os demais registros usados têm handler
+        self._layouts: Dict[bytes, SalesRegister] = {}
+        self._handlers: Dict[bytes, Callable[[int, bytes], None]] = {
+            b'0000': self._on_header,
+            b'0200': self._on_product,
+        }
+        for register in registers:
+            layout = SALES_REGISTERS[register]
+            self._layouts[register.encode()] = layout
+            if layout.parent:
+                self._handlers[layout.parent.encode()] = partial(self._on_parent, layout.parent,
+                                                                 layout.parent_cod_item)
+    
+    @staticmethod
+    def split_fields(line: bytes) -> List[bytes]:
+        line = line.strip()
+        if line.startswith(b'|'):
+            line = line[1:]
+        if line.endswith(b'|'):
+            line = line[:-1]
+        return line.split(b'|')
+    
+    @staticmethod
+    def text_fields(line: bytes) -> List[str]:
+        line = line.decode('latin-1').strip()
+        if line.startswith('|'):
+            line = line[1:]
+        if line.endswith('|'):
+            line = line[:-1]
+        return line.split('|')
+    
+    @staticmethod
+    def record_type(line: bytes) -> bytes:
+        """Primeiro campo da linha, sem separar os demais"""
+        line = line.strip()
+        if line.startswith(b'|'):
+            line = line[1:]
+        end = line.find(b'|')
+        return line if end < 0 else line[:end]
     
     def parse_decimal(self, value: str) -> Decimal:
         if not value or value.strip() == '':
@@ -333,87 +533,324 @@ class SpedParser:
             aliq_icms=self.parse_decimal(aliq_str) if aliq_str else None
         )
     
-    def parse_c870(self, line_number: int, fields: List[str], raw_line: str) -> C870Record:
-        return C870Record(
+    def parse_record(self, line_number: int, fields: List[str], raw_line: bytes, layout: SalesRegister,
+                     parent_item: str = '') -> SalesRecord:
+        # Campos além do fim da linha e campos que o layout não tem leem como vazios
+        if len(fields) < layout.width:
+            fields.extend([''] * (layout.width - len(fields)))
+        fields.append('')
+        (cod_item, cfop, vl_item, vl_desc, cst_pis, vl_bc_pis, aliq_pis, vl_pis, cst_cofins, vl_bc_cofins,
+         aliq_cofins, vl_cofins, cod_cta) = layout.extract(fields)
+        parse_decimal = self.parse_decimal
+        return SalesRecord(
+            register=layout.register,
             line_number=line_number,
-            cod_item=fields[1] if len(fields) > 1 else '',
-            cfop=fields[2] if len(fields) > 2 else '',
-            vl_item=self.parse_decimal(fields[3]) if len(fields) > 3 else Decimal('0'),
-            vl_desc=self.parse_decimal(fields[4]) if len(fields) > 4 else Decimal('0'),
-            cst_pis=fields[5] if len(fields) > 5 else '',
-            vl_bc_pis=self.parse_decimal(fields[6]) if len(fields) > 6 else Decimal('0'),
-            aliq_pis=self.parse_decimal(fields[7]) if len(fields) > 7 else Decimal('0'),
-            vl_pis=self.parse_decimal(fields[8]) if len(fields) > 8 else Decimal('0'),
-            cst_cofins=fields[9] if len(fields) > 9 else '',
-            vl_bc_cofins=self.parse_decimal(fields[10]) if len(fields) > 10 else Decimal('0'),
-            aliq_cofins=self.parse_decimal(fields[11]) if len(fields) > 11 else Decimal('0'),
-            vl_cofins=self.parse_decimal(fields[12]) if len(fields) > 12 else Decimal('0'),
-            cod_cta=fields[13] if len(fields) > 13 else '',
+            cod_item=cod_item if layout.cod_item is not None else parent_item,
+            cfop=cfop,
+            vl_item=parse_decimal(vl_item),
+            vl_desc=parse_decimal(vl_desc),
+            cst_pis=cst_pis,
+            vl_bc_pis=parse_decimal(vl_bc_pis),
+            aliq_pis=parse_decimal(aliq_pis),
+            vl_pis=parse_decimal(vl_pis),
+            cst_cofins=cst_cofins,
+            vl_bc_cofins=parse_decimal(vl_bc_cofins),
+            aliq_cofins=parse_decimal(aliq_cofins),
+            vl_cofins=parse_decimal(vl_cofins),
+            cod_cta=cod_cta,
             raw_line=raw_line
         )
     
-    def load_content(self, content: str) -> None:
-        self.lines = content.split('\n')
-        self.line_count = len(self.lines)
+    def load_content(self, content: bytes) -> None:
+        self.load_stream(io.BytesIO(content))
+    
+    def load_stream(self, stream: BinaryIO,
+                    progress: Optional[Callable[[int, int], None]] = None, report_every: int = 4096) -> None:
+        """Lê o SPED linha a linha a partir de um stream binário (ex.: membro de ZIP/GZIP).
+
+        O arquivo não é materializado: cada linha é despachada e descartada,
+        exceto as dos registros de receita. ``progress(bytes_lidos,
+        linhas_lidas)`` é chamado a cada ``report_every`` linhas.
+        """
+        self.record_lines = record_lines = []
+        self.record_raw = record_raw = []
+        self.record_offsets = record_offsets = []
+        self.record_parent_items = record_parent_items = {}
+        self._parent_items = parent_items = {}
         
-        for line_num, line in enumerate(self.lines, 1):
-            line = line.strip()
-            if not line:
-                continue
-            
-            if line.startswith('|'):
-                line = line[1:]
-            if line.endswith('|'):
-                line = line[:-1]
-            
-            fields = line.split('|')
-            record_type = fields[0] if fields else ''
-            
-            if record_type == '0000':
-                self.header = self.parse_header(fields)
-            elif record_type == '0200':
-                product = self.parse_product(fields)
-                self.products[product.cod_item] = product
-            elif record_type == 'C870':
-                self.c870_count += 1
-    
-    def get_c870_records(self) -> Generator[C870Record, None, None]:
-        for line_num, line in enumerate(self.lines, 1):
-            line = line.strip()
-            if not line:
-                continue
-            
-            original_line = line
-            if line.startswith('|'):
-                line = line[1:]
-            if line.endswith('|'):
-                line = line[:-1]
-            
-            fields = line.split('|')
-            if fields[0] == 'C870':
-                yield self.parse_c870(line_num, fields, original_line)
+        layouts = self._layouts
+        handlers = self._handlers
+        record_type = self.record_type
+        bytes_read = 0
+        line_num = 0
+        # Só inteiros e bytes nas listas: milhões de tuplas aqui custariam coletas do GC durante a leitura
+        for line_num, line in enumerate(stream, 1):
+            line_type = record_type(line)
+            layout = layouts.get(line_type)
+            if layout is not None:
+                record_lines.append(line_num)
+                record_raw.append(line)
+                record_offsets.append(bytes_read)
+                if layout.parent:
+                    record_parent_items[line_num] = parent_items.get(layout.parent, '')
+            else:
+                handler = handlers.get(line_type)
+                if handler is not None:
+                    handler(line_num, line)
+            bytes_read += len(line)
+            if progress is not None and line_num % report_every == 0:
+                progress(bytes_read, line_num)
+        if progress is not None:
+            progress(bytes_read, line_num)
+        self.line_count = line_num
+        self.record_count = len(record_lines)
+    
+    def _on_header(self, line_num: int, line: bytes) -> None:
+        self.header = self.parse_header(self.text_fields(line))
+    
+    def _on_product(self, line_num: int, line: bytes) -> None:
+        product = self.parse_product(self.text_fields(line))
+        self.products[product.cod_item] = product
+    
+    def _on_parent(self, register: str, cod_item_position: int, line_num: int, line: bytes) -> None:
+        fields = self.text_fields(line)
+        self._parent_items[register] = fields[cod_item_position] if len(fields) > cod_item_position else ''
+    
+    def parse_record_line(self, line_number: int, line: bytes, parent_item: str = '') -> Optional[SalesRecord]:
+        """Lê um registro de receita avulso (ex.: linha relida do arquivo original)"""
+        fields = self.text_fields(line)
+        layout = SALES_REGISTERS.get(fields[0])
+        return self.parse_record(line_number, fields, line, layout, parent_item) if layout else None
+    
+    def get_records(self) -> Generator[SalesRecord, None, None]:
+        parent_items = self.record_parent_items
+        text_fields = self.text_fields
+        parse_record = self.parse_record
+        for line_num, line in zip(self.record_lines, self.record_raw):
+            fields = text_fields(line)
+            yield parse_record(line_num, fields, line, SALES_REGISTERS[fields[0]],
+                               parent_items.get(line_num, '') if parent_items else '')
     
     def get_ncm_for_item(self, cod_item: str) -> Optional[str]:
         product = self.products.get(cod_item)
         return product.cod_ncm if product else None
 
 
+def parse_valid_date(value) -> Optional[str]:
+    """Data de vigência como 'AAAA-MM-DD' (vazio = sem limite); aceita data do Excel, dd/mm/aaaa, aaaa-mm-dd e mm/aaaa"""
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    text = str(value).strip()
+    if not text:
+        return None
+    return _parse_date_text(text)
+
+
+@lru_cache(maxsize=4096)
+def _parse_date_text(text: str) -> str:
+    # Bases repetem poucas datas de vigência: strptime roda uma vez por texto distinto
+    for date_format in ('%d/%m/%Y', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%m/%Y'):
+        try:
+            return datetime.strptime(text, date_format).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    raise ValueError(f'Data de vigência inválida: {text}')
+
+
+class XlsxColumnReader:
+    """Leitura em streaming de colunas escolhidas da primeira planilha de um ``.xlsx``.
+
+    O XML da planilha é descompactado em blocos e varrido por uma expressão
+    regular que só casa as células das colunas pedidas: as demais não chegam
+    a virar objetos Python, ao contrário do leitor do openpyxl, que monta
+    todas as células de cada linha. Strings compartilhadas são decodificadas
+    só quando usadas e números com formato de data viram ``datetime``.
+    Depende da referência ``r="B2"`` em cada célula, que o Excel sempre grava.
+    """
+
+    CHUNK_SIZE = 4 * 2**20
+    MAIN_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+    REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+    TEXT = re.compile(rb'<t(?:\s[^>]*)?>(.*?)</t>', re.S)
+    VALUE = re.compile(rb'<v>(.*?)</v>', re.S)
+    PHONETIC = re.compile(rb'<rPh\b.*?</rPh>', re.S)
+    TYPE = re.compile(rb'\bt="(\w+)"')
+    STYLE = re.compile(rb'\bs="(\d+)"')
+
+    def __init__(self, file):
+        self.archive = zipfile.ZipFile(file)
+        workbook = ElementTree.fromstring(self.archive.read('xl/workbook.xml'))
+        properties = workbook.find(f'{self.MAIN_NS}workbookPr')
+        self.epoch = (CALENDAR_MAC_1904 if properties is not None and properties.get('date1904') in ('1', 'true')
+                      else CALENDAR_WINDOWS_1900)
+        targets = {rel.get('Id'): rel.get('Target')
+                   for rel in ElementTree.fromstring(self.archive.read('xl/_rels/workbook.xml.rels'))}
+        target = targets[workbook.find(f'{self.MAIN_NS}sheets')[0].get(f'{self.REL_NS}id')]
+        self.sheet_path = target.lstrip('/') if target.startswith('/') else f'xl/{target}'
+        self.date_styles = self._date_styles()
+        self._shared_raw: Optional[List[bytes]] = None
+        self._shared: Dict[int, str] = {}
+
+    def close(self) -> None:
+        self.archive.close()
+
+    def _date_styles(self) -> set:
+        """Índices de estilo de célula cujo formato numérico é de data"""
+        try:
+            styles = ElementTree.fromstring(self.archive.read('xl/styles.xml'))
+        except KeyError:
+            return set()
+        formats = dict(BUILTIN_FORMATS)
+        for number_format in styles.iter(f'{self.MAIN_NS}numFmt'):
+            formats[int(number_format.get('numFmtId'))] = number_format.get('formatCode')
+        cell_formats = styles.find(f'{self.MAIN_NS}cellXfs')
+        if cell_formats is None:
+            return set()
+        return {index for index, xf in enumerate(cell_formats)
+                if is_date_format(formats.get(int(xf.get('numFmtId', 0))) or '')}
+
+    def _text(self, inner: bytes) -> str:
+        if b'<rPh' in inner:
+            inner = self.PHONETIC.sub(b'', inner)
+        text = b''.join(self.TEXT.findall(inner)).decode('utf-8')
+        return html.unescape(text) if '&' in text else text
+
+    def _shared_string(self, index: int) -> str:
+        text = self._shared.get(index)
+        if text is None:
+            if self._shared_raw is None:
+                try:
+                    data = self.archive.read('xl/sharedStrings.xml')
+                except KeyError:
+                    data = b''
+                self._shared_raw = re.findall(rb'<si>(.*?)</si>', data, re.S)
+            text = self._shared[index] = self._text(self._shared_raw[index])
+        return text
+
+    def _value(self, attrs: bytes, inner: Optional[bytes]):
+        if not inner:
+            return None
+        kind = self.TYPE.search(attrs).group(1) if b't="' in attrs else b'n'
+        if kind == b'inlineStr':
+            return self._text(inner)
+        value = self.VALUE.search(inner)
+        if value is None:
+            return None
+        value = value.group(1)
+        if kind == b's':
+            return self._shared_string(int(value))
+        if kind in (b'str', b'd'):
+            text = value.decode('utf-8')
+            text = html.unescape(text) if '&' in text else text
+            return datetime.fromisoformat(text) if kind == b'd' else text
+        if kind == b'b':
+            return value == b'1'
+        if kind == b'e':
+            return None
+        number = float(value) if b'.' in value or b'E' in value or b'e' in value else int(value)
+        if self.date_styles and b's="' in attrs and int(self.STYLE.search(attrs).group(1)) in self.date_styles:
+            return from_excel(number, self.epoch)
+        return number
+
+    def _cells(self, columns: Optional[List[str]] = None):
+        """Listas de (coluna, linha, atributos, conteúdo) das células das colunas pedidas (todas, sem ``columns``),
+        um bloco de linhas completas por vez"""
+        letters = b'|'.join(c.encode() for c in columns) if columns else rb'[A-Z]{1,3}'
+        pattern = re.compile(rb'<c r="(' + letters + rb')(\d+)"([^>]*?)(?:/>|>(.*?)</c>)', re.S)
+        with self.archive.open(self.sheet_path) as stream:
+            pending = b''
+            while True:
+                chunk = stream.read(self.CHUNK_SIZE)
+                data = pending + chunk
+                # Processa só linhas completas; o resto segue para o próximo bloco
+                cut = data.rfind(b'</row>') + 6 if chunk else len(data)
+                if cut < 6 and chunk:
+                    pending = data
+                    continue
+                yield pattern.findall(data, 0, cut)
+                if not chunk:
+                    return
+                pending = data[cut:]
+
+    def head(self, max_rows: int) -> List[list]:
+        """As primeiras ``max_rows`` linhas, com todas as colunas (posição = índice da coluna)"""
+        rows: List[list] = [[] for _ in range(max_rows)]
+        for cells in self._cells():
+            for letters, row_number, attrs, inner in cells:
+                if int(row_number) > max_rows:
+                    return rows
+                row = rows[int(row_number) - 1]
+                index = column_index_from_string(letters.decode()) - 1
+                row.extend([None] * (index + 1 - len(row)))
+                row[index] = self._value(attrs, inner)
+        return rows
+
+    def rows(self, indices: List[int], first_row: int) -> List[tuple]:
+        """Valores das colunas ``indices`` (base 0), a partir da linha ``first_row`` (base 1)"""
+        letters = [get_column_letter(index + 1) for index in indices]
+        position = {letter.encode(): i for i, letter in enumerate(letters)}
+        rows: List[tuple] = []
+        current_number = None
+        current: list = []
+        value = self._value
+        for cells in self._cells(letters):
+            for column, row_number, attrs, inner in cells:
+                if row_number != current_number:
+                    if current_number is not None and int(current_number) >= first_row:
+                        rows.append(tuple(current))
+                    current_number = row_number
+                    current = [None] * len(indices)
+                current[position[column]] = value(attrs, inner)
+        if current_number is not None and int(current_number) >= first_row:
+            rows.append(tuple(current))
+        return rows
+
+
 class ProductBaseLoader:
-    """Carrega base de produtos do cliente (Excel)"""
+    """Carrega base de produtos do cliente (Excel, CSV ou Parquet).
+
+    ``products_by_ncm`` associa um NCM (8 dígitos) ou prefixo de NCM (linha
+    com ``*`` no fim, ex.: ``2202*``) a uma lista de regras com MVA, MVA
+    ajustada e alíquota, cada uma opcionalmente restrita a uma UF e a um
+    período de vigência. ``get_product_by_ncm`` escolhe o prefixo mais longo
+    e, dentro dele, a regra da UF antes da geral e a vigência mais recente.
+    Bases sem as colunas UF e vigência continuam com uma regra por NCM.
+    """
+    
+    # Linhas examinadas à procura do cabeçalho (títulos acima da tabela são comuns)
+    HEADER_SCAN_ROWS = 20
     
     def __init__(self):
-        self.products_by_ncm: Dict[str, Dict] = {}
+        self.products_by_ncm: Dict[str, List[Dict]] = {}
     
-    def load_dataframe(self, df: pd.DataFrame) -> int:
+    @property
+    def temporal(self) -> bool:
+        """Se alguma regra depende de UF ou vigência"""
+        return any(rule['uf'] or rule['valid_from'] or rule['valid_to']
+                   for rules in self.products_by_ncm.values() for rule in rules)
+    
+    @staticmethod
+    def map_columns(columns) -> Dict[str, object]:
+        """Colunas reconhecidas: campo da regra -> coluna da base"""
         col_map = {}
-        for col in df.columns:
+        for col in columns:
             col_lower = str(col).lower()
+            col_plain = unicodedata.normalize('NFKD', col_lower).encode('ascii', 'ignore').decode()
             if col_lower == 'ncm':
                 col_map['ncm'] = col
             elif col_lower == 'capitulo':
                 col_map['capitulo'] = col
             elif col_lower == 'item':
                 col_map['item'] = col
+            elif col_lower == 'uf':
+                col_map['uf'] = col
+            elif 'vigencia' in col_plain or 'valid' in col_plain:
+                if any(word in col_plain for word in ('fim', 'final', 'ate', 'termino')):
+                    col_map['valid_to'] = col
+                else:
+                    col_map['valid_from'] = col
             elif 'mva' in col_lower or 'iva' in col_lower:
                 if 'ajust' in col_lower:
                     col_map['mva_adjusted'] = col
@@ -421,65 +858,422 @@ class ProductBaseLoader:
                     col_map['mva'] = col
             elif 'aliq' in col_lower and 'entrada' in col_lower:
                 col_map['aliq_icms'] = col
+        return col_map
+    
+    @staticmethod
+    def is_header(col_map: Dict[str, object]) -> bool:
+        return 'mva' in col_map and ('ncm' in col_map or ('capitulo' in col_map and 'item' in col_map))
+    
+    @classmethod
+    def find_header(cls, rows: List[tuple]) -> Tuple[int, Dict[str, int]]:
+        """Índice da linha de cabeçalho entre as primeiras e o mapa campo -> posição da coluna"""
+        for index, row in enumerate(rows):
+            names = ['' if value is None else str(value) for value in row]
+            col_map = cls.map_columns(names)
+            if cls.is_header(col_map):
+                return index, {key: names.index(name) for key, name in col_map.items()}
+        return 0, {}
+    
+    def load_file(self, file, name: Optional[str] = None) -> int:
+        """Carrega a base de um upload ou caminho pela extensão: .xlsx, .xls, .csv ou .parquet"""
+        name = (name or getattr(file, 'name', None) or str(file)).lower()
+        if name.endswith('.csv'):
+            df = self.read_csv(file)
+        elif name.endswith('.parquet'):
+            df = self.read_parquet(file)
+        elif name.endswith(('.xlsx', '.xlsm')):
+            df = self.read_xlsx(file)
+        else:
+            df = pd.read_excel(file)
+        return self.load_dataframe(df)
+    
+    @classmethod
+    def read_xlsx(cls, file) -> pd.DataFrame:
+        """Só as colunas mapeadas da primeira planilha, lidas em streaming (``XlsxColumnReader``)"""
+        reader = XlsxColumnReader(file)
+        try:
+            head = reader.head(cls.HEADER_SCAN_ROWS)
+            header_index, positions = cls.find_header(head)
+            if positions:
+                used = sorted(set(positions.values()))
+                return pd.DataFrame(reader.rows(used, header_index + 2),
+                                    columns=[str(head[header_index][i]) for i in used])
+        finally:
+            reader.close()
+        # Células sem referência (alguns geradores de planilha): leitor somente leitura do openpyxl
+        if hasattr(file, 'seek'):
+            file.seek(0)
+        return cls.read_xlsx_openpyxl(file)
+    
+    @classmethod
+    def read_xlsx_openpyxl(cls, file) -> pd.DataFrame:
+        workbook = load_workbook(file, read_only=True, data_only=True)
+        try:
+            sheet = workbook.worksheets[0]
+            head = list(sheet.iter_rows(max_row=cls.HEADER_SCAN_ROWS, values_only=True))
+            header_index, positions = cls.find_header(head)
+            if not positions:
+                return pd.DataFrame()
+            used = sorted(set(positions.values()))
+            columns = [str(head[header_index][i]) for i in used]
+            pick = itemgetter(*used)
+            rows = [pick(row) for row in sheet.iter_rows(min_row=header_index + 2, max_col=used[-1] + 1,
+                                                         values_only=True)]
+        finally:
+            workbook.close()
+        return pd.DataFrame(rows, columns=columns)
+    
+    @classmethod
+    def read_csv(cls, file) -> pd.DataFrame:
+        """CSV com separador ; , ou tabulação, em UTF-8 ou Latin-1; só as colunas mapeadas, como texto"""
+        data = file.read() if hasattr(file, 'read') else Path(file).read_bytes()
+        try:
+            text = data.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            text = data.decode('latin-1')
+        head_lines = [line.rstrip('\r') for line in text.split('\n', cls.HEADER_SCAN_ROWS)[:cls.HEADER_SCAN_ROWS]]
+        sep = max((';', ',', '\t'), key=lambda candidate: sum(line.count(candidate) for line in head_lines))
+        head = list(csv.reader(head_lines, delimiter=sep))
+        header_index, positions = cls.find_header(head)
+        if not positions:
+            return pd.DataFrame()
+        # Texto puro: NCM sem perder zeros à esquerda e decimais sem passar por float
+        return pd.read_csv(io.StringIO(text), sep=sep, skiprows=header_index, usecols=sorted(set(positions.values())),
+                           dtype=str)
+    
+    @classmethod
+    def read_parquet(cls, file) -> pd.DataFrame:
+        """Só as colunas mapeadas do Parquet"""
+        parquet_file = pq.ParquetFile(file)
+        col_map = cls.map_columns(parquet_file.schema_arrow.names)
+        return parquet_file.read(columns=list(dict.fromkeys(col_map.values()))).to_pandas()
+    
+    def load_dataframe(self, df: pd.DataFrame) -> int:
+        col_map = self.map_columns(df.columns)
+        # Uma lista por campo mapeado, com ausentes (NaN/NaT/NA) já como None: sem Series nem pd.notna por célula
+        fields = list(col_map)
+        columns = [df[col].astype(object).where(df[col].notna(), None).tolist() for col in col_map.values()]
         
         count = 0
-        for _, row in df.iterrows():
+        for values in zip(*columns):
+            row = dict(zip(fields, values))
             ncm = None
-            if 'ncm' in col_map and pd.notna(row[col_map['ncm']]):
-                ncm_raw = str(row[col_map['ncm']]).strip()
-                if ncm_raw and ncm_raw not in ['', 'nan']:
+            is_prefix = False
+            if row.get('ncm') is not None:
+                ncm_raw = str(row['ncm']).strip()
+                if ncm_raw.endswith('*'):
+                    # Prefixo: vale para todos os NCMs que começam com esses dígitos
+                    ncm = ncm_raw[:-1].replace('.', '').replace('-', '').strip()
+                    is_prefix = True
+                    if not (ncm.isdigit() and 2 <= len(ncm) <= 8):
+                        continue
+                elif ncm_raw and ncm_raw not in ['', 'nan']:
                     ncm = ncm_raw.replace('.', '').replace('-', '').zfill(8)[:8]
             
             if not ncm and 'capitulo' in col_map and 'item' in col_map:
                 try:
-                    cap = str(int(float(row[col_map['capitulo']]))).zfill(4)
-                    item = str(int(float(row[col_map['item']]))).zfill(4)
+                    cap = str(int(float(row['capitulo']))).zfill(4)
+                    item = str(int(float(row['item']))).zfill(4)
                     ncm = cap + item
                 except:
                     continue
             
-            if not ncm or len(ncm) != 8:
+            if not ncm or (len(ncm) != 8 and not is_prefix):
                 continue
             
             mva = None
-            if 'mva' in col_map and pd.notna(row[col_map['mva']]):
+            if row.get('mva') is not None:
                 try:
-                    mva_str = str(row[col_map['mva']]).replace(',', '.').replace('%', '')
+                    mva_str = str(row['mva']).replace(',', '.').replace('%', '')
                     mva = Decimal(mva_str)
                 except:
                     pass
             
+            mva_adjusted = None
+            if row.get('mva_adjusted') is not None:
+                try:
+                    mva_adj_str = str(row['mva_adjusted']).replace(',', '.').replace('%', '')
+                    mva_adjusted = Decimal(mva_adj_str)
+                except:
+                    pass
+            
             aliq = Decimal('18')
-            if 'aliq_icms' in col_map and pd.notna(row[col_map['aliq_icms']]):
+            if row.get('aliq_icms') is not None:
                 try:
-                    aliq_str = str(row[col_map['aliq_icms']]).replace(',', '.').replace('%', '')
+                    aliq_str = str(row['aliq_icms']).replace(',', '.').replace('%', '')
                     aliq = Decimal(aliq_str)
                 except:
                     pass
             
+            uf = None
+            if row.get('uf') is not None:
+                uf = str(row['uf']).strip().upper() or None
+                if uf is not None and not (len(uf) == 2 and uf.isascii() and uf.isalpha()):
+                    continue
+            try:
+                valid_from = parse_valid_date(row.get('valid_from'))
+                valid_to = parse_valid_date(row.get('valid_to'))
+            except ValueError:
+                continue
+            
             if mva is not None:
-                self.products_by_ncm[ncm] = {
+                rules = self.products_by_ncm.setdefault(ncm, [])
+                # Mesma UF e vigência repetida: prevalece a última linha
+                rules[:] = [r for r in rules if (r['uf'], r['valid_from'], r['valid_to']) != (uf, valid_from, valid_to)]
+                rules.append({
                     'ncm': ncm,
+                    'uf': uf,
+                    'valid_from': valid_from,
+                    'valid_to': valid_to,
                     'mva': mva,
+                    'mva_adjusted': mva_adjusted,
                     'aliq_icms': aliq
-                }
+                })
                 count += 1
         
+        for rules in self.products_by_ncm.values():
+            # Ordem de preferência: regra da UF antes da geral, vigência mais recente primeiro
+            rules.sort(key=lambda r: r['valid_from'] or '', reverse=True)
+            rules.sort(key=lambda r: r['uf'] is None)
+        
         return count
     
-    def get_product_by_ncm(self, ncm: str) -> Optional[Dict]:
-        return self.products_by_ncm.get(ncm)
+    def get_product_by_ncm(self, ncm: str, uf: Optional[str] = None, valid_on: Optional[str] = None) -> Optional[Dict]:
+        """Regra aplicável ao NCM na UF e data ('AAAA-MM-DD'); sem UF ou data, o filtro correspondente é ignorado"""
+        for length in range(len(ncm), 1, -1):
+            for rule in self.products_by_ncm.get(ncm[:length], ()):
+                if rule_applies(rule, uf, valid_on):
+                    return rule
+        return None
+
+
+def rule_applies(rule: Dict, uf: Optional[str], valid_on: Optional[str]) -> bool:
+    if uf is not None and rule['uf'] is not None and rule['uf'] != uf:
+        return False
+    if valid_on is not None and (
+            (rule['valid_from'] is not None and valid_on < rule['valid_from']) or
+            (rule['valid_to'] is not None and valid_on > rule['valid_to'])):
+        return False
+    return True
+
+
+class ProductTable:
+    """Base de produtos compilada numa tabela binária somente leitura.
+
+    Processos do pool e workers do spool não recebem mais o dicionário de
+    ``ProductBaseLoader`` por pickle a cada tarefa: a sessão grava a tabela
+    uma vez por lote (``write``) e cada tarefa a mapeia em memória (``open``),
+    sem cópia — as páginas ficam no cache do sistema, compartilhadas entre os
+    processos. Layout: cabeçalho, chaves de NCM/prefixo ordenadas (8 bytes,
+    completadas com zeros) com a faixa de regras de cada uma, e as regras na
+    ordem de preferência da base. Valores decimais são gravados em ponto fixo
+    (mantissa inteira + expoente), preservando o Decimal original; datas como
+    AAAAMMDD. A busca é binária sobre as chaves e devolve as mesmas regras
+    (dicionários) de ``ProductBaseLoader.get_product_by_ncm``.
+    """
+
+    MAGIC = b'ICST'
+    VERSION = 1
+    HEADER = struct.Struct('<4sHII')
+    # NCM ou prefixo, primeira regra, quantidade de regras
+    KEY = struct.Struct('<8sII')
+    # UF, vigência início/fim, MVA, MVA ajustada e alíquota (mantissa, expoente), flags
+    RULE = struct.Struct('<2sIIqbqbqbB')
+    FLAG_MVA_ADJUSTED = 1
+
+    def __init__(self, buffer, mapped: Optional[mmap.mmap] = None):
+        self._buffer = buffer
+        self._mapped = mapped
+        magic, version, self.key_count, self.rule_count = self.HEADER.unpack_from(buffer, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError('Tabela de produtos inválida ou de outra versão')
+        self._keys_offset = self.HEADER.size
+        self._rules_offset = self._keys_offset + self.key_count * self.KEY.size
+
+    @staticmethod
+    def _fixed_point(value: Decimal) -> Tuple[int, int]:
+        sign, digits, exponent = value.as_tuple()
+        if not isinstance(exponent, int):
+            raise ValueError(f'Valor não numérico na base de produtos: {value}')
+        mantissa = int(''.join(map(str, digits)) or '0') * (-1 if sign else 1)
+        if not -2**63 <= mantissa < 2**63 or not -128 <= exponent < 128:
+            raise ValueError(f'Valor fora da faixa da tabela de produtos: {value}')
+        return mantissa, exponent
+
+    @staticmethod
+    def _date_number(value: Optional[str]) -> int:
+        return int(value.replace('-', '')) if value else 0
+
+    @classmethod
+    def compile(cls, products_by_ncm: Dict[str, List[Dict]]) -> bytes:
+        keys = []
+        rules = []
+        for ncm in sorted(products_by_ncm, key=lambda key: key.encode().ljust(8, b'\0')):
+            keys.append(cls.KEY.pack(ncm.encode(), len(rules), len(products_by_ncm[ncm])))
+            for rule in products_by_ncm[ncm]:
+                mva_adjusted = rule.get('mva_adjusted')
+                rules.append(cls.RULE.pack(
+                    (rule['uf'] or '').encode('ascii').ljust(2, b'\0'),
+                    cls._date_number(rule['valid_from']), cls._date_number(rule['valid_to']),
+                    *cls._fixed_point(rule['mva']),
+                    *cls._fixed_point(mva_adjusted if mva_adjusted is not None else ZERO),
+                    *cls._fixed_point(rule['aliq_icms']),
+                    cls.FLAG_MVA_ADJUSTED if mva_adjusted is not None else 0
+                ))
+        return b''.join([cls.HEADER.pack(cls.MAGIC, cls.VERSION, len(keys), len(rules)), *keys, *rules])
+
+    @classmethod
+    def write(cls, products_by_ncm: Dict[str, List[Dict]], path: str) -> None:
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(cls.compile(products_by_ncm))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def open(cls, path: str) -> 'ProductTable':
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return cls(mapped, mapped)
+        except ValueError:
+            mapped.close()
+            raise
+
+    def close(self) -> None:
+        if self._mapped is not None:
+            self._mapped.close()
+            self._mapped = None
+
+    def __enter__(self) -> 'ProductTable':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self.key_count
+
+    def rules_for(self, ncm: str) -> List[Dict]:
+        """Regras gravadas para o NCM ou prefixo exato, na ordem de preferência"""
+        target = ncm.encode().ljust(8, b'\0')
+        low, high = 0, self.key_count
+        while low < high:
+            middle = (low + high) // 2
+            key, first, count = self.KEY.unpack_from(self._buffer, self._keys_offset + middle * self.KEY.size)
+            if key < target:
+                low = middle + 1
+            elif key > target:
+                high = middle
+            else:
+                return [self._rule(ncm, first + offset) for offset in range(count)]
+        return []
+
+    def _rule(self, ncm: str, position: int) -> Dict:
+        (uf, valid_from, valid_to, mva, mva_exp, adjusted, adjusted_exp, aliq, aliq_exp,
+         flags) = self.RULE.unpack_from(self._buffer, self._rules_offset + position * self.RULE.size)
+        return {
+            'ncm': ncm,
+            'uf': uf.rstrip(b'\0').decode('ascii') or None,
+            'valid_from': f'{valid_from // 10000:04d}-{valid_from // 100 % 100:02d}-{valid_from % 100:02d}'
+                          if valid_from else None,
+            'valid_to': f'{valid_to // 10000:04d}-{valid_to // 100 % 100:02d}-{valid_to % 100:02d}'
+                        if valid_to else None,
+            'mva': Decimal(mva).scaleb(mva_exp),
+            'mva_adjusted': Decimal(adjusted).scaleb(adjusted_exp) if flags & self.FLAG_MVA_ADJUSTED else None,
+            'aliq_icms': Decimal(aliq).scaleb(aliq_exp),
+        }
+
+    def get_product_by_ncm(self, ncm: str, uf: Optional[str] = None, valid_on: Optional[str] = None) -> Optional[Dict]:
+        """Mesma escolha de ``ProductBaseLoader.get_product_by_ncm``"""
+        for length in range(len(ncm), 1, -1):
+            for rule in self.rules_for(ncm[:length]):
+                if rule_applies(rule, uf, valid_on):
+                    return rule
+        return None
+
+
+# Decimais imutáveis reaproveitados em todas as linhas
+ZERO = Decimal('0')
+DEFAULT_ALIQ_ICMS = Decimal('18')
 
 
 class IcmsStCalculator:
-    """Calculadora de exclusão ICMS-ST"""
+    """Calculadora de exclusão ICMS-ST.
+
+    Os valores calculados dependem só das bases e alíquotas de PIS/COFINS da
+    linha e da MVA/alíquota de ICMS do NCM; linhas de varejo repetem muito
+    essas combinações, então o cálculo passa por um memo LRU limitado a
+    ``memo_size`` entradas (0 desativa). ``memo_stats`` informa o
+    aproveitamento.
+    """
     
-    def __init__(self, product_base: ProductBaseLoader, cfops_elegiveis: set):
+    MEMO_SIZE = 65536
+    
+    def __init__(self, product_base: ProductBaseLoader, cfops_elegiveis: set, memo_size: int = MEMO_SIZE,
+                 registers: Tuple[str, ...] = DEFAULT_REGISTERS):
         self.product_base = product_base
         self.cfops_elegiveis = cfops_elegiveis
+        # Registros de receita lidos dos SPEDs calculados com esta calculadora
+        self.registers = tuple(registers)
+        self._adjusted_values = lru_cache(maxsize=memo_size)(self.adjusted_values) if memo_size else self.adjusted_values
+        self.set_context()
+    
+    def set_context(self, uf: Optional[str] = None, valid_on: Optional[str] = None) -> None:
+        """UF e data de referência do arquivo em cálculo; a regra de cada NCM é resolvida uma vez por contexto"""
+        self.uf = uf
+        self.valid_on = valid_on
+        self._products: Dict[str, Optional[Dict]] = {}
     
-    def calculate(self, record: C870Record, ncm: Optional[str]) -> CalculationResult:
-        base = CalculationResult(
+    @staticmethod
+    def adjusted_values(vl_bc_pis: Decimal, aliq_pis: Decimal, vl_bc_cofins: Decimal, aliq_cofins: Decimal,
+                        mva: Decimal, aliq_icms: Decimal) -> Tuple[Decimal, Decimal, Decimal, Decimal, Decimal, Decimal]:
+        """Exclusão do ICMS-ST de uma linha: (base ICMS-ST, ICMS-ST, BC PIS, PIS, BC COFINS, COFINS) novos"""
+        # Passo 4: Cálculo da exclusão ICMS-ST
+        # Fórmula: VL_BC - ((VL_BC * MVA%) * ALIQ_ICMS%)
+        mva_decimal = mva / Decimal('100')
+        aliq_icms_decimal = aliq_icms / Decimal('100')
+
+        # Exclusão para PIS (baseado no campo 7 - VL_BC_PIS)
+        exclusao_pis = vl_bc_pis * mva_decimal * aliq_icms_decimal
+        vl_bc_pis_new = (vl_bc_pis - exclusao_pis).quantize(Decimal('0.01'), ROUND_HALF_UP)
+        if vl_bc_pis_new < 0:
+            vl_bc_pis_new = Decimal('0')
+
+        # Exclusão para COFINS (baseado no campo 11 - VL_BC_COFINS)
+        exclusao_cofins = vl_bc_cofins * mva_decimal * aliq_icms_decimal
+        vl_bc_cofins_new = (vl_bc_cofins - exclusao_cofins).quantize(Decimal('0.01'), ROUND_HALF_UP)
+        if vl_bc_cofins_new < 0:
+            vl_bc_cofins_new = Decimal('0')
+
+        # Passo 6: Novos valores = BC_nova * alíquota (campos 8 e 12 têm 4 casas decimais)
+        vl_pis_new = (vl_bc_pis_new * aliq_pis / Decimal('100')).quantize(Decimal('0.01'), ROUND_HALF_UP)
+        vl_cofins_new = (vl_bc_cofins_new * aliq_cofins / Decimal('100')).quantize(Decimal('0.01'), ROUND_HALF_UP)
+
+        # Valores para relatório
+        # base_icms_st = VL_BC_PIS * MVA% (base intermediária do cálculo)
+        base_icms_st = (vl_bc_pis * mva_decimal).quantize(Decimal('0.01'), ROUND_HALF_UP)
+        valor_icms_st = exclusao_pis.quantize(Decimal('0.01'), ROUND_HALF_UP)
+
+        return base_icms_st, valor_icms_st, vl_bc_pis_new, vl_pis_new, vl_bc_cofins_new, vl_cofins_new
+
+    def memo_stats(self) -> Dict[str, float]:
+        """Acertos, falhas, tamanho e taxa de acerto do memo de cálculo"""
+        if not hasattr(self._adjusted_values, 'cache_info'):
+            return {}
+        info = self._adjusted_values.cache_info()
+        lookups = info.hits + info.misses
+        return {
+            'hits': info.hits,
+            'misses': info.misses,
+            'size': info.currsize,
+            'max_size': info.maxsize,
+            'hit_rate': info.hits / lookups if lookups else 0.0,
+        }
+
+    @staticmethod
+    def _skipped(record: SalesRecord, ncm: Optional[str], reason: str) -> CalculationResult:
+        """Linha mantida com os valores originais"""
+        return CalculationResult(
             line_number=record.line_number,
             cod_item=record.cod_item,
             ncm=ncm or '',
@@ -489,65 +1283,46 @@ class IcmsStCalculator:
             vl_pis_orig=record.vl_pis,
             vl_bc_cofins_orig=record.vl_bc_cofins,
             vl_cofins_orig=record.vl_cofins,
-            mva=Decimal('0'),
-            aliq_icms=Decimal('0'),
-            base_icms_st=Decimal('0'),
-            valor_icms_st=Decimal('0'),
+            mva=ZERO,
+            aliq_icms=ZERO,
+            base_icms_st=ZERO,
+            valor_icms_st=ZERO,
             vl_bc_pis_new=record.vl_bc_pis,
             vl_pis_new=record.vl_pis,
             vl_bc_cofins_new=record.vl_bc_cofins,
             vl_cofins_new=record.vl_cofins,
-            economia_pis=Decimal('0'),
-            economia_cofins=Decimal('0'),
-            economia_total=Decimal('0'),
-            status='skipped'
+            economia_pis=ZERO,
+            economia_cofins=ZERO,
+            economia_total=ZERO,
+            status='skipped',
+            skip_reason=reason
         )
-        
-        if record.cfop not in self.cfops_elegiveis:
-            base.skip_reason = f'CFOP {record.cfop} não elegível'
-            return base
+
+    def calculate(self, record: SalesRecord, ncm: Optional[str]) -> CalculationResult:
+        # Registros cujo layout não tem CFOP (C481/C485, A170) entram pela escolha do registro;
+        # nos demais, CFOP em branco não é elegível
+        if record.cfop not in self.cfops_elegiveis and SALES_REGISTERS[record.register].cfop is not None:
+            return self._skipped(record, ncm, f'CFOP {record.cfop} não elegível')
         
         if not ncm:
-            base.skip_reason = 'NCM não encontrado'
-            return base
+            return self._skipped(record, ncm, 'NCM não encontrado')
         
-        product = self.product_base.get_product_by_ncm(ncm)
+        try:
+            product = self._products[ncm]
+        except KeyError:
+            product = self._products[ncm] = self.product_base.get_product_by_ncm(ncm, self.uf, self.valid_on)
         if not product:
-            base.skip_reason = 'NCM sem MVA na base'
-            return base
+            return self._skipped(record, ncm, 'NCM sem MVA na base')
         
         mva = product['mva']
-        aliq_icms = product.get('aliq_icms', Decimal('18'))
+        aliq_icms = product.get('aliq_icms', DEFAULT_ALIQ_ICMS)
 
         if mva <= 0:
-            base.skip_reason = 'MVA zero ou negativo'
-            return base
-
-        # Passo 4: Cálculo da exclusão ICMS-ST
-        # Fórmula: VL_BC - ((VL_BC * MVA%) * ALIQ_ICMS%)
-        mva_decimal = mva / Decimal('100')
-        aliq_icms_decimal = aliq_icms / Decimal('100')
-
-        # Exclusão para PIS (baseado no campo 7 - VL_BC_PIS)
-        exclusao_pis = record.vl_bc_pis * mva_decimal * aliq_icms_decimal
-        vl_bc_pis_new = (record.vl_bc_pis - exclusao_pis).quantize(Decimal('0.01'), ROUND_HALF_UP)
-        if vl_bc_pis_new < 0:
-            vl_bc_pis_new = Decimal('0')
+            return self._skipped(record, ncm, 'MVA zero ou negativo')
 
-        # Exclusão para COFINS (baseado no campo 11 - VL_BC_COFINS)
-        exclusao_cofins = record.vl_bc_cofins * mva_decimal * aliq_icms_decimal
-        vl_bc_cofins_new = (record.vl_bc_cofins - exclusao_cofins).quantize(Decimal('0.01'), ROUND_HALF_UP)
-        if vl_bc_cofins_new < 0:
-            vl_bc_cofins_new = Decimal('0')
-
-        # Passo 6: Novos valores = BC_nova * alíquota (campos 8 e 12 têm 4 casas decimais)
-        vl_pis_new = (vl_bc_pis_new * record.aliq_pis / Decimal('100')).quantize(Decimal('0.01'), ROUND_HALF_UP)
-        vl_cofins_new = (vl_bc_cofins_new * record.aliq_cofins / Decimal('100')).quantize(Decimal('0.01'), ROUND_HALF_UP)
-
-        # Valores para relatório
-        # base_icms_st = VL_BC_PIS * MVA% (base intermediária do cálculo)
-        base_icms_st = (record.vl_bc_pis * mva_decimal).quantize(Decimal('0.01'), ROUND_HALF_UP)
-        valor_icms_st = exclusao_pis.quantize(Decimal('0.01'), ROUND_HALF_UP)
+        base_icms_st, valor_icms_st, vl_bc_pis_new, vl_pis_new, vl_bc_cofins_new, vl_cofins_new = \
+            self._adjusted_values(record.vl_bc_pis, record.aliq_pis, record.vl_bc_cofins, record.aliq_cofins,
+                                  mva, aliq_icms)
 
         economia_pis = record.vl_pis - vl_pis_new
         economia_cofins = record.vl_cofins - vl_cofins_new
@@ -577,166 +1352,726 @@ class IcmsStCalculator:
         )
 
 
+class ScenarioEvaluator:
+    """Simulações (what-if) sobre os mesmos registros de receita do processamento.
+
+    Cada cenário troca a MVA pela MVA ajustada, a alíquota interna de ICMS ou
+    o conjunto de CFOPs elegíveis. Os registros já lidos passam por todos os
+    cenários na mesma leitura do SPED; por linha, cenários que resultam nos
+    mesmos parâmetros (MVA, alíquota) compartilham um único cálculo, e os
+    parâmetros efetivos de cada NCM são resolvidos uma vez. Só os totais do
+    mês são guardados por cenário.
+    """
+
+    def __init__(self, scenarios: List[Scenario], product_base: ProductBaseLoader, cfops_elegiveis: set):
+        self.scenarios = scenarios
+        self.product_base = product_base
+        self.cfops_by_scenario = [s.cfops if s.cfops is not None else frozenset(cfops_elegiveis)
+                                  for s in scenarios]
+        self.set_context()
+        self.start_month()
+
+    def set_context(self, uf: Optional[str] = None, valid_on: Optional[str] = None) -> None:
+        """Mesmo contexto (UF, data) de ``IcmsStCalculator.set_context``"""
+        self.uf = uf
+        self.valid_on = valid_on
+        self._params_by_ncm: Dict[str, List[Optional[Tuple[Decimal, Decimal]]]] = {}
+
+    def start_month(self) -> None:
+        # Por cenário: registros, calculados, PIS original/novo, COFINS original/novo
+        self.totals = [[0, 0, Decimal('0'), Decimal('0'), Decimal('0'), Decimal('0')] for _ in self.scenarios]
+
+    def _params_for(self, ncm: Optional[str]) -> List[Optional[Tuple[Decimal, Decimal]]]:
+        params = self._params_by_ncm.get(ncm)
+        if params is None:
+            product = self.product_base.get_product_by_ncm(ncm, self.uf, self.valid_on) if ncm else None
+            params = []
+            for scenario in self.scenarios:
+                mva = None
+                if product:
+                    mva = product['mva']
+                    if scenario.use_mva_adjusted and product.get('mva_adjusted') is not None:
+                        mva = product['mva_adjusted']
+                if mva is None or mva <= 0:
+                    params.append(None)
+                    continue
+                aliq = scenario.aliq_icms if scenario.aliq_icms is not None else product.get('aliq_icms', Decimal('18'))
+                params.append((mva, aliq))
+            self._params_by_ncm[ncm] = params
+        return params
+
+    def add(self, record: SalesRecord, ncm: Optional[str]) -> None:
+        computed: Dict[Tuple[Decimal, Decimal], Tuple[Decimal, Decimal]] = {}
+        for totals, cfops, param in zip(self.totals, self.cfops_by_scenario, self._params_for(ncm)):
+            totals[0] += 1
+            if param is None or (record.cfop not in cfops and SALES_REGISTERS[record.register].cfop is not None):
+                continue
+            values = computed.get(param)
+            if values is None:
+                _, _, _, vl_pis_new, _, vl_cofins_new = IcmsStCalculator.adjusted_values(
+                    record.vl_bc_pis, record.aliq_pis, record.vl_bc_cofins, record.aliq_cofins, *param)
+                values = computed[param] = (vl_pis_new, vl_cofins_new)
+            totals[1] += 1
+            totals[2] += record.vl_pis
+            totals[3] += values[0]
+            totals[4] += record.vl_cofins
+            totals[5] += values[1]
+
+    def month_summaries(self, month: str, year: str, month_name: str) -> Dict[str, MonthSummary]:
+        return {
+            scenario.name: summarize_totals(month, year, month_name, *totals)
+            for scenario, totals in zip(self.scenarios, self.totals)
+        }
+
+
 class SpedWriter:
-    """Gera arquivo SPED retificado"""
+    """Gera arquivo SPED retificado.
+
+    O arquivo original é relido em ``generate`` e copiado em blocos entre as
+    linhas recalculadas, localizadas pelas posições em bytes guardadas pelo
+    parser; nelas só os campos de base e valor de PIS/COFINS do layout do
+    registro mudam e o terminador original (``\n`` ou ``\r\n``) é mantido.
+    """
     
     def __init__(self, parser: SpedParser, results: List[CalculationResult]):
         self.parser = parser
         self.results_by_line = {r.line_number: r for r in results if r.status == 'calculated'}
     
-    def format_decimal(self, value: Decimal) -> str:
-        return str(value.quantize(Decimal('0.01'))).replace('.', ',')
+    @staticmethod
+    def format_decimal(value: Decimal) -> bytes:
+        return str(value.quantize(Decimal('0.01'))).replace('.', ',').encode('ascii')
     
-    def generate(self) -> str:
-        modified_lines = []
+    @classmethod
+    def rewrite_line(cls, line: bytes, result: CalculationResult) -> bytes:
+        """Linha do registro de receita com as novas bases e valores de PIS/COFINS"""
+        content = line.rstrip(b'\r\n')
+        fields = SpedParser.split_fields(content)
+        layout = SALES_REGISTERS.get(fields[0].decode('latin-1'))
+        if layout is None:
+            return line
         
-        for line_num, line in enumerate(self.parser.lines, 1):
-            original = line.strip()
-            
-            if not original:
-                modified_lines.append(line)
-                continue
-            
-            result = self.results_by_line.get(line_num)
-            if not result:
-                modified_lines.append(line)
+        updates = [(position, value) for position, value in (
+            (layout.vl_bc_pis, result.vl_bc_pis_new), (layout.vl_pis, result.vl_pis_new),
+            (layout.vl_bc_cofins, result.vl_bc_cofins_new), (layout.vl_cofins, result.vl_cofins_new)
+        ) if position is not None]
+        if max(position for position, _ in updates) >= len(fields):
+            return line
+        
+        for position, value in updates:
+            fields[position] = cls.format_decimal(value)
+        
+        return b'|' + b'|'.join(fields) + b'|' + line[len(content):]
+    
+    def generate(self, stream: BinaryIO, chunk_size: int = 1024 * 1024) -> bytes:
+        """SPED retificado a partir de ``stream``, o mesmo arquivo lido pelo parser"""
+        output = io.BytesIO()
+        results_by_line = self.results_by_line
+        position = 0
+        if results_by_line:
+            parser = self.parser
+            for line_num, line, offset in zip(parser.record_lines, parser.record_raw, parser.record_offsets):
+                result = results_by_line.get(line_num)
+                if result is None:
+                    continue
+                remaining = offset - position
+                while remaining > 0:
+                    chunk = stream.read(min(remaining, chunk_size))
+                    if not chunk:
+                        break
+                    output.write(chunk)
+                    remaining -= len(chunk)
+                stream.read(len(line))
+                output.write(self.rewrite_line(line, result))
+                position = offset + len(line)
+        shutil.copyfileobj(stream, output, chunk_size)
+        return output.getvalue()
+
+
+class RollupAccumulator:
+    """Agrega resultados por NCM, item e CFOP durante o processamento"""
+
+    DIMENSIONS = ('ncm', 'cod_item', 'cfop')
+    EMPTY_KEY = '(sem valor)'
+
+    def __init__(self):
+        self.groups: Dict[str, Dict[str, GroupSummary]] = {d: {} for d in self.DIMENSIONS}
+        self._periods: Dict[Tuple[str, str], set] = {}
+
+    def add(self, result: CalculationResult, period: str) -> None:
+        calculated = result.status == 'calculated'
+        for dimension in self.DIMENSIONS:
+            key = getattr(result, dimension) or self.EMPTY_KEY
+            groups = self.groups[dimension]
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = GroupSummary(dimension=dimension, key=key)
+                self._periods[(dimension, key)] = set()
+
+            group.total_records += 1
+            if result.ncm and dimension != 'cfop':
+                group.ncm = result.ncm
+
+            periods = self._periods[(dimension, key)]
+            if period not in periods:
+                periods.add(period)
+                group.months = len(periods)
+
+            if not calculated:
                 continue
-            
-            temp = original
-            if temp.startswith('|'):
-                temp = temp[1:]
-            if temp.endswith('|'):
-                temp = temp[:-1]
-            
-            fields = temp.split('|')
-            
-            if len(fields) >= 13:
-                fields[6] = self.format_decimal(result.vl_bc_pis_new)
-                fields[8] = self.format_decimal(result.vl_pis_new)
-                fields[10] = self.format_decimal(result.vl_bc_cofins_new)
-                fields[12] = self.format_decimal(result.vl_cofins_new)
-                
-                new_line = '|' + '|'.join(fields) + '|'
-                modified_lines.append(new_line)
+
+            group.total_calculated += 1
+            group.pis_original += result.vl_pis_orig
+            group.pis_credit += result.vl_pis_orig - result.vl_pis_new
+            group.cofins_original += result.vl_cofins_orig
+            group.cofins_credit += result.vl_cofins_orig - result.vl_cofins_new
+            group.valor_icms_st += result.valor_icms_st
+            group.total_credit += result.economia_total
+
+    def get_sorted(self, dimension: str) -> List[GroupSummary]:
+        """Grupos da dimensão ordenados por crédito (maior primeiro)"""
+        return sorted(
+            self.groups[dimension].values(),
+            key=lambda g: (-g.total_credit, -g.total_records, g.key)
+        )
+
+    def to_json(self) -> Dict[str, List[Dict]]:
+        labels = {'ncm': 'por_ncm', 'cod_item': 'por_item', 'cfop': 'por_cfop'}
+        return {
+            labels[dimension]: [
+                {
+                    'chave': g.key,
+                    'ncm': g.ncm,
+                    'meses': g.months,
+                    'registros': g.total_records,
+                    'calculados': g.total_calculated,
+                    'icms_st': float(g.valor_icms_st),
+                    'credito_pis': float(g.pis_credit),
+                    'credito_cofins': float(g.cofins_credit),
+                    'credito_total': float(g.total_credit)
+                }
+                for g in self.get_sorted(dimension)
+            ]
+            for dimension in self.DIMENSIONS
+        }
+
+
+class ParquetResultExporter:
+    """Exporta as linhas calculadas em Parquet particionado por CNPJ/ano/mês.
+
+    As linhas são acumuladas em colunas e gravadas em row groups à medida que
+    o processamento avança, de modo que o lote completo nunca fica em memória.
+    """
+
+    ROW_GROUP_SIZE = 100_000
+    MONEY_FIELDS = [
+        'vl_item', 'vl_bc_pis_orig', 'vl_pis_orig', 'vl_bc_cofins_orig', 'vl_cofins_orig',
+        'base_icms_st', 'valor_icms_st', 'vl_bc_pis_new', 'vl_pis_new',
+        'vl_bc_cofins_new', 'vl_cofins_new', 'economia_pis', 'economia_cofins', 'economia_total'
+    ]
+    RATE_FIELDS = ['mva', 'aliq_icms']
+    TEXT_FIELDS = ['cod_item', 'ncm', 'cfop', 'status', 'skip_reason']
+    # Escalas das colunas decimal128: valores do SPED com mais casas são arredondados, não rejeitados
+    MONEY_QUANTUM = Decimal('0.01')
+    RATE_QUANTUM = Decimal('0.00000001')
+
+    SCHEMA = pa.schema(
+        [('line_number', pa.int64())]
+        + [(name, pa.string()) for name in TEXT_FIELDS]
+        + [(name, pa.decimal128(18, 2)) for name in MONEY_FIELDS]
+        + [(name, pa.decimal128(18, 8)) for name in RATE_FIELDS]
+    )
+
+    def __init__(self, output_dir: str, include_skipped: bool = False):
+        self.output_dir = Path(output_dir)
+        self.include_skipped = include_skipped
+        self.files: List[Path] = []
+        self.rows_written = 0
+        self._writer: Optional[pq.ParquetWriter] = None
+        self._columns: Dict[str, list] = {}
+        self._reset_columns()
+
+    def _reset_columns(self) -> None:
+        self._columns = {name: [] for name in self.SCHEMA.names}
+
+    def open_partition(self, cnpj: str, year: str, month: str) -> None:
+        """Fecha a partição corrente e abre um novo arquivo para o mês informado"""
+        self.close()
+        partition_dir = self.output_dir / f'cnpj={cnpj or "desconhecido"}' / f'ano={year}' / f'mes={month}'
+        partition_dir.mkdir(parents=True, exist_ok=True)
+        path = partition_dir / f'part-{len(list(partition_dir.glob("part-*.parquet")))}.parquet'
+        self._writer = pq.ParquetWriter(str(path), self.SCHEMA, compression='snappy')
+        self.files.append(path)
+
+    def add(self, result: CalculationResult) -> None:
+        if result.status != 'calculated' and not self.include_skipped:
+            return
+        columns = self._columns
+        columns['line_number'].append(result.line_number)
+        for name in self.TEXT_FIELDS:
+            columns[name].append(getattr(result, name))
+        for name in self.MONEY_FIELDS:
+            columns[name].append(getattr(result, name).quantize(self.MONEY_QUANTUM, ROUND_HALF_UP))
+        for name in self.RATE_FIELDS:
+            columns[name].append(getattr(result, name).quantize(self.RATE_QUANTUM, ROUND_HALF_UP))
+        if len(columns['line_number']) >= self.ROW_GROUP_SIZE:
+            self._flush()
+
+    def _flush(self) -> None:
+        count = len(self._columns['line_number'])
+        if not count or self._writer is None:
+            return
+        table = pa.Table.from_pydict(self._columns, schema=self.SCHEMA)
+        self._writer.write_table(table)
+        self.rows_written += count
+        self._reset_columns()
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._flush()
+            self._writer.close()
+            self._writer = None
+
+    def write_to_zip(self, zip_file: zipfile.ZipFile, prefix: str = 'PARQUET') -> None:
+        self.close()
+        for path in self.files:
+            # Parquet já é comprimido internamente
+            zip_file.write(path, f'{prefix}/{path.relative_to(self.output_dir).as_posix()}',
+                           compress_type=zipfile.ZIP_STORED)
+
+    def cleanup(self) -> None:
+        self.close()
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+
+
+class ResultExplorer:
+    """Consulta paginada às linhas de um lote, com filtro e ordenação no servidor.
+
+    Na construção, os campos consultáveis viram uma tabela colunar do Arrow:
+    mês, NCM, item, CFOP e situação codificados em dicionário (os filtros de
+    texto rodam só sobre os valores distintos) e os valores em float64. Filtros
+    e ordenação são vetorizados; apenas as linhas da página pedida são lidas
+    dos resultados e enviadas à tela. As primeiras páginas de uma ordenação
+    usam seleção parcial (top-k) e a última ordenação completa fica guardada
+    para a navegação entre as demais.
+    """
+
+    CALCULATED = 'Calculada'
+    PAGE_SIZES = (50, 100, 500)
+    # Até esta profundidade a página sai de uma seleção parcial, sem ordenar o lote todo
+    TOP_K_LIMIT = 10_000
+    # chave de ordenação: rótulo
+    SORT_KEYS = {
+        'position': 'Ordem do arquivo',
+        'economia_total': 'Economia Total',
+        'valor_icms_st': 'ICMS-ST',
+        'vl_item': 'Valor Item',
+        'mva': 'MVA %',
+        'ncm': 'NCM',
+        'cod_item': 'Cod Item',
+    }
+    DICTIONARY_FIELDS = ('ncm', 'cod_item', 'cfop')
+    NUMERIC_FIELDS = ('vl_item', 'valor_icms_st', 'economia_total', 'mva')
+
+    def __init__(self, all_results: Dict[str, List[CalculationResult]]):
+        self.months = list(all_results)
+        self._results: List[CalculationResult] = []
+        for results in all_results.values():
+            self._results.extend(results)
+        rows = self._results
+        month_indices = pa.concat_arrays(
+            [pa.array([code] * len(results), pa.int32()) for code, results in enumerate(all_results.values())]
+        ) if rows else pa.array([], pa.int32())
+        columns = {
+            'position': pa.array(range(len(rows)), pa.int64()),
+            'month': pa.DictionaryArray.from_arrays(month_indices, pa.array(self.months, pa.string())),
+        }
+        for name in self.DICTIONARY_FIELDS:
+            columns[name] = pa.array([getattr(r, name) for r in rows], pa.string()).dictionary_encode()
+        columns['situacao'] = pa.array(
+            [r.skip_reason or self.CALCULATED for r in rows], pa.string()
+        ).dictionary_encode()
+        for name in self.NUMERIC_FIELDS:
+            columns[name] = pa.array([float(getattr(r, name)) for r in rows], pa.float64())
+        # Ordenação de texto pela posição de cada valor no dicionário ordenado
+        for name in ('ncm', 'cod_item'):
+            dictionary = columns[name]
+            ranks = pc.rank(dictionary.dictionary, sort_keys='ascending', tiebreaker='dense')
+            columns[f'{name}_ordem'] = pc.take(ranks.cast(pa.int32()), dictionary.indices)
+        self.table = pa.table(columns)
+        self._sorted: Optional[Tuple[tuple, pa.Array]] = None
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    def values(self, name: str) -> List[str]:
+        """Valores distintos de uma coluna codificada, para as listas de filtro"""
+        return sorted(self.table[name].chunk(0).dictionary.to_pylist()) if len(self) else []
+
+    def _dictionary_mask(self, name: str, matches: Callable[[pa.Array], pa.Array]) -> pa.Array:
+        column = self.table[name].chunk(0)
+        codes = pc.indices_nonzero(matches(column.dictionary)).cast(column.indices.type)
+        return pc.is_in(column.indices, value_set=codes)
+
+    def _mask(self, months: Tuple[str, ...], ncm: str, cod_item: str, cfops: Tuple[str, ...],
+              situacoes: Tuple[str, ...]) -> Optional[pa.Array]:
+        masks = []
+        if months:
+            masks.append(self._dictionary_mask('month', lambda d: pc.is_in(d, value_set=pa.array(months))))
+        if ncm:
+            masks.append(self._dictionary_mask('ncm', lambda d: pc.starts_with(d, pattern=ncm)))
+        if cod_item:
+            masks.append(self._dictionary_mask(
+                'cod_item', lambda d: pc.match_substring(d, pattern=cod_item, ignore_case=True)))
+        if cfops:
+            masks.append(self._dictionary_mask('cfop', lambda d: pc.is_in(d, value_set=pa.array(cfops))))
+        if situacoes:
+            masks.append(self._dictionary_mask('situacao', lambda d: pc.is_in(d, value_set=pa.array(situacoes))))
+        if not masks:
+            return None
+        mask = masks[0]
+        for other in masks[1:]:
+            mask = pc.and_(mask, other)
+        return mask
+
+    def query(self, months: Tuple[str, ...] = (), ncm: str = '', cod_item: str = '',
+              cfops: Tuple[str, ...] = (), situacoes: Tuple[str, ...] = (), sort: str = 'position',
+              descending: bool = False, page: int = 1, page_size: int = 100) -> Tuple[int, int, pd.DataFrame]:
+        """Aplica filtros e ordenação e devolve (total de linhas, página efetiva, linhas da página)"""
+        filters = (tuple(months), ncm.strip(), cod_item.strip(), tuple(cfops), tuple(situacoes))
+        mask = self._mask(*filters)
+        table = self.table.filter(mask) if mask is not None else self.table
+        total = table.num_rows
+        page = max(1, min(page, -(-total // page_size) or 1))
+        start = (page - 1) * page_size
+        stop = min(start + page_size, total)
+        order = 'descending' if descending else 'ascending'
+
+        if not total:
+            positions = []
+        elif sort == 'position':
+            if descending:
+                positions = table['position'].slice(total - stop, stop - start).to_pylist()[::-1]
             else:
-                modified_lines.append(line)
-        
-        return '\n'.join(modified_lines)
+                positions = table['position'].slice(start, stop - start).to_pylist()
+        else:
+            key_column = f'{sort}_ordem' if sort in ('ncm', 'cod_item') else sort
+            # Empates ficam na ordem do arquivo, para que as páginas não se sobreponham
+            sort_keys = [(key_column, order), ('position', 'ascending')]
+            cache_key = (filters, sort, descending)
+            if self._sorted and self._sorted[0] == cache_key:
+                ordered = self._sorted[1]
+            elif stop <= self.TOP_K_LIMIT:
+                ordered = table['position'].take(pc.select_k_unstable(table, k=stop, sort_keys=sort_keys))
+            else:
+                # A ordenação completa é estável e a tabela já está na ordem do arquivo
+                ordered = table['position'].take(pc.sort_indices(table, sort_keys=[(key_column, order)]))
+                self._sorted = (cache_key, ordered)
+            positions = ordered.slice(start, stop - start).to_pylist()
+
+        month_column = self.table['month'].take(pa.array(positions, pa.int64())).to_pylist()
+        return total, page, self._page_frame(positions, month_column)
+
+    def _page_frame(self, positions: List[int], months: List[str]) -> pd.DataFrame:
+        rows = []
+        for position, month in zip(positions, months):
+            r = self._results[position]
+            rows.append({
+                'Mês': month,
+                'Linha': r.line_number,
+                'Cod Item': r.cod_item,
+                'NCM': r.ncm,
+                'CFOP': r.cfop,
+                'Situação': r.skip_reason or self.CALCULATED,
+                'Valor Item': float(r.vl_item),
+                'MVA %': float(r.mva),
+                'ICMS-ST': float(r.valor_icms_st),
+                'PIS Orig': float(r.vl_pis_orig),
+                'PIS Novo': float(r.vl_pis_new),
+                'COFINS Orig': float(r.vl_cofins_orig),
+                'COFINS Novo': float(r.vl_cofins_new),
+                'Economia Total': float(r.economia_total),
+            })
+        return pd.DataFrame(rows, columns=['Mês', 'Linha', 'Cod Item', 'NCM', 'CFOP', 'Situação', 'Valor Item',
+                                           'MVA %', 'ICMS-ST', 'PIS Orig', 'PIS Novo', 'COFINS Orig',
+                                           'COFINS Novo', 'Economia Total'])
 
 
 # =============================================================================
 # GERADORES DE OUTPUT
 # =============================================================================
 
-def generate_excel(all_results: Dict[str, List[CalculationResult]], summaries: List[MonthSummary]) -> bytes:
-    """Gera Excel consolidado com uma aba por mês"""
-    wb = Workbook()
-    wb.remove(wb.active)
-    
-    header_font = Font(bold=True, color='FFFFFF')
-    header_fill = PatternFill('solid', fgColor='2E7D32')
-    money_fill = PatternFill('solid', fgColor='E8F5E9')
-    thin_border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
-    
-    # Aba de resumo
-    ws = wb.create_sheet(title='RESUMO', index=0)
-    ws.merge_cells('A1:H1')
-    ws['A1'].value = 'RESUMO CONSOLIDADO - EXCLUSÃO ICMS-ST DA BASE PIS/COFINS'
-    ws['A1'].font = Font(bold=True, size=14)
-    ws['A1'].alignment = Alignment(horizontal='center')
+ROLLUP_SHEETS = [
+    ('ncm', 'RESUMO_NCM', 'NCM', 'RESUMO POR NCM'),
+    ('cod_item', 'RESUMO_ITEM', 'Cod Item', 'RESUMO POR ITEM'),
+    ('cfop', 'RESUMO_CFOP', 'CFOP', 'RESUMO POR CFOP'),
+]
+
+# Limite de linhas de uma planilha Excel (inclui a linha de cabeçalho)
+EXCEL_MAX_ROWS = 1_048_576
+
+DETAIL_HEADERS = [
+    'Linha', 'Cod Item', 'NCM', 'CFOP', 'Valor Item',
+    'BC PIS Orig', 'PIS Orig', 'BC COFINS Orig', 'COFINS Orig',
+    'MVA %', 'ICMS-ST', 'BC PIS Nova', 'PIS Novo',
+    'BC COFINS Nova', 'COFINS Novo', 'Economia PIS', 'Economia COFINS', 'Economia Total'
+]
+
+HEADER_FONT = Font(bold=True, color='FFFFFF')
+HEADER_FILL = PatternFill('solid', fgColor='2E7D32')
+MONEY_FILL = PatternFill('solid', fgColor='E8F5E9')
+THIN_BORDER = Border(
+    left=Side(style='thin'),
+    right=Side(style='thin'),
+    top=Side(style='thin'),
+    bottom=Side(style='thin')
+)
+MONEY_FORMAT = 'R$ #,##0.00'
+
+
+def month_sheet_name(month_name: str, year: str) -> str:
+    """Nome da aba de detalhe de um mês (ex.: Mar_2022)"""
+    return f'{month_name[:3]}_{year}'
+
+
+def detail_shard_names(sheet_name: str, total_rows: int, max_rows_per_sheet: int) -> List[str]:
+    """Nomes das abas de um mês, com abas de continuação quando excede o limite de linhas"""
+    base = sheet_name[:31]
+    shards = max(1, -(-total_rows // max_rows_per_sheet))
+    return [base] + [f'{base[:27]}_p{n}' for n in range(2, shards + 1)]
+
+
+def _cell(ws, value=None, font=None, fill=None, border=None, alignment=None, number_format=None) -> WriteOnlyCell:
+    cell = WriteOnlyCell(ws, value=value)
+    if font is not None:
+        cell.font = font
+    if fill is not None:
+        cell.fill = fill
+    if border is not None:
+        cell.border = border
+    if alignment is not None:
+        cell.alignment = alignment
+    if number_format is not None:
+        cell.number_format = number_format
+    return cell
+
+
+def _write_title(ws, title: str, last_col: int) -> None:
+    ws.merged_cells.add(f'A1:{get_column_letter(last_col)}1')
+    ws.append([_cell(ws, title, font=Font(bold=True, size=14), alignment=Alignment(horizontal='center'))])
+    ws.append([])
+
+
+def _write_header_row(ws, headers: List[str]) -> None:
+    ws.append([
+        _cell(ws, header, font=HEADER_FONT, fill=HEADER_FILL, border=THIN_BORDER,
+              alignment=Alignment(horizontal='center'))
+        for header in headers
+    ])
+
+
+def _write_total_row(ws, first_row: int, last_row: int, sum_cols: List[int], money_cols: List[int],
+                     last_col: int) -> None:
+    row = [_cell(ws, 'TOTAL', font=Font(bold=True))]
+    for col in range(2, last_col + 1):
+        if col not in sum_cols:
+            row.append(None)
+            continue
+        col_letter = get_column_letter(col)
+        row.append(_cell(
+            ws, f'=SUM({col_letter}{first_row}:{col_letter}{last_row})',
+            font=Font(bold=True), fill=MONEY_FILL, border=THIN_BORDER,
+            number_format=MONEY_FORMAT if col in money_cols else None
+        ))
+    ws.append(row)
+
+
+def _write_detail_sheets(wb: Workbook, sheet_name: str, results: List[CalculationResult],
+                         max_rows_per_sheet: int) -> List[str]:
+    """Grava as linhas calculadas de um mês, abrindo abas de continuação quando necessário"""
+    calculated = [r for r in results if r.status == 'calculated']
+    shard_names = detail_shard_names(sheet_name, len(calculated), max_rows_per_sheet)
     
-    headers = ['Mês/Ano', 'Registros', 'Calculados', 'PIS Original', 'PIS Crédito', 
-               'COFINS Original', 'COFINS Crédito', 'Crédito Total']
-    
-    for col, header in enumerate(headers, 1):
-        cell = ws.cell(row=3, column=col, value=header)
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.border = thin_border
-        cell.alignment = Alignment(horizontal='center')
-    
-    for row_num, summary in enumerate(summaries, 4):
-        ws.cell(row=row_num, column=1, value=f'{summary.month_name}/{summary.year}')
-        ws.cell(row=row_num, column=2, value=summary.total_records)
-        ws.cell(row=row_num, column=3, value=summary.total_calculated)
-        ws.cell(row=row_num, column=4, value=float(summary.pis_original))
-        ws.cell(row=row_num, column=5, value=float(summary.pis_credit))
-        ws.cell(row=row_num, column=6, value=float(summary.cofins_original))
-        ws.cell(row=row_num, column=7, value=float(summary.cofins_credit))
-        ws.cell(row=row_num, column=8, value=float(summary.total_credit))
-        
-        for col in range(1, 9):
-            ws.cell(row=row_num, column=col).border = thin_border
+    for shard_idx, shard_name in enumerate(shard_names):
+        ws = wb.create_sheet(title=shard_name)
+        for col in range(1, 19):
+            ws.column_dimensions[get_column_letter(col)].width = 14
+        _write_header_row(ws, DETAIL_HEADERS)
+        
+        # Estilo com borda registrado uma única vez e copiado para cada célula
+        bordered_style = _cell(ws, border=THIN_BORDER)._style
+        
+        start = shard_idx * max_rows_per_sheet
+        for result in calculated[start:start + max_rows_per_sheet]:
+            values = [
+                result.line_number,
+                result.cod_item,
+                result.ncm,
+                result.cfop,
+                float(result.vl_item),
+                float(result.vl_bc_pis_orig),
+                float(result.vl_pis_orig),
+                float(result.vl_bc_cofins_orig),
+                float(result.vl_cofins_orig),
+                float(result.mva),
+                float(result.valor_icms_st),
+                float(result.vl_bc_pis_new),
+                float(result.vl_pis_new),
+                float(result.vl_bc_cofins_new),
+                float(result.vl_cofins_new),
+                float(result.economia_pis),
+                float(result.economia_cofins),
+                float(result.economia_total),
+            ]
+            row = []
+            for value in values:
+                cell = WriteOnlyCell(ws, value=value)
+                cell._style = copy(bordered_style)
+                row.append(cell)
+            ws.append(row)
     
-    total_row = len(summaries) + 4
-    ws.cell(row=total_row, column=1, value='TOTAL')
-    ws.cell(row=total_row, column=1).font = Font(bold=True)
+    return shard_names
+
+
+def generate_detail_workbook(sheet_name: str, results: List[CalculationResult],
+                             max_rows_per_sheet: int = EXCEL_MAX_ROWS - 1) -> bytes:
+    """Gera o Excel De/Para de um único mês (usado na exportação de uma planilha por mês)"""
+    wb = Workbook(write_only=True)
+    _write_detail_sheets(wb, sheet_name, results, max_rows_per_sheet)
     
-    for col in [2, 3, 4, 5, 6, 7, 8]:
-        col_letter = get_column_letter(col)
-        cell = ws.cell(row=total_row, column=col)
-        cell.value = f'=SUM({col_letter}4:{col_letter}{total_row-1})'
-        cell.font = Font(bold=True)
-        cell.fill = money_fill
-        cell.border = thin_border
+    output = io.BytesIO()
+    wb.save(output)
+    return output.getvalue()
+
+
+def detail_workbook_filename(sheet_name: str) -> str:
+    return f'DE_PARA_MENSAL/DE_PARA_{sheet_name}.xlsx'
+
+
+def generate_excel(all_results: Dict[str, List[CalculationResult]], summaries: List[MonthSummary],
+                   rollups: Optional[RollupAccumulator] = None,
+                   max_rows_per_sheet: int = EXCEL_MAX_ROWS - 1,
+                   split_by_month: bool = False,
+                   scenario_summaries: Optional[Dict[str, List[MonthSummary]]] = None,
+                   link_detail_workbooks: bool = False) -> bytes:
+    """Gera Excel consolidado com uma aba por mês.
+
+    A planilha é gravada em modo streaming (write-only). Meses que excedem o
+    limite de linhas do Excel são divididos em abas de continuação, e a aba
+    RESUMO traz links para cada uma delas. Com ``split_by_month`` as abas de
+    detalhe não são gravadas e a aba RESUMO cita os arquivos gerados por
+    ``generate_detail_workbook``; os links para eles só são gravados com
+    ``link_detail_workbooks``, quando o Excel vai junto desses arquivos
+    (ZIP completo, resultado do spool). ``scenario_summaries`` (resumos por cenário,
+    na mesma ordem de ``summaries``) gera a aba CENÁRIOS, lado a lado com o
+    processamento atual.
+    """
+    wb = Workbook(write_only=True)
     
-    for row in range(4, total_row + 1):
-        for col in [4, 5, 6, 7, 8]:
-            ws.cell(row=row, column=col).number_format = 'R$ #,##0.00'
+    # Abas de detalhe planejadas de antemão para que o RESUMO possa apontar para elas
+    shard_plan: Dict[str, List[str]] = {}
+    for sheet_name, results in all_results.items():
+        total_calculated = sum(1 for r in results if r.status == 'calculated')
+        shard_plan[sheet_name] = detail_shard_names(sheet_name, total_calculated, max_rows_per_sheet)
+    max_links = max((len(names) for names in shard_plan.values()), default=1)
     
+    # Aba de resumo
+    ws = wb.create_sheet(title='RESUMO')
     ws.column_dimensions['A'].width = 15
     for col in range(2, 9):
         ws.column_dimensions[get_column_letter(col)].width = 18
+    for col in range(9, 9 + max_links):
+        ws.column_dimensions[get_column_letter(col)].width = 16
     
-    # Abas por mês
-    for sheet_name, results in all_results.items():
-        ws = wb.create_sheet(title=sheet_name[:31])
-        calculated = [r for r in results if r.status == 'calculated']
-        
-        headers = [
-            'Linha', 'Cod Item', 'NCM', 'CFOP', 'Valor Item',
-            'BC PIS Orig', 'PIS Orig', 'BC COFINS Orig', 'COFINS Orig',
-            'MVA %', 'ICMS-ST', 'BC PIS Nova', 'PIS Novo',
-            'BC COFINS Nova', 'COFINS Novo', 'Economia PIS', 'Economia COFINS', 'Economia Total'
-        ]
+    _write_title(ws, 'RESUMO CONSOLIDADO - EXCLUSÃO ICMS-ST DA BASE PIS/COFINS', 8)
+    
+    headers = ['Mês/Ano', 'Registros', 'Calculados', 'PIS Original', 'PIS Crédito', 
+               'COFINS Original', 'COFINS Crédito', 'Crédito Total', 'Detalhe']
+    _write_header_row(ws, headers)
+    
+    for summary in summaries:
+        sheet_name = month_sheet_name(summary.month_name, summary.year)
+        row = [_cell(ws, f'{summary.month_name}/{summary.year}', border=THIN_BORDER),
+               _cell(ws, summary.total_records, border=THIN_BORDER),
+               _cell(ws, summary.total_calculated, border=THIN_BORDER)]
+        for value in [summary.pis_original, summary.pis_credit, summary.cofins_original,
+                      summary.cofins_credit, summary.total_credit]:
+            row.append(_cell(ws, float(value), border=THIN_BORDER, number_format=MONEY_FORMAT))
         
-        for col, header in enumerate(headers, 1):
-            cell = ws.cell(row=1, column=col, value=header)
-            cell.font = header_font
-            cell.fill = header_fill
-            cell.border = thin_border
-            cell.alignment = Alignment(horizontal='center')
-        
-        for row_num, result in enumerate(calculated, 2):
-            ws.cell(row=row_num, column=1, value=result.line_number)
-            ws.cell(row=row_num, column=2, value=result.cod_item)
-            ws.cell(row=row_num, column=3, value=result.ncm)
-            ws.cell(row=row_num, column=4, value=result.cfop)
-            ws.cell(row=row_num, column=5, value=float(result.vl_item))
-            ws.cell(row=row_num, column=6, value=float(result.vl_bc_pis_orig))
-            ws.cell(row=row_num, column=7, value=float(result.vl_pis_orig))
-            ws.cell(row=row_num, column=8, value=float(result.vl_bc_cofins_orig))
-            ws.cell(row=row_num, column=9, value=float(result.vl_cofins_orig))
-            ws.cell(row=row_num, column=10, value=float(result.mva))
-            ws.cell(row=row_num, column=11, value=float(result.valor_icms_st))
-            ws.cell(row=row_num, column=12, value=float(result.vl_bc_pis_new))
-            ws.cell(row=row_num, column=13, value=float(result.vl_pis_new))
-            ws.cell(row=row_num, column=14, value=float(result.vl_bc_cofins_new))
-            ws.cell(row=row_num, column=15, value=float(result.vl_cofins_new))
-            ws.cell(row=row_num, column=16, value=float(result.economia_pis))
-            ws.cell(row=row_num, column=17, value=float(result.economia_cofins))
-            ws.cell(row=row_num, column=18, value=float(result.economia_total))
-            
-            for col in range(1, 19):
-                ws.cell(row=row_num, column=col).border = thin_border
+        link_font = Font(color='0563C1', underline='single')
+        if split_by_month:
+            if sheet_name in shard_plan:
+                target = detail_workbook_filename(sheet_name)
+                if link_detail_workbooks:
+                    row.append(_cell(ws, f'=HYPERLINK("{target}","{sheet_name}.xlsx")', font=link_font))
+                else:
+                    # Excel baixado sozinho: o arquivo mensal só existe no ZIP completo
+                    row.append(_cell(ws, f'{target} (ZIP completo)'))
+        else:
+            for shard_name in shard_plan.get(sheet_name, []):
+                row.append(_cell(ws, f'=HYPERLINK("#\'{shard_name}\'!A1","{shard_name}")', font=link_font))
+        ws.append(row)
+    
+    total_row = len(summaries) + 4
+    _write_total_row(ws, 4, total_row - 1, [2, 3, 4, 5, 6, 7, 8], [4, 5, 6, 7, 8], 8)
+    
+    # Comparação de cenários: créditos lado a lado, um par de colunas por cenário
+    if scenario_summaries:
+        columns = {'Atual': summaries, **scenario_summaries}
+        last_col = 1 + 2 * len(columns)
+        ws = wb.create_sheet(title='CENÁRIOS')
+        ws.column_dimensions['A'].width = 15
+        for col in range(2, last_col + 1):
+            ws.column_dimensions[get_column_letter(col)].width = 22
         
-        for col in range(1, 19):
-            ws.column_dimensions[get_column_letter(col)].width = 14
+        _write_title(ws, 'COMPARAÇÃO DE CENÁRIOS - CRÉDITO PIS/COFINS', last_col)
+        
+        headers = ['Mês/Ano']
+        for name in columns:
+            headers += [f'{name} - Calculados', f'{name} - Crédito']
+        _write_header_row(ws, headers)
+        
+        for idx, summary in enumerate(summaries):
+            row = [_cell(ws, f'{summary.month_name}/{summary.year}', border=THIN_BORDER)]
+            for month_summaries in columns.values():
+                row.append(_cell(ws, month_summaries[idx].total_calculated, border=THIN_BORDER))
+                row.append(_cell(ws, float(month_summaries[idx].total_credit), border=THIN_BORDER,
+                                 number_format=MONEY_FORMAT))
+            ws.append(row)
+        
+        _write_total_row(ws, 4, len(summaries) + 3, list(range(2, last_col + 1)),
+                         list(range(3, last_col + 1, 2)), last_col)
+    
+    # Abas de resumo por NCM, item e CFOP
+    if rollups is not None:
+        for dimension, title, key_label, caption in ROLLUP_SHEETS:
+            ws = wb.create_sheet(title=title)
+            ws.column_dimensions['A'].width = 18
+            ws.column_dimensions['B'].width = 12
+            for col in range(3, 11):
+                ws.column_dimensions[get_column_letter(col)].width = 16
+            
+            _write_title(ws, f'{caption} - EXCLUSÃO ICMS-ST DA BASE PIS/COFINS', 10)
+            
+            headers = [key_label, 'NCM', 'Meses', 'Registros', 'Calculados', 'ICMS-ST',
+                       'PIS Original', 'PIS Crédito', 'COFINS Crédito', 'Crédito Total']
+            _write_header_row(ws, headers)
+            
+            groups = rollups.get_sorted(dimension)
+            for group in groups:
+                row = [_cell(ws, value, border=THIN_BORDER) for value in
+                       [group.key, group.ncm, group.months, group.total_records, group.total_calculated]]
+                for value in [group.valor_icms_st, group.pis_original, group.pis_credit,
+                              group.cofins_credit, group.total_credit]:
+                    row.append(_cell(ws, float(value), border=THIN_BORDER, number_format=MONEY_FORMAT))
+                ws.append(row)
+            
+            total_row = len(groups) + 4
+            _write_total_row(ws, 4, total_row - 1, [4, 5, 6, 7, 8, 9, 10], [6, 7, 8, 9, 10], 10)
+    
+    # Abas por mês
+    if not split_by_month:
+        for sheet_name, results in all_results.items():
+            _write_detail_sheets(wb, sheet_name, results, max_rows_per_sheet)
     
     output = io.BytesIO()
     wb.save(output)
@@ -845,6 +2180,2092 @@ def generate_pdf(summaries: List[MonthSummary], company_name: str, cnpj: str) ->
     return output.getvalue()
 
 
+def generate_summary_json(summaries: List[MonthSummary], company_name: str, cnpj: str, cfops: set,
+                          rollups: Optional[RollupAccumulator] = None,
+                          scenario_summaries: Optional[Dict[str, List[MonthSummary]]] = None) -> Dict:
+    """Gera o resumo consolidado para integração (JSON)"""
+    total_records = sum(s.total_records for s in summaries)
+    total_calculated = sum(s.total_calculated for s in summaries)
+    summary_json = {
+        'empresa': company_name,
+        'cnpj': cnpj,
+        'periodo': f'{summaries[0].month_name}/{summaries[0].year} a {summaries[-1].month_name}/{summaries[-1].year}',
+        'processado_em': datetime.now().isoformat(),
+        'cfops_utilizados': list(cfops),
+        'total_registros': total_records,
+        'total_calculados': total_calculated,
+        'credito_pis': float(sum(s.pis_credit for s in summaries)),
+        'credito_cofins': float(sum(s.cofins_credit for s in summaries)),
+        'credito_total': float(sum(s.total_credit for s in summaries)),
+        'meses': [
+            {
+                'mes': s.month_name,
+                'ano': s.year,
+                'registros': s.total_records,
+                'calculados': s.total_calculated,
+                'credito_pis': float(s.pis_credit),
+                'credito_cofins': float(s.cofins_credit),
+                'credito_total': float(s.total_credit)
+            }
+            for s in summaries
+        ],
+        'agrupamentos': rollups.to_json() if rollups else {}
+    }
+    if scenario_summaries:
+        summary_json['cenarios'] = [
+            {
+                'nome': name,
+                'calculados': sum(s.total_calculated for s in month_summaries),
+                'credito_pis': float(sum(s.pis_credit for s in month_summaries)),
+                'credito_cofins': float(sum(s.cofins_credit for s in month_summaries)),
+                'credito_total': float(sum(s.total_credit for s in month_summaries)),
+                'meses': [{'mes': s.month_name, 'ano': s.year, 'credito_total': float(s.total_credit)}
+                          for s in month_summaries]
+            }
+            for name, month_summaries in scenario_summaries.items()
+        ]
+    return summary_json
+
+
+class BatchArtifacts:
+    """Resultado de um lote processado e os seus arquivos de download.
+
+    Cada arquivo é gerado no primeiro pedido e guardado para os seguintes;
+    os que nunca são pedidos não custam CPU nem memória. O ZIP completo
+    reaproveita os arquivos já gerados. O objeto fica na sessão, de modo que
+    os resultados continuam na tela entre as reexecuções do script.
+    """
+
+    # nome: (rótulo, arquivo, MIME); o nome do ZIP completo vem do primeiro SPED do lote
+    SPECS = {
+        'excel': ('Excel (De/Para)', 'DE_PARA_CONSOLIDADO.xlsx',
+                  'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+        'pdf': ('PDF (Relatório)', 'RELATORIO_CONSOLIDADO.pdf', 'application/pdf'),
+        'speds': ('SPEDs Retificados', 'SPEDS_RETIFICADOS.zip', 'application/zip'),
+        'json': ('JSON', 'resumo_consolidado.json', 'application/json'),
+        'completo': ('Todos os Arquivos (ZIP)', None, 'application/zip'),
+    }
+
+    def __init__(self, summaries: List[MonthSummary], all_results: Dict[str, List[CalculationResult]],
+                 sped_outputs: Dict[str, bytes], company_name: str, cnpj: str, cfops: set,
+                 rollups: RollupAccumulator, scenario_summaries: Optional[Dict[str, List[MonthSummary]]] = None,
+                 split_by_month: bool = False, parquet_exporter: Optional[ParquetResultExporter] = None,
+                 zip_name: str = 'resultados.zip', metrics: Optional['MetricsRegistry'] = None,
+                 profiler: Optional['SamplingProfiler'] = None):
+        self.summaries = summaries
+        self.all_results = all_results
+        self.sped_outputs = sped_outputs
+        self.company_name = company_name
+        self.cnpj = cnpj
+        self.cfops = cfops
+        self.rollups = rollups
+        self.scenario_summaries = scenario_summaries or {}
+        self.split_by_month = split_by_month
+        self.parquet_exporter = parquet_exporter
+        self.zip_name = zip_name
+        self.metrics = metrics
+        # Perfil do lote: a geração dos arquivos também é amostrada e o resultado vai no ZIP completo
+        self.profiler = profiler
+        self._data: Dict[str, bytes] = {}
+        self._summary_json: Optional[Dict] = None
+        self._explorer: Optional[ResultExplorer] = None
+        if parquet_exporter:
+            # Sessão encerrada sem pedir o ZIP completo: os Parquet temporários saem junto
+            weakref.finalize(self, parquet_exporter.cleanup)
+
+    def filename(self, name: str) -> str:
+        return self.SPECS[name][1] or self.zip_name
+
+    def is_ready(self, name: str) -> bool:
+        return name in self._data
+
+    def get(self, name: str) -> bytes:
+        if name not in self._data:
+            started = time.perf_counter()
+            with self.profiler.capture(f'artefato_{name}') if self.profiler else nullcontext():
+                self._data[name] = getattr(self, f'_build_{name}')()
+            if self.metrics:
+                self.metrics.observe('icmsst_artifact_duration_seconds', time.perf_counter() - started, artifact=name)
+                self.metrics.observe('icmsst_artifact_size_bytes', len(self._data[name]), artifact=name)
+        return self._data[name]
+
+    def explorer(self) -> ResultExplorer:
+        """Índice das linhas do lote, montado na primeira consulta"""
+        if self._explorer is None:
+            self._explorer = ResultExplorer(self.all_results)
+        return self._explorer
+
+    def summary_json(self) -> Dict:
+        if self._summary_json is None:
+            self._summary_json = generate_summary_json(self.summaries, self.company_name, self.cnpj, self.cfops,
+                                                       self.rollups, self.scenario_summaries)
+        return self._summary_json
+
+    def cleanup(self) -> None:
+        if self.parquet_exporter:
+            self.parquet_exporter.cleanup()
+            self.parquet_exporter = None
+
+    def _build_excel(self) -> bytes:
+        return generate_excel(self.all_results, self.summaries, self.rollups,
+                              split_by_month=self.split_by_month, scenario_summaries=self.scenario_summaries)
+
+    def _build_pdf(self) -> bytes:
+        return generate_pdf(self.summaries, self.company_name, self.cnpj)
+
+    def _build_speds(self) -> bytes:
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            for filename, content in self.sped_outputs.items():
+                zip_file.writestr(filename, content)
+        return buffer.getvalue()
+
+    def _build_json(self) -> bytes:
+        return json.dumps(self.summary_json(), ensure_ascii=False, indent=2).encode('utf-8')
+
+    def _build_completo(self) -> bytes:
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_all:
+            if self.split_by_month:
+                # No ZIP o RESUMO aponta para os workbooks mensais gravados ao lado
+                zip_all.writestr(self.filename('excel'), generate_excel(
+                    self.all_results, self.summaries, self.rollups, split_by_month=True,
+                    scenario_summaries=self.scenario_summaries, link_detail_workbooks=True))
+                # Um workbook por vez, gravado direto no ZIP
+                for sheet_name, results in self.all_results.items():
+                    zip_all.writestr(detail_workbook_filename(sheet_name),
+                                     generate_detail_workbook(sheet_name, results))
+            else:
+                zip_all.writestr(self.filename('excel'), self.get('excel'))
+            zip_all.writestr(self.filename('pdf'), self.get('pdf'))
+            zip_all.writestr(self.filename('json'), self.get('json'))
+            for filename, content in self.sped_outputs.items():
+                zip_all.writestr(f"SPEDS_RETIFICADOS/{filename}", content)
+            if self.parquet_exporter:
+                self.parquet_exporter.write_to_zip(zip_all)
+            if self.profiler:
+                self.profiler.write_to_zip(zip_all)
+        # Os Parquet só entram no ZIP completo, que agora fica guardado
+        self.cleanup()
+        return buffer.getvalue()
+
+
+# =============================================================================
+# PERSISTÊNCIA
+# =============================================================================
+
+DEFAULT_RESULT_STORE_PATH = 'data/icmsst_resultados.db'
+
+
+def get_result_store_path() -> str:
+    """Caminho do banco SQLite de histórico (configurável em secrets.toml)"""
+    try:
+        return st.secrets.get("storage", {}).get("sqlite_path", DEFAULT_RESULT_STORE_PATH)
+    except Exception:
+        return DEFAULT_RESULT_STORE_PATH
+
+
+def to_centavos(value: Decimal) -> int:
+    return int((value * 100).to_integral_value(ROUND_HALF_UP))
+
+
+def from_centavos(value: Optional[int]) -> Decimal:
+    return Decimal(value or 0).scaleb(-2)
+
+
+class ResultStore:
+    """Histórico de resultados em SQLite para consultas sem reprocessar o lote.
+
+    Valores monetários são gravados em centavos (INTEGER), o que mantém as
+    somas exatas. Regravar um mês de um CNPJ substitui os dados anteriores.
+    """
+
+    BATCH_SIZE = 10_000
+    RESULT_MONEY_FIELDS = [
+        'vl_item', 'vl_bc_pis_orig', 'vl_pis_orig', 'vl_bc_cofins_orig', 'vl_cofins_orig',
+        'base_icms_st', 'valor_icms_st', 'vl_bc_pis_new', 'vl_pis_new',
+        'vl_bc_cofins_new', 'vl_cofins_new', 'economia_pis', 'economia_cofins', 'economia_total'
+    ]
+    SUMMARY_MONEY_FIELDS = [
+        'pis_original', 'pis_adjusted', 'pis_credit',
+        'cofins_original', 'cofins_adjusted', 'cofins_credit', 'total_credit'
+    ]
+
+    SCHEMA = f"""
+        CREATE TABLE IF NOT EXISTS month_summaries (
+            cnpj TEXT NOT NULL,
+            period TEXT NOT NULL,
+            year TEXT NOT NULL,
+            month TEXT NOT NULL,
+            month_name TEXT NOT NULL,
+            company_name TEXT,
+            total_records INTEGER NOT NULL,
+            total_calculated INTEGER NOT NULL,
+            total_skipped INTEGER NOT NULL,
+            {', '.join(f'{name} INTEGER NOT NULL' for name in SUMMARY_MONEY_FIELDS)},
+            savings_percentage TEXT NOT NULL,
+            cfops TEXT,
+            processed_at TEXT NOT NULL,
+            PRIMARY KEY (cnpj, period)
+        );
+        CREATE TABLE IF NOT EXISTS results (
+            cnpj TEXT NOT NULL,
+            period TEXT NOT NULL,
+            line_number INTEGER NOT NULL,
+            cod_item TEXT,
+            ncm TEXT,
+            cfop TEXT,
+            status TEXT NOT NULL,
+            skip_reason TEXT,
+            mva TEXT,
+            aliq_icms TEXT,
+            {', '.join(f'{name} INTEGER NOT NULL' for name in RESULT_MONEY_FIELDS)}
+        );
+        CREATE INDEX IF NOT EXISTS idx_results_cnpj_period ON results (cnpj, period);
+        CREATE INDEX IF NOT EXISTS idx_results_period ON results (period);
+        CREATE INDEX IF NOT EXISTS idx_results_ncm ON results (cnpj, ncm, period);
+        CREATE INDEX IF NOT EXISTS idx_results_cod_item ON results (cnpj, cod_item, period);
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(self.SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def save_month(self, cnpj: str, summary: MonthSummary, results: List[CalculationResult],
+                   company_name: str = '', cfops: Optional[set] = None) -> int:
+        """Grava o resumo e as linhas de um mês, substituindo gravações anteriores"""
+        period = f'{summary.year}-{summary.month}'
+        result_columns = (['cnpj', 'period', 'line_number', 'cod_item', 'ncm', 'cfop', 'status',
+                           'skip_reason', 'mva', 'aliq_icms'] + self.RESULT_MONEY_FIELDS)
+        insert_result = (f'INSERT INTO results ({", ".join(result_columns)}) '
+                         f'VALUES ({", ".join("?" * len(result_columns))})')
+        
+        def rows():
+            for r in results:
+                yield ((cnpj, period, r.line_number, r.cod_item, r.ncm, r.cfop, r.status,
+                        r.skip_reason, str(r.mva), str(r.aliq_icms))
+                       + tuple(to_centavos(getattr(r, name)) for name in self.RESULT_MONEY_FIELDS))
+        
+        with self.conn:
+            self.conn.execute('DELETE FROM results WHERE cnpj = ? AND period = ?', (cnpj, period))
+            self.conn.execute('DELETE FROM month_summaries WHERE cnpj = ? AND period = ?', (cnpj, period))
+            summary_row = (
+                (cnpj, period, summary.year, summary.month, summary.month_name, company_name,
+                 summary.total_records, summary.total_calculated, summary.total_skipped)
+                + tuple(to_centavos(getattr(summary, name)) for name in self.SUMMARY_MONEY_FIELDS)
+                + (str(summary.savings_percentage), ','.join(sorted(cfops or [])), datetime.now().isoformat())
+            )
+            self.conn.execute(
+                f'INSERT INTO month_summaries VALUES ({", ".join("?" * len(summary_row))})', summary_row
+            )
+            batch = []
+            for row in rows():
+                batch.append(row)
+                if len(batch) >= self.BATCH_SIZE:
+                    self.conn.executemany(insert_result, batch)
+                    batch = []
+            if batch:
+                self.conn.executemany(insert_result, batch)
+        
+        return len(results)
+
+    def list_companies(self) -> List[Tuple[str, str]]:
+        cursor = self.conn.execute(
+            'SELECT cnpj, MAX(company_name) FROM month_summaries GROUP BY cnpj ORDER BY cnpj'
+        )
+        return [(row[0], row[1] or '') for row in cursor]
+
+    def list_summaries(self, cnpj: Optional[str] = None) -> List[Tuple[str, MonthSummary]]:
+        sql = ('SELECT cnpj, month, year, month_name, total_records, total_calculated, total_skipped, '
+               f'{", ".join(self.SUMMARY_MONEY_FIELDS)}, savings_percentage FROM month_summaries')
+        params: List = []
+        if cnpj:
+            sql += ' WHERE cnpj = ?'
+            params.append(cnpj)
+        sql += ' ORDER BY cnpj, period'
+        
+        summaries = []
+        for row in self.conn.execute(sql, params):
+            money = [from_centavos(v) for v in row[7:7 + len(self.SUMMARY_MONEY_FIELDS)]]
+            summaries.append((row[0], MonthSummary(row[1], row[2], row[3], row[4], row[5], row[6],
+                                                   *money, Decimal(row[-1]))))
+        return summaries
+
+    def _where(self, cnpj: Optional[str], year: Optional[str], month: Optional[str],
+               ncm: Optional[str], cod_item: Optional[str], cfop: Optional[str]) -> Tuple[str, List]:
+        clauses = []
+        params: List = []
+        if cnpj:
+            clauses.append('cnpj = ?')
+            params.append(cnpj)
+        if year and month:
+            clauses.append('period = ?')
+            params.append(f'{year}-{month}')
+        elif year:
+            clauses.append('period BETWEEN ? AND ?')
+            params.extend([f'{year}-01', f'{year}-12'])
+        elif month:
+            # Mesmo mês em todos os anos gravados (period = AAAA-MM)
+            clauses.append('substr(period, 6, 2) = ?')
+            params.append(month)
+        if ncm:
+            clauses.append('ncm = ?')
+            params.append(ncm)
+        if cod_item:
+            clauses.append('cod_item = ?')
+            params.append(cod_item)
+        if cfop:
+            clauses.append('cfop = ?')
+            params.append(cfop)
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+    def credit_totals(self, cnpj: Optional[str] = None, year: Optional[str] = None,
+                      month: Optional[str] = None, ncm: Optional[str] = None,
+                      cod_item: Optional[str] = None, cfop: Optional[str] = None) -> List[Dict]:
+        """Créditos por CNPJ e período para os filtros informados"""
+        where, params = self._where(cnpj, year, month, ncm, cod_item, cfop)
+        sql = (
+            'SELECT cnpj, period, COUNT(*), SUM(status = \'calculated\'), '
+            'SUM(vl_pis_orig - vl_pis_new), SUM(vl_cofins_orig - vl_cofins_new), SUM(economia_total) '
+            f'FROM results{where} GROUP BY cnpj, period ORDER BY cnpj, period'
+        )
+        return [
+            {
+                'cnpj': row[0],
+                'periodo': row[1],
+                'registros': row[2],
+                'calculados': row[3] or 0,
+                'credito_pis': from_centavos(row[4]),
+                'credito_cofins': from_centavos(row[5]),
+                'credito_total': from_centavos(row[6]),
+            }
+            for row in self.conn.execute(sql, params)
+        ]
+
+    def query_results(self, cnpj: Optional[str] = None, year: Optional[str] = None,
+                      month: Optional[str] = None, ncm: Optional[str] = None,
+                      cod_item: Optional[str] = None, cfop: Optional[str] = None,
+                      limit: int = 1000) -> List[Dict]:
+        """Linhas gravadas para os filtros informados"""
+        where, params = self._where(cnpj, year, month, ncm, cod_item, cfop)
+        columns = (['cnpj', 'period', 'line_number', 'cod_item', 'ncm', 'cfop', 'status',
+                    'skip_reason', 'mva', 'aliq_icms'] + self.RESULT_MONEY_FIELDS)
+        sql = (f'SELECT {", ".join(columns)} FROM results{where} '
+               'ORDER BY cnpj, period, line_number LIMIT ?')
+        rows = []
+        for row in self.conn.execute(sql, params + [limit]):
+            record = dict(zip(columns, row))
+            for name in self.RESULT_MONEY_FIELDS:
+                record[name] = from_centavos(record[name])
+            rows.append(record)
+        return rows
+
+
+# =============================================================================
+# PIPELINE DE PROCESSAMENTO
+# =============================================================================
+
+# Bytes lidos do início de cada upload para localizar o registro 0000
+HEADER_PEEK_BYTES = 4096
+
+
+class SpedSource:
+    """Um SPED do lote: upload direto ou membro de um arquivo ZIP/GZIP.
+
+    O conteúdo vem de ``data`` (bytes do upload) ou de ``path`` (upload gravado
+    em disco, para ser lido pelos processos do pool). ``open`` devolve sempre
+    um stream binário novo; membros compactados são descompactados sob
+    demanda, sem gerar uma cópia do conteúdo completo.
+    """
+    
+    def __init__(self, name: str, data: Optional[bytes] = None, path: Optional[str] = None,
+                 member: Optional[str] = None, compression: Optional[str] = None,
+                 size: Optional[int] = None, origin: str = ''):
+        self.name = name
+        self.data = data
+        self.path = path
+        self.member = member
+        self.compression = compression
+        self.size = size
+        self.origin = origin or name
+        self._content_hash: Optional[str] = None
+    
+    def open(self) -> BinaryIO:
+        if self.compression == 'zip':
+            archive = zipfile.ZipFile(self.path if self.path else io.BytesIO(self.data))
+            stream = archive.open(self.member)
+            # O membro mantém o arquivo subjacente aberto até ser fechado
+            archive.close()
+            return stream
+        if self.compression == 'gz':
+            return gzip.open(self.path, 'rb') if self.path else gzip.GzipFile(fileobj=io.BytesIO(self.data))
+        return open(self.path, 'rb') if self.path else io.BytesIO(self.data)
+    
+    def read_head(self, size: int = HEADER_PEEK_BYTES) -> bytes:
+        with self.open() as stream:
+            return stream.read(size)
+    
+    def content_hash(self) -> str:
+        """SHA-256 do conteúdo (descompactado), lido uma única vez por fonte"""
+        if self._content_hash is None:
+            with self.open() as stream:
+                self._content_hash = hash_stream(stream)
+        return self._content_hash
+    
+    def to_spec(self) -> Dict:
+        """Descrição serializável (só tipos nativos) para envio a outro processo"""
+        if self.path is None:
+            raise ValueError(f'{self.name}: fonte sem arquivo em disco não pode ser enviada a outro processo')
+        return {'name': self.name, 'path': self.path, 'member': self.member,
+                'compression': self.compression, 'size': self.size, 'origin': self.origin}
+    
+    @classmethod
+    def from_spec(cls, spec: Dict) -> 'SpedSource':
+        return cls(**spec)
+
+
+def expand_uploads(files: List, spool_dir: Optional[str] = None) -> List[SpedSource]:
+    """Converte os uploads (.txt, .zip com vários SPEDs ou .gz) em fontes de leitura.
+
+    As fontes leem os bytes do upload sem copiá-los; com ``spool_dir`` os
+    uploads são gravados em disco (``spool_sources``).
+    """
+    sources: List[SpedSource] = []
+    
+    for file_obj in files:
+        # getvalue() de um BytesIO não copia o buffer; cada abertura ganha sua própria posição
+        data = file_obj.getvalue()
+        lower_name = file_obj.name.lower()
+        
+        if lower_name.endswith('.zip'):
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                members = archive.infolist()
+            for info in members:
+                if info.is_dir() or info.filename.startswith('__MACOSX/'):
+                    continue
+                sources.append(SpedSource(
+                    name=Path(info.filename).name,
+                    data=data,
+                    member=info.filename,
+                    compression='zip',
+                    size=info.file_size,
+                    origin=file_obj.name
+                ))
+        elif lower_name.endswith('.gz'):
+            # Tamanho descompactado fica nos 4 últimos bytes do GZIP (módulo 2^32)
+            size = int.from_bytes(data[-4:], 'little') if len(data) >= 4 else None
+            sources.append(SpedSource(
+                name=file_obj.name[:-3],
+                data=data,
+                compression='gz',
+                size=size,
+                origin=file_obj.name
+            ))
+        else:
+            sources.append(SpedSource(
+                name=file_obj.name,
+                data=data,
+                size=len(data)
+            ))
+    
+    if spool_dir:
+        spool_sources(sources, spool_dir)
+    return sources
+
+
+def spool_sources(sources: List[SpedSource], spool_dir: str) -> None:
+    """Grava em disco os uploads das fontes, para serem lidos por outros processos.
+
+    Cada upload é gravado uma única vez, mesmo quando é um ZIP com vários
+    SPEDs; as fontes passam a apontar para o arquivo e soltam os bytes.
+    """
+    paths: Dict[int, str] = {}
+    for source in sources:
+        if source.data is None:
+            continue
+        path = paths.get(id(source.data))
+        if path is None:
+            path = str(Path(spool_dir) / f'{len(paths):04d}_{Path(source.origin).name}')
+            with open(path, 'wb') as f:
+                f.write(source.data)
+            paths[id(source.data)] = path
+        source.path = path
+        source.data = None
+
+
+@dataclass
+class BatchEntry:
+    file: object
+    name: str
+    header: Optional[SpedHeader]
+    month: str
+    year: str
+    reason: str = ''
+
+
+def peek_sped_header(head: bytes) -> Optional[SpedHeader]:
+    """Lê o registro 0000 a partir dos primeiros bytes de um SPED"""
+    for raw_line in head.split(b'\n'):
+        line = raw_line.strip().lstrip(b'\xef\xbb\xbf')
+        if not line:
+            continue
+        fields = SpedParser.text_fields(line)
+        if fields[0] == '0000':
+            return SpedParser().parse_header(fields)
+        return None
+    return None
+
+
+def build_batch_index(sources: List[SpedSource]) -> Tuple[List[BatchEntry], List[BatchEntry]]:
+    """Ordena o lote pelo período real do 0000 e separa arquivos rejeitados.
+
+    Sem cabeçalho 0000 o arquivo é rejeitado. Quando há mais de um arquivo do
+    mesmo CNPJ/período, prevalece a retificadora (TIPO_ESCRIT = 1) e, entre
+    arquivos do mesmo tipo, o último enviado. Arquivos de CNPJ diferente do
+    predominante no lote também são rejeitados.
+    """
+    accepted: Dict[Tuple[str, str, str], BatchEntry] = {}
+    rejected: List[BatchEntry] = []
+    
+    for source in sources:
+        header = peek_sped_header(source.read_head())
+        month, year = extract_month_year(source.name, header)
+        entry = BatchEntry(file=source, name=source.name, header=header, month=month, year=year)
+        
+        if header is None:
+            entry.reason = 'Registro 0000 não encontrado no início do arquivo'
+            rejected.append(entry)
+            continue
+        
+        key = (header.cnpj, year, month)
+        previous = accepted.get(key)
+        if previous is not None:
+            # Retificadora prevalece sobre original; mesmo tipo: último enviado
+            if previous.header.tipo_escrit == '1' and header.tipo_escrit != '1':
+                entry.reason = f'Período {month}/{year} duplicado: mantido {previous.name} (retificadora)'
+                rejected.append(entry)
+                continue
+            previous.reason = f'Período {month}/{year} duplicado: substituído por {entry.name}'
+            rejected.append(previous)
+        accepted[key] = entry
+    
+    cnpj_counts: Dict[str, int] = {}
+    for entry in accepted.values():
+        cnpj_counts[entry.header.cnpj] = cnpj_counts.get(entry.header.cnpj, 0) + 1
+    main_cnpj = max(cnpj_counts, key=cnpj_counts.get) if cnpj_counts else ''
+    
+    ordered = []
+    for entry in sorted(accepted.values(), key=lambda e: (e.year, e.month, e.name)):
+        if entry.header.cnpj != main_cnpj:
+            entry.reason = f'CNPJ {entry.header.cnpj} diferente do lote ({main_cnpj})'
+            rejected.append(entry)
+            continue
+        ordered.append(entry)
+    
+    return ordered, rejected
+
+
+@dataclass
+class ProcessedMonth:
+    source_name: str
+    month: str
+    year: str
+    month_name: str
+    header: Optional[SpedHeader]
+    summary: MonthSummary
+    results: List[CalculationResult]
+    sped_output: bytes
+    resumed: bool = False
+    scenario_summaries: Dict[str, MonthSummary] = field(default_factory=dict)
+    # Duração de cada etapa (leitura, cálculo, escrita) e consultas ao memo (acertos, falhas), para as métricas
+    stage_seconds: Dict[str, float] = field(default_factory=dict)
+    memo_lookups: Tuple[int, int] = (0, 0)
+
+    @property
+    def sheet_name(self) -> str:
+        return month_sheet_name(self.month_name, self.year)
+
+    @property
+    def sped_filename(self) -> str:
+        return f'SPED_RETIFICADO_{self.month}_{self.year}.txt'
+
+
+def summarize_month(month: str, year: str, month_name: str, results: List[CalculationResult]) -> MonthSummary:
+    """Consolida os resultados de um mês"""
+    calculated = [r for r in results if r.status == 'calculated']
+    
+    return summarize_totals(
+        month, year, month_name, len(results), len(calculated),
+        sum(r.vl_pis_orig for r in calculated), sum(r.vl_pis_new for r in calculated),
+        sum(r.vl_cofins_orig for r in calculated), sum(r.vl_cofins_new for r in calculated)
+    )
+
+
+def summarize_totals(month: str, year: str, month_name: str, total_records: int, total_calculated: int,
+                     pis_orig: Decimal, pis_new: Decimal, cofins_orig: Decimal, cofins_new: Decimal) -> MonthSummary:
+    """Monta o resumo do mês a partir dos totais já somados"""
+    pis_credit = pis_orig - pis_new
+    cofins_credit = cofins_orig - cofins_new
+    total_credit = pis_credit + cofins_credit
+    
+    total_original = pis_orig + cofins_orig
+    savings_pct = (total_credit / total_original * 100) if total_original > 0 else Decimal('0')
+    
+    return MonthSummary(
+        month=month,
+        year=year,
+        month_name=month_name,
+        total_records=total_records,
+        total_calculated=total_calculated,
+        total_skipped=total_records - total_calculated,
+        pis_original=pis_orig,
+        pis_adjusted=pis_new,
+        pis_credit=pis_credit,
+        cofins_original=cofins_orig,
+        cofins_adjusted=cofins_new,
+        cofins_credit=cofins_credit,
+        total_credit=total_credit,
+        savings_percentage=savings_pct.quantize(Decimal('0.01'), ROUND_HALF_UP) if isinstance(savings_pct, Decimal) else Decimal('0')
+    )
+
+
+class FileProgress:
+    """Progresso de um arquivo, alimentado pela leitura e pelo cálculo.
+
+    O parser informa bytes e linhas lidos e o cálculo informa registros de
+    receita processados, a cada ``REPORT_EVERY`` linhas. A fração do arquivo pondera
+    as duas fases (``PARSE_WEIGHT`` para a leitura). O ``callback`` recebe um
+    snapshot (dict só com tipos nativos, serializável em JSON) no máximo a
+    cada ``min_interval`` segundos e sempre ao final; não depende do
+    Streamlit, então serve à interface, ao pool e aos workers do spool.
+    """
+
+    REPORT_EVERY = 4096
+    PARSE_WEIGHT = 0.4
+
+    def __init__(self, name: str, size: Optional[int], callback: Optional[Callable[[Dict], None]] = None,
+                 min_interval: float = 0.5):
+        self.name = name
+        self.size = size or 0
+        self.callback = callback
+        self.min_interval = min_interval
+        self.started_at = time.monotonic()
+        self.phase = 'leitura'
+        self.phase_started_at = self.started_at
+        self.phase_lines = 0
+        self.fraction = 0.0
+        self._last_emit = 0.0
+
+    def on_parse(self, bytes_read: int, lines_read: int) -> None:
+        self.phase_lines = lines_read
+        if self.size:
+            self.fraction = self.PARSE_WEIGHT * min(1.0, bytes_read / self.size)
+        self._maybe_emit()
+
+    def on_calc(self, records_done: int, records_total: int) -> None:
+        if self.phase != 'cálculo':
+            self.phase = 'cálculo'
+            self.phase_started_at = time.monotonic()
+        self.phase_lines = records_done
+        if records_total:
+            self.fraction = self.PARSE_WEIGHT + (1 - self.PARSE_WEIGHT) * min(1.0, records_done / records_total)
+        self._maybe_emit()
+
+    def finish(self) -> None:
+        self.phase = 'concluído'
+        self.fraction = 1.0
+        self._maybe_emit(force=True)
+
+    def snapshot(self) -> Dict:
+        now = time.monotonic()
+        elapsed = now - self.started_at
+        phase_elapsed = now - self.phase_started_at
+        return {
+            'name': self.name,
+            'size': self.size,
+            'phase': self.phase,
+            'fraction': self.fraction,
+            'elapsed': elapsed,
+            'lines_per_second': self.phase_lines / phase_elapsed if phase_elapsed > 0 else 0.0,
+            'mb_per_second': self.fraction * self.size / 2**20 / elapsed if elapsed > 0 else 0.0,
+            'eta': elapsed / self.fraction * (1 - self.fraction) if self.fraction > 0 else None,
+        }
+
+    def _maybe_emit(self, force: bool = False) -> None:
+        if self.callback is None:
+            return
+        now = time.monotonic()
+        if force or now - self._last_emit >= self.min_interval:
+            self._last_emit = now
+            self.callback(self.snapshot())
+
+
+class BatchProgress:
+    """Progresso do lote: frações dos arquivos ponderadas pelo tamanho"""
+
+    def __init__(self, sizes: Dict[int, int]):
+        # Arquivo sem tamanho conhecido conta como 1 byte, só para entrar na média
+        self.sizes = {key: size or 1 for key, size in sizes.items()}
+        self.total = sum(self.sizes.values()) or 1
+        self.fractions = {key: 0.0 for key in sizes}
+        self.skipped_bytes = 0
+        self.started_at = time.monotonic()
+
+    def update(self, key: int, fraction: float) -> None:
+        self.fractions[key] = fraction
+
+    def skip(self, key: int) -> None:
+        """Arquivo concluído sem processamento (checkpoint): não entra na vazão nem no ETA"""
+        if self.fractions[key] < 1.0:
+            self.fractions[key] = 1.0
+            self.skipped_bytes += self.sizes[key]
+
+    def snapshot(self) -> Dict:
+        done_bytes = sum(self.sizes[key] * fraction for key, fraction in self.fractions.items())
+        worked_bytes = done_bytes - self.skipped_bytes
+        remaining_bytes = self.total - done_bytes
+        elapsed = time.monotonic() - self.started_at
+        bytes_per_second = worked_bytes / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if remaining_bytes <= 0:
+            eta = 0.0
+        elif bytes_per_second > 0:
+            eta = remaining_bytes / bytes_per_second
+        return {
+            'fraction': done_bytes / self.total,
+            'elapsed': elapsed,
+            'mb_per_second': bytes_per_second / 2**20,
+            'eta': eta,
+        }
+
+
+def format_duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return '--:--'
+    minutes, secs = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02d}:{secs:02d}' if hours else f'{minutes}:{secs:02d}'
+
+
+def format_file_progress(label: str, snapshot: Dict) -> str:
+    """Linha de status de um arquivo, usada na interface e nos workers"""
+    return (f"{label} — {snapshot['phase']} {snapshot['fraction']:.0%} · "
+            f"{snapshot['lines_per_second']:,.0f} linhas/s · {snapshot['mb_per_second']:.1f} MB/s · "
+            f"ETA {format_duration(snapshot['eta'])}")
+
+
+def write_progress_file(path: str, snapshot: Dict) -> None:
+    """Callback de progresso para outro processo: grava o snapshot de forma atômica"""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, path)
+
+
+def read_progress_file(path: str) -> Optional[Dict]:
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def rule_context(header: Optional[SpedHeader], month: str, year: str) -> Tuple[Optional[str], Optional[str]]:
+    """(UF, data 'AAAA-MM-DD') usados para escolher as regras da base para um SPED"""
+    uf = header.uf.strip().upper() if header and header.uf else None
+    if header and len(header.dt_ini) >= 8 and header.dt_ini[:8].isdigit():
+        dt_ini = header.dt_ini
+        return uf, f'{dt_ini[4:8]}-{dt_ini[2:4]}-{dt_ini[:2]}'
+    if month.isdigit() and year.isdigit() and month != '00':
+        return uf, f'{year}-{month}-01'
+    return uf, None
+
+
+def process_sped_source(source: SpedSource, calculator: IcmsStCalculator,
+                        rollups: Optional[RollupAccumulator] = None,
+                        parquet_exporter: Optional[ParquetResultExporter] = None,
+                        fallback_cnpj: str = '',
+                        scenarios: Optional[ScenarioEvaluator] = None,
+                        progress: Optional[FileProgress] = None) -> ProcessedMonth:
+    """Processa um SPED completo: parse, cálculo, resumo e SPED retificado"""
+    # Parse SPED (membros compactados são lidos descompactando sob demanda)
+    started = time.perf_counter()
+    memo_before = calculator.memo_stats()
+    parser = SpedParser(calculator.registers)
+    with source.open() as stream:
+        parser.load_stream(stream, progress.on_parse if progress else None, FileProgress.REPORT_EVERY)
+    
+    # Extrair mês/ano do header do SPED (mais confiável que o nome do arquivo)
+    month, year = extract_month_year(source.name, parser.header)
+    month_name = MONTH_NAMES.get(month, month)
+    uf, valid_on = rule_context(parser.header, month, year)
+    calculator.set_context(uf, valid_on)
+    if scenarios:
+        scenarios.set_context(uf, valid_on)
+    
+    if parquet_exporter:
+        parquet_exporter.open_partition(parser.header.cnpj if parser.header else fallback_cnpj, year, month)
+    
+    # Calcular (agregações por NCM/item/CFOP acumuladas na mesma passada)
+    parsed = time.perf_counter()
+    period = f'{month}/{year}'
+    results: List[CalculationResult] = []
+    if scenarios:
+        scenarios.start_month()
+    for record in parser.get_records():
+        ncm = parser.get_ncm_for_item(record.cod_item)
+        result = calculator.calculate(record, ncm)
+        results.append(result)
+        if rollups is not None:
+            rollups.add(result, period)
+        if parquet_exporter:
+            parquet_exporter.add(result)
+        if scenarios:
+            scenarios.add(record, ncm)
+        if progress and len(results) % FileProgress.REPORT_EVERY == 0:
+            progress.on_calc(len(results), parser.record_count)
+    
+    summary = summarize_month(month, year, month_name, results)
+    
+    # Gerar SPED retificado
+    calculated = time.perf_counter()
+    writer = SpedWriter(parser, results)
+    with source.open() as stream:
+        sped_output = writer.generate(stream)
+    if progress:
+        progress.finish()
+    memo_after = calculator.memo_stats()
+    
+    return ProcessedMonth(
+        source_name=source.name,
+        month=month,
+        year=year,
+        month_name=month_name,
+        header=parser.header,
+        summary=summary,
+        results=results,
+        sped_output=sped_output,
+        scenario_summaries=scenarios.month_summaries(month, year, month_name) if scenarios else {},
+        stage_seconds={'leitura': parsed - started, 'calculo': calculated - parsed,
+                       'escrita': time.perf_counter() - calculated},
+        memo_lookups=(memo_after.get('hits', 0) - memo_before.get('hits', 0),
+                      memo_after.get('misses', 0) - memo_before.get('misses', 0))
+    )
+
+
+def replay_month(processed: ProcessedMonth, rollups: Optional[RollupAccumulator] = None,
+                 parquet_exporter: Optional[ParquetResultExporter] = None,
+                 fallback_cnpj: str = '') -> None:
+    """Alimenta agregações e exportações com um mês recuperado de checkpoint"""
+    period = f'{processed.month}/{processed.year}'
+    if parquet_exporter:
+        parquet_exporter.open_partition(processed.header.cnpj if processed.header else fallback_cnpj,
+                                        processed.year, processed.month)
+    for result in processed.results:
+        if rollups is not None:
+            rollups.add(result, period)
+        if parquet_exporter:
+            parquet_exporter.add(result)
+
+
+def read_source_lines(source: SpedSource, line_numbers: set) -> Dict[int, bytes]:
+    """Relê do arquivo original apenas as linhas pedidas, cruas e com o terminador"""
+    lines: Dict[int, bytes] = {}
+    last_line = max(line_numbers) if line_numbers else 0
+    with source.open() as stream:
+        for line_number, raw_line in enumerate(stream, 1):
+            if line_number in line_numbers:
+                lines[line_number] = raw_line
+            if line_number >= last_line:
+                break
+    return lines
+
+
+class IncrementalBatch:
+    """Lote já processado, mantido para aplicar correções da base de produtos.
+
+    Ao receber uma nova base, compara as regras (MVA, MVA ajustada, alíquota,
+    UF e vigência) de cada NCM ou prefixo com a base anterior e recalcula só
+    as linhas dos NCMs cobertos pelas regras alteradas,
+    localizadas por um índice NCM -> posições em ``results`` montado sob
+    demanda por mês. As linhas originais são relidas dos arquivos do lote;
+    resultados, resumo do mês, cenários e SPED retificado são corrigidos no
+    lugar, com o mesmo resultado de um processamento completo.
+    """
+
+    def __init__(self, signature: tuple, months: List[ProcessedMonth], products_by_ncm: Dict[str, List[Dict]],
+                 cfops: set, scenarios: List[Scenario]):
+        self.signature = signature
+        self.months = months
+        self.products_by_ncm = products_by_ncm
+        self.cfops = cfops
+        self.scenarios = scenarios
+        self._indexes: Dict[int, Dict[str, List[int]]] = {}
+
+    @staticmethod
+    def changed_ncms(old: Dict[str, List[Dict]], new: Dict[str, List[Dict]]) -> set:
+        """NCMs e prefixos cujas regras mudaram"""
+        return {ncm for ncm in old.keys() | new.keys() if old.get(ncm) != new.get(ncm)}
+
+    def _index(self, month_idx: int) -> Dict[str, List[int]]:
+        index = self._indexes.get(month_idx)
+        if index is None:
+            index = {}
+            for position, result in enumerate(self.months[month_idx].results):
+                if result.ncm:
+                    index.setdefault(result.ncm, []).append(position)
+            self._indexes[month_idx] = index
+        return index
+
+    def apply_product_base(self, product_base: ProductBaseLoader,
+                           sources: List[SpedSource]) -> Tuple[int, int, int]:
+        """Aplica a nova base; devolve (NCMs alterados, linhas recalculadas, meses alterados)"""
+        changed = self.changed_ncms(self.products_by_ncm, product_base.products_by_ncm)
+        old_base = ProductBaseLoader()
+        old_base.products_by_ncm = self.products_by_ncm
+        calculator = IcmsStCalculator(product_base, self.cfops)
+        old_scenarios = ScenarioEvaluator(self.scenarios, old_base, self.cfops) if self.scenarios else None
+        new_scenarios = ScenarioEvaluator(self.scenarios, product_base, self.cfops) if self.scenarios else None
+        parser = SpedParser()
+
+        lines_recomputed = 0
+        months_changed = 0
+        for month_idx, (processed, source) in enumerate(zip(self.months, sources)):
+            index = self._index(month_idx)
+            positions = [p for ncm, ncm_positions in index.items()
+                         if any(ncm[:length] in changed for length in range(2, len(ncm) + 1))
+                         for p in ncm_positions]
+            if not positions:
+                continue
+            positions.sort()
+            uf, valid_on = rule_context(processed.header, processed.month, processed.year)
+            calculator.set_context(uf, valid_on)
+            if new_scenarios:
+                old_scenarios.set_context(uf, valid_on)
+                new_scenarios.set_context(uf, valid_on)
+
+            results = processed.results
+            original_lines = read_source_lines(source, {results[p].line_number for p in positions})
+            output_lines = io.BytesIO(processed.sped_output).readlines()
+            summary = processed.summary
+            totals = [summary.total_calculated, summary.pis_original, summary.pis_adjusted,
+                      summary.cofins_original, summary.cofins_adjusted]
+            if new_scenarios:
+                old_scenarios.start_month()
+                new_scenarios.start_month()
+
+            for position in positions:
+                old_result = results[position]
+                record = parser.parse_record_line(old_result.line_number, original_lines[old_result.line_number],
+                                                  old_result.cod_item)
+                new_result = calculator.calculate(record, old_result.ncm)
+                for result, sign in ((old_result, -1), (new_result, 1)):
+                    if result.status == 'calculated':
+                        totals[0] += sign
+                        totals[1] += sign * result.vl_pis_orig
+                        totals[2] += sign * result.vl_pis_new
+                        totals[3] += sign * result.vl_cofins_orig
+                        totals[4] += sign * result.vl_cofins_new
+                results[position] = new_result
+                line = original_lines[old_result.line_number]
+                output_lines[old_result.line_number - 1] = (
+                    SpedWriter.rewrite_line(line, new_result) if new_result.status == 'calculated' else line
+                )
+                if new_scenarios:
+                    old_scenarios.add(record, old_result.ncm)
+                    new_scenarios.add(record, old_result.ncm)
+
+            processed.summary = summarize_totals(processed.month, processed.year, processed.month_name,
+                                                 summary.total_records, *totals)
+            processed.sped_output = b''.join(output_lines)
+            if new_scenarios:
+                for name, old_totals, new_totals in zip(processed.scenario_summaries, old_scenarios.totals,
+                                                        new_scenarios.totals):
+                    current = processed.scenario_summaries[name]
+                    deltas = [new - old for old, new in zip(old_totals, new_totals)]
+                    processed.scenario_summaries[name] = summarize_totals(
+                        processed.month, processed.year, processed.month_name, current.total_records,
+                        current.total_calculated + deltas[1],
+                        current.pis_original + deltas[2], current.pis_adjusted + deltas[3],
+                        current.cofins_original + deltas[4], current.cofins_adjusted + deltas[5]
+                    )
+            lines_recomputed += len(positions)
+            months_changed += 1
+
+        self.products_by_ncm = product_base.products_by_ncm
+        return len(changed), lines_recomputed, months_changed
+
+
+DEFAULT_CHECKPOINT_DIR = 'data/checkpoints'
+
+
+def get_checkpoint_dir() -> str:
+    """Diretório de checkpoints (configurável em secrets.toml)"""
+    try:
+        return st.secrets.get("storage", {}).get("checkpoint_dir", DEFAULT_CHECKPOINT_DIR)
+    except Exception:
+        return DEFAULT_CHECKPOINT_DIR
+
+
+def hash_stream(stream: BinaryIO, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Formato serializado de ProcessedMonth (checkpoints, spool e retorno dos processos do pool)
+PROCESSED_MONTH_FORMAT = 4
+
+# Conversores de cada campo de CalculationResult e MonthSummary a partir do texto serializado
+RESULT_DECODERS = [
+    int if f.type is int else Decimal if f.type is Decimal else (lambda v: v or None) if f.name == 'skip_reason' else str
+    for f in dataclass_fields(CalculationResult)
+]
+SUMMARY_DECODERS = [
+    int if f.type is int else Decimal if f.type is Decimal else str
+    for f in dataclass_fields(MonthSummary)
+]
+
+
+def encode_summary(summary: MonthSummary) -> str:
+    return '|'.join(str(v) for v in astuple(summary))
+
+
+def decode_summary(text: str) -> MonthSummary:
+    return MonthSummary(*[decode(v) for decode, v in zip(SUMMARY_DECODERS, text.split('|'))])
+
+
+def encode_processed_month(processed: ProcessedMonth) -> Dict:
+    """Serializa um mês processado só com tipos do JSON (números e Decimal viram texto)"""
+    return {
+        'version': PROCESSED_MONTH_FORMAT,
+        'source_name': processed.source_name,
+        'month': processed.month,
+        'year': processed.year,
+        'month_name': processed.month_name,
+        'header': astuple(processed.header) if processed.header else None,
+        'summary': encode_summary(processed.summary),
+        # Uma string por linha: bem mais compacta e rápida de serializar que objetos Decimal
+        'results': ['|'.join('' if v is None else str(v) for v in vars(r).values())
+                    for r in processed.results],
+        # latin-1 leva cada byte a um caractere e volta sem perdas
+        'sped_output': processed.sped_output.decode('latin-1'),
+        'scenarios': {name: encode_summary(summary) for name, summary in processed.scenario_summaries.items()},
+        'stage_seconds': processed.stage_seconds,
+        'memo_lookups': processed.memo_lookups,
+    }
+
+
+def decode_processed_month(payload: Dict, resumed: bool = False) -> ProcessedMonth:
+    if payload.get('version') != PROCESSED_MONTH_FORMAT:
+        raise ValueError(f"Formato de mês processado incompatível: {payload.get('version')}")
+    return ProcessedMonth(
+        source_name=payload['source_name'],
+        month=payload['month'],
+        year=payload['year'],
+        month_name=payload['month_name'],
+        header=SpedHeader(*payload['header']) if payload['header'] else None,
+        summary=decode_summary(payload['summary']),
+        results=[
+            CalculationResult(*[decode(v) for decode, v in zip(RESULT_DECODERS, row.split('|'))])
+            for row in payload['results']
+        ],
+        sped_output=payload['sped_output'].encode('latin-1'),
+        resumed=resumed,
+        scenario_summaries={name: decode_summary(text) for name, text in payload['scenarios'].items()},
+        stage_seconds=payload['stage_seconds'],
+        memo_lookups=tuple(payload['memo_lookups'])
+    )
+
+
+def dump_processed_month(processed: ProcessedMonth) -> bytes:
+    """Mês processado em JSON compactado, para gravar em disco (checkpoints e spool)"""
+    return gzip.compress(json.dumps(encode_processed_month(processed), separators=(',', ':')).encode('utf-8'),
+                         compresslevel=1)
+
+
+def load_processed_month(data: bytes, resumed: bool = False) -> ProcessedMonth:
+    return decode_processed_month(json.loads(gzip.decompress(data)), resumed=resumed)
+
+
+class BatchCheckpoint:
+    """Checkpoints por arquivo para retomar lotes interrompidos.
+
+    Cada mês concluído é gravado em ``<work_dir>/<chave>.ckpt``, onde a chave
+    combina o hash do conteúdo do SPED com o hash da configuração (CFOPs e
+    base de produtos). Um lote reiniciado reaproveita os meses cuja entrada e
+    configuração não mudaram. Os arquivos são JSON compactado
+    (``dump_processed_month``): ler um checkpoint nunca executa código.
+    """
+
+    MAX_AGE_DAYS = 7
+
+    def __init__(self, work_dir: str, config_hash: str):
+        self.work_dir = Path(work_dir)
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        self.config_hash = config_hash
+
+    @staticmethod
+    def config_fingerprint(product_base: ProductBaseLoader, cfops: set,
+                           scenarios: Optional[List[Scenario]] = None,
+                           registers: Tuple[str, ...] = DEFAULT_REGISTERS) -> str:
+        digest = hashlib.sha256()
+        digest.update(','.join(sorted(cfops)).encode())
+        if tuple(registers) != DEFAULT_REGISTERS:
+            # Só C870 mantém o mesmo fingerprint (e os checkpoints) de antes da escolha de registros
+            digest.update(f"@{','.join(sorted(registers))}".encode())
+        for scenario in scenarios or []:
+            cfops_key = ','.join(sorted(scenario.cfops)) if scenario.cfops is not None else '*'
+            digest.update(f"#{scenario.name}:{scenario.use_mva_adjusted}:{scenario.aliq_icms}:{cfops_key}".encode())
+        for ncm in sorted(product_base.products_by_ncm):
+            for product in product_base.products_by_ncm[ncm]:
+                digest.update(f"|{ncm}:{product['mva']}:{product.get('mva_adjusted')}:{product['aliq_icms']}"
+                              f":{product['uf']}:{product['valid_from']}:{product['valid_to']}".encode())
+        return digest.hexdigest()
+
+    def key_for(self, source: SpedSource) -> str:
+        return hashlib.sha256(
+            f'{PROCESSED_MONTH_FORMAT}:{source.content_hash()}:{self.config_hash}'.encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.work_dir / f'{key}.ckpt'
+
+    def save(self, key: str, processed: ProcessedMonth) -> None:
+        # Gravação atômica: um checkpoint parcial nunca é lido
+        tmp_path = self._path(key).with_suffix('.tmp')
+        tmp_path.write_bytes(dump_processed_month(processed))
+        os.replace(tmp_path, self._path(key))
+
+    def load(self, key: str) -> Optional[ProcessedMonth]:
+        path = self._path(key)
+        if not path.exists():
+            return None
+        try:
+            return load_processed_month(path.read_bytes(), resumed=True)
+        except Exception:
+            # Checkpoint corrompido ou de versão incompatível: reprocessa o mês
+            return None
+
+    def prune(self, max_age_days: int = MAX_AGE_DAYS) -> int:
+        """Remove checkpoints antigos; devolve quantos foram apagados"""
+        cutoff = datetime.now().timestamp() - max_age_days * 86400
+        removed = 0
+        for path in self.work_dir.glob('*.ckpt'):
+            if path.stat().st_mtime < cutoff:
+                path.unlink(missing_ok=True)
+                removed += 1
+        return removed
+
+
+# =============================================================================
+# MÉTRICAS
+# =============================================================================
+
+# Limites dos histogramas: segundos por etapa e bytes por arquivo gerado (64 KB a 1 GB)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = tuple(2**n for n in range(16, 31, 2))
+
+DEFAULT_METRICS_CONFIG = {
+    'port': None,                    # endpoint HTTP local: http://<host>:<port>/metrics
+    'host': '127.0.0.1',
+    'textfile': None,                # arquivo .prom para o textfile collector do node_exporter
+    'textfile_interval_seconds': 15,
+}
+
+
+class MetricsRegistry:
+    """Contadores, gauges e histogramas no formato de texto do Prometheus.
+
+    Alimentado pelo pipeline e lido por ``render``, seja por um endpoint HTTP
+    local (``serve``) ou por um arquivo do textfile collector
+    (``write_textfile``). Gauges com ``callback`` são lidos na hora da coleta.
+    ``const_labels`` identifica o processo quando vários gravam métricas.
+    """
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, const_labels: Optional[Dict[str, str]] = None):
+        self.const_labels = const_labels or {}
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, Dict] = {}
+
+    def counter(self, name: str, help: str) -> None:
+        self._metrics[name] = {'type': 'counter', 'help': help, 'samples': {}}
+
+    def gauge(self, name: str, help: str, callback: Optional[Callable[[], Optional[float]]] = None) -> None:
+        self._metrics[name] = {'type': 'gauge', 'help': help, 'samples': {}, 'callback': callback}
+
+    def histogram(self, name: str, help: str, buckets: Tuple[float, ...]) -> None:
+        self._metrics[name] = {'type': 'histogram', 'help': help, 'samples': {}, 'buckets': tuple(buckets)}
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            samples = self._metrics[name]['samples']
+            samples[key] = samples.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        with self._lock:
+            self._metrics[name]['samples'][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            metric = self._metrics[name]
+            # Contagem acumulada por limite, seguida de total de observações e soma
+            counts = metric['samples'].setdefault(key, [0] * (len(metric['buckets']) + 2))
+            for i, bound in enumerate(metric['buckets']):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    @staticmethod
+    def _format_labels(labels: Dict[str, str]) -> str:
+        if not labels:
+            return ''
+        escaped = (str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for v in labels.values())
+        return '{' + ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + '}'
+
+    @staticmethod
+    def _format_value(value: float) -> str:
+        if isinstance(value, int):
+            return str(value)
+        return '+Inf' if value == float('inf') else repr(float(value))
+
+    def render(self) -> str:
+        with self._lock:
+            snapshot = {name: dict(metric, samples={k: copy(v) for k, v in metric['samples'].items()})
+                        for name, metric in self._metrics.items()}
+        lines = []
+        for name, metric in snapshot.items():
+            if metric.get('callback'):
+                try:
+                    value = metric['callback']()
+                except Exception:
+                    value = None
+                if value is not None:
+                    metric['samples'][()] = value
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for key, value in sorted(metric['samples'].items()):
+                labels = dict(self.const_labels, **dict(key))
+                if metric['type'] != 'histogram':
+                    lines.append(f'{name}{self._format_labels(labels)} {self._format_value(value)}')
+                    continue
+                for bound, count in zip(metric['buckets'] + (float('inf'),), value[:-2] + [value[-2]]):
+                    bucket_labels = self._format_labels(dict(labels, le=self._format_value(float(bound))))
+                    lines.append(f'{name}_bucket{bucket_labels} {count}')
+                lines.append(f'{name}_sum{self._format_labels(labels)} {self._format_value(float(value[-1]))}')
+                lines.append(f'{name}_count{self._format_labels(labels)} {value[-2]}')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path: str) -> None:
+        """Grava as métricas de forma atômica: o collector nunca lê um arquivo pela metade"""
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def write_textfile_every(self, path: str, interval_seconds: float) -> threading.Thread:
+        """Regrava o arquivo periodicamente numa thread daemon (gauges lidos na hora continuam atuais)"""
+        def loop():
+            while True:
+                try:
+                    self.write_textfile(path)
+                except Exception:
+                    # A thread segue viva: a próxima gravação pode dar certo (ex.: disco liberado)
+                    logger.exception('Métricas: falha ao gravar %s', path)
+                time.sleep(interval_seconds)
+
+        thread = threading.Thread(target=loop, name='icmsst-metrics-textfile', daemon=True)
+        thread.start()
+        return thread
+
+    def serve(self, port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+        """Endpoint ``/metrics`` numa thread daemon; por padrão só na interface local"""
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', MetricsRegistry.CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name='icmsst-metrics-http', daemon=True).start()
+        return server
+
+
+def build_metrics(const_labels: Optional[Dict[str, str]] = None) -> MetricsRegistry:
+    """Registro com as métricas alimentadas pelo pipeline (sessões e workers do spool)"""
+    metrics = MetricsRegistry(const_labels)
+    metrics.counter('icmsst_files_processed_total',
+                    'Arquivos SPED concluídos, por origem (calculado, checkpoint, incremental)')
+    metrics.counter('icmsst_records_processed_total', 'Linhas de receita (C870 e demais registros) calculadas')
+    metrics.counter('icmsst_records_calculated_total', 'Linhas com exclusão do ICMS-ST aplicada')
+    metrics.counter('icmsst_credit_reais_total', 'Crédito de PIS/COFINS calculado, em reais')
+    metrics.histogram('icmsst_stage_duration_seconds', 'Duração das etapas de um arquivo (leitura, calculo, escrita)',
+                      LATENCY_BUCKETS)
+    metrics.histogram('icmsst_batch_duration_seconds', 'Duração do processamento de um lote, por estratégia',
+                      LATENCY_BUCKETS)
+    metrics.counter('icmsst_cache_requests_total', 'Consultas aos caches (checkpoint, memo) por resultado (hit, miss)')
+    metrics.histogram('icmsst_artifact_size_bytes', 'Tamanho dos arquivos gerados para download', SIZE_BUCKETS)
+    metrics.histogram('icmsst_artifact_duration_seconds', 'Tempo de geração dos arquivos para download',
+                      LATENCY_BUCKETS)
+    return metrics
+
+
+def record_processed_month(metrics: MetricsRegistry, processed: ProcessedMonth, origin: str) -> None:
+    """Contabiliza um mês concluído; linhas, crédito e latências só quando o mês foi de fato calculado"""
+    metrics.inc('icmsst_files_processed_total', origin=origin)
+    if origin != 'calculado':
+        return
+    metrics.inc('icmsst_records_processed_total', processed.summary.total_records)
+    metrics.inc('icmsst_records_calculated_total', processed.summary.total_calculated)
+    metrics.inc('icmsst_credit_reais_total', float(processed.summary.total_credit))
+    for stage, seconds in processed.stage_seconds.items():
+        metrics.observe('icmsst_stage_duration_seconds', seconds, stage=stage)
+    hits, misses = processed.memo_lookups
+    if hits or misses:
+        metrics.inc('icmsst_cache_requests_total', hits, cache='memo', result='hit')
+        metrics.inc('icmsst_cache_requests_total', misses, cache='memo', result='miss')
+
+
+def active_session_count() -> Optional[int]:
+    """Sessões conectadas ao servidor do Streamlit (None fora dele)"""
+    if not Runtime.exists():
+        return None
+    return Runtime.instance()._session_mgr.num_active_sessions()
+
+
+@st.cache_resource
+def get_metrics() -> MetricsRegistry:
+    """Registro único por processo do servidor, exposto conforme a seção [metrics] do secrets.toml"""
+    config = dict(DEFAULT_METRICS_CONFIG)
+    try:
+        config.update(st.secrets.get("metrics", {}))
+    except Exception:
+        pass
+    metrics = build_metrics()
+    metrics.gauge('icmsst_active_sessions', 'Sessões conectadas ao servidor', callback=active_session_count)
+    if config['port']:
+        try:
+            metrics.serve(int(config['port']), config['host'])
+        except OSError as exc:
+            logger.warning('Métricas: endpoint %s:%s indisponível (%s)', config['host'], config['port'], exc)
+    if config['textfile']:
+        metrics.write_textfile_every(config['textfile'], float(config['textfile_interval_seconds']))
+    return metrics
+
+
+# =============================================================================
+# PERFIL DE EXECUÇÃO
+# =============================================================================
+
+class SamplingProfiler:
+    """Amostrador de pilhas para diagnosticar lotes lentos sem acesso aos dados do cliente.
+
+    Uma thread daemon lê a pilha das threads em captura a cada ``interval``
+    segundos (``sys._current_frames``), sem instrumentar cada chamada como o
+    cProfile. O resultado tem só nomes de funções, arquivos e linhas do código:
+    nenhum valor, registro ou nome de arquivo do lote.
+    """
+
+    INTERVAL_SECONDS = 0.005
+    TOP_N = 40
+
+    def __init__(self, interval: float = INTERVAL_SECONDS):
+        self.interval = interval
+        self.stacks: Dict[str, int] = {}
+        self.samples = 0
+        self.phase_seconds: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        # thread -> [fase, profundidade de aninhamento, frame de origem, início]
+        self._targets: Dict[int, list] = {}
+        self._labels: Dict[object, str] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, phase: str, _root=None) -> None:
+        """Passa a amostrar a thread atual; a pilha é contada a partir de quem chamou"""
+        ident = threading.get_ident()
+        with self._lock:
+            if ident in self._targets:
+                # Captura aninhada (ex.: Excel gerado dentro do ZIP completo): fica na fase externa
+                self._targets[ident][1] += 1
+                return
+            self._targets[ident] = [phase, 1, _root or sys._getframe(1), time.perf_counter()]
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='icmsst-profiler', daemon=True)
+                self._thread.start()
+
+    def stop(self) -> None:
+        ident = threading.get_ident()
+        with self._lock:
+            target = self._targets.get(ident)
+            if target is None:
+                return
+            target[1] -= 1
+            if target[1] == 0:
+                del self._targets[ident]
+                self.phase_seconds[target[0]] = self.phase_seconds.get(target[0], 0) + time.perf_counter() - target[3]
+
+    @contextmanager
+    def capture(self, phase: str):
+        self.start(phase, sys._getframe(2))
+        try:
+            yield self
+        finally:
+            self.stop()
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            name = getattr(code, 'co_qualname', code.co_name)
+            label = self._labels[code] = f'{name} ({Path(code.co_filename).name}:{code.co_firstlineno})'
+        return label
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                if not self._targets:
+                    self._thread = None
+                    return
+                for ident, (phase, _, root, _) in list(self._targets.items()):
+                    frame = frames.get(ident)
+                    if frame is None:
+                        # Thread encerrada sem ``stop`` (ex.: exceção no script)
+                        del self._targets[ident]
+                        continue
+                    names = []
+                    while frame is not None and frame is not root:
+                        names.append(self._label(frame.f_code))
+                        frame = frame.f_back
+                    names.append(phase)
+                    stack = ';'.join(reversed(names))
+                    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                    self.samples += 1
+            del frames
+
+    def collapsed(self) -> str:
+        """Pilhas no formato "collapsed" (flamegraph.pl, speedscope, inferno)"""
+        with self._lock:
+            stacks = dict(self.stacks)
+        return ''.join(f'{stack} {count}\n' for stack, count in sorted(stacks.items()))
+
+    def top_functions(self, n: int = TOP_N) -> str:
+        """Tabela das funções com mais amostras: próprias (no topo da pilha) e totais (em qualquer nível)"""
+        with self._lock:
+            stacks = dict(self.stacks)
+            samples = self.samples
+            phases = dict(self.phase_seconds)
+        own: Dict[str, int] = {}
+        total: Dict[str, int] = {}
+        for stack, count in stacks.items():
+            names = stack.split(';')[1:]
+            if not names:
+                continue
+            own[names[-1]] = own.get(names[-1], 0) + count
+            for name in set(names):
+                total[name] = total.get(name, 0) + count
+        lines = [f'Amostras: {samples:,} a cada {self.interval * 1000:g} ms']
+        lines += [f'Fase {phase}: {seconds:.2f}s' for phase, seconds in phases.items()]
+        lines += ['', f"{'Próprio':>9} {'%':>6} {'Total':>9} {'%':>6}  Função"]
+        for name, count in sorted(own.items(), key=lambda item: (-item[1], item[0]))[:n]:
+            lines.append(f'{count:>9,} {count / samples:>6.1%} {total[name]:>9,} {total[name] / samples:>6.1%}  {name}')
+        return '\n'.join(lines) + '\n'
+
+    def write_to_zip(self, zip_file: zipfile.ZipFile, folder: str = 'PERFIL') -> None:
+        zip_file.writestr(f'{folder}/perfil.collapsed.txt', self.collapsed())
+        zip_file.writestr(f'{folder}/funcoes_mais_amostradas.txt', self.top_functions())
+
+
+# =============================================================================
+# EXECUÇÃO COMPARTILHADA
+# =============================================================================
+
+# Memória estimada para processar um arquivo, em múltiplos do seu tamanho
+TASK_MEMORY_FACTOR = 12
+
+DEFAULT_EXECUTION_CONFIG = {
+    'process_pool': True,
+    'max_workers': min(4, os.cpu_count() or 1),
+    'memory_budget_mb': None,
+    # auto: o planejador escolhe por lote; inline ou pool fixam a estratégia
+    'strategy': 'auto',
+}
+
+EXECUTION_STRATEGIES = {
+    'inline': 'na sessão',
+    'pool': 'pool de processos',
+}
+
+# Lotes menores que isso rodam na sessão: despachar tarefas ao pool custaria mais que o cálculo
+INLINE_MAX_BATCH_BYTES = 16 * 2**20
+
+
+def total_memory_bytes() -> Optional[int]:
+    """Memória total disponível ao processo (limite do cgroup, se houver)"""
+    try:
+        limit = Path('/sys/fs/cgroup/memory.max').read_text().strip()
+        if limit.isdigit():
+            return int(limit)
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def get_execution_config() -> Dict:
+    """Configuração do pool de processos (seção [execution] do secrets.toml)"""
+    config = dict(DEFAULT_EXECUTION_CONFIG)
+    try:
+        config.update(st.secrets.get("execution", {}))
+    except Exception:
+        pass
+    if not config['memory_budget_mb']:
+        total = total_memory_bytes()
+        config['memory_budget_mb'] = int(total * 0.6 / 2**20) if total else 4096
+    return config
+
+
+@dataclass
+class ExecutionPlan:
+    """Estratégia de execução de um lote e o motivo da escolha"""
+    strategy: str
+    reason: str
+    overridden: bool = False
+
+    def describe(self) -> str:
+        origin = 'definida pelo operador' if self.overridden else 'automática'
+        return f'{EXECUTION_STRATEGIES[self.strategy]} ({origin}): {self.reason}'
+
+
+def plan_execution(sizes: List[int], cpu_count: int, max_workers: int, memory_budget_bytes: int,
+                   strategy: str = 'auto', pool_enabled: bool = True) -> ExecutionPlan:
+    """Escolhe entre processar o lote na sessão ou no pool, pelo tamanho dos arquivos, núcleos e memória.
+
+    O motor oferece duas estratégias: ``inline`` (arquivos em sequência no
+    processo da sessão, sem serialização) e ``pool`` (um arquivo por tarefa
+    no pool compartilhado, em paralelo e com fila justa entre usuários).
+    Não há estratégias "streaming" nem "em blocos" separadas: as duas já
+    leem cada SPED em streaming (``SpedParser.load_stream`` e
+    ``SpedWriter.generate``), então um arquivo acima do orçamento de memória
+    vai para ``inline``, uma cópia por vez. O paralelismo é por arquivo: um
+    mês enorme sozinho roda numa tarefa só (dividi-lo exigiria repassar o
+    0200 a cada bloco e remontar a saída na ordem original).
+    """
+    if not pool_enabled:
+        return ExecutionPlan('inline', 'pool de processos desativado (process_pool = false)', overridden=True)
+    if strategy in EXECUTION_STRATEGIES:
+        return ExecutionPlan(strategy, f'execution.strategy = "{strategy}"', overridden=True)
+
+    total_mb = sum(sizes) / 2**20
+    parallel = min(cpu_count, max_workers, len(sizes))
+    if min(cpu_count, max_workers) <= 1:
+        return ExecutionPlan('inline', f'{cpu_count} núcleo(s) e max_workers = {max_workers}: sem paralelismo, '
+                                       f'o pool só acrescentaria serialização')
+    if sum(sizes) < INLINE_MAX_BATCH_BYTES:
+        return ExecutionPlan('inline', f'lote pequeno ({len(sizes)} arquivo(s), {total_mb:.1f} MB)')
+    largest = max(sizes) * TASK_MEMORY_FACTOR
+    if largest > memory_budget_bytes:
+        return ExecutionPlan('inline', f'o maior arquivo precisa de ~{largest / 2**20:,.0f} MB, acima do orçamento de '
+                                       f'{memory_budget_bytes / 2**20:,.0f} MB: uma cópia só, em sequência na sessão')
+    # Quantos dos maiores arquivos cabem juntos no orçamento de memória
+    fits = 0
+    needed = 0
+    for size in sorted(sizes, reverse=True)[:parallel]:
+        needed += size * TASK_MEMORY_FACTOR
+        if needed > memory_budget_bytes:
+            break
+        fits += 1
+    limit = ' (limitado pela memória)' if fits < parallel else ''
+    return ExecutionPlan('pool', f'{len(sizes)} arquivo(s), {total_mb:,.1f} MB: até {fits} arquivo(s) em '
+                                 f'paralelo{limit}')
+
+
+def engine_module():
+    """Módulo importável com o pipeline.
+
+    O Streamlit executa este arquivo como ``__main__``, que os processos do
+    pool não conseguem importar; as tarefas são referenciadas pelo nome real
+    do módulo.
+    """
+    if __name__ != '__main__':
+        return sys.modules[__name__]
+    return importlib.import_module(Path(__file__).stem)
+
+
+def run_file_task(source_spec: Dict, product_table_path: str, cfops: List[str],
+                  scenario_specs: Tuple[tuple, ...] = (), progress_path: Optional[str] = None,
+                  registers: Tuple[str, ...] = DEFAULT_REGISTERS) -> Dict:
+    """Tarefa executada num processo do pool: processa um SPED e devolve o mês serializado.
+
+    A base de produtos é a ``ProductTable`` gravada pela sessão, mapeada em memória.
+    Com ``progress_path`` o progresso é gravado nesse arquivo JSON para a sessão acompanhar.
+    """
+    with ProductTable.open(product_table_path) as product_table:
+        calculator = IcmsStCalculator(product_table, set(cfops), registers=registers)
+        # Cenários chegam como tuplas: a classe do __main__ do Streamlit não é importável no processo
+        scenarios = None
+        if scenario_specs:
+            scenarios = ScenarioEvaluator([Scenario(*spec) for spec in scenario_specs], product_table, set(cfops))
+        source = SpedSource.from_spec(source_spec)
+        progress = None
+        if progress_path:
+            progress = FileProgress(source.name, source.size, partial(write_progress_file, progress_path))
+        processed = process_sped_source(source, calculator, scenarios=scenarios, progress=progress)
+    return encode_processed_month(processed)
+
+
+class _QueuedTask:
+    def __init__(self, user: str, fn_name: str, args: tuple, estimated_bytes: int):
+        self.user = user
+        self.fn_name = fn_name
+        self.args = args
+        self.estimated_bytes = estimated_bytes
+        self.future: Future = Future()
+
+
+class ExecutionService:
+    """Pool de processos compartilhado por todas as sessões do servidor.
+
+    Cada usuário tem sua fila FIFO e as filas são atendidas em rodízio, de modo
+    que um lote grande não bloqueia os demais analistas. Uma tarefa só é
+    despachada quando cabe no orçamento de memória (estimado pelo tamanho do
+    arquivo); se nada estiver em execução ela é admitida mesmo acima do
+    orçamento, para não ficar parada para sempre.
+    """
+
+    def __init__(self, max_workers: int, memory_budget_bytes: int):
+        self.max_workers = max_workers
+        self.memory_budget_bytes = memory_budget_bytes
+        self._executor = self._new_executor()
+        # Reentrante: o callback de um Future já concluído roda na hora, com o lock adquirido
+        self._lock = threading.RLock()
+        self._queues: Dict[str, deque] = {}
+        self._turns: deque = deque()
+        self._running = 0
+        self._in_flight_bytes = 0
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        # spawn: o servidor do Streamlit tem várias threads, e fork com threads não é seguro
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, user: str, fn_name: str, args: tuple, estimated_bytes: int = 0) -> Future:
+        """Enfileira ``engine_module().<fn_name>(*args)``; devolve um Future com o resultado"""
+        task = _QueuedTask(user or 'anônimo', fn_name, args, estimated_bytes)
+        with self._lock:
+            if task.user not in self._queues:
+                self._queues[task.user] = deque()
+                self._turns.append(task.user)
+            self._queues[task.user].append(task)
+            self._dispatch_locked()
+        return task.future
+
+    def cancel(self, futures: List[Future]) -> None:
+        """Retira da fila as tarefas ainda não despachadas (ex.: sessão encerrada)"""
+        pending = set(futures)
+        with self._lock:
+            for user in list(self._queues):
+                queue = self._queues[user]
+                for task in [t for t in queue if t.future in pending]:
+                    queue.remove(task)
+                    task.future.cancel()
+                if not queue:
+                    del self._queues[user]
+                    self._turns.remove(user)
+
+    def queue_position(self, future: Future) -> Optional[int]:
+        """Posição (1 = próxima) na ordem de despacho; None se já despachada"""
+        with self._lock:
+            for position, task in enumerate(self._dispatch_order_locked(), 1):
+                if task.future is future:
+                    return position
+        return None
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'running': self._running,
+                'queued': sum(len(q) for q in self._queues.values()),
+                'users': len(self._queues),
+                'in_flight_mb': self._in_flight_bytes // 2**20,
+            }
+
+    def _dispatch_order_locked(self) -> List[_QueuedTask]:
+        queues = {user: list(self._queues[user]) for user in self._turns}
+        order = []
+        while any(queues.values()):
+            for user in self._turns:
+                if queues[user]:
+                    order.append(queues[user].pop(0))
+        return order
+
+    def _dispatch_locked(self) -> None:
+        while self._running < self.max_workers and self._turns:
+            user = self._turns[0]
+            task = self._queues[user][0]
+            fits = self._in_flight_bytes + task.estimated_bytes <= self.memory_budget_bytes
+            if not fits and self._running > 0:
+                # Aguarda memória liberar; não passa tarefas menores à frente (evita inanição)
+                return
+
+            self._queues[user].popleft()
+            self._turns.rotate(-1)
+            if not self._queues[user]:
+                del self._queues[user]
+                self._turns.remove(user)
+
+            if not task.future.set_running_or_notify_cancel():
+                continue
+            self._running += 1
+            self._in_flight_bytes += task.estimated_bytes
+            try:
+                inner = self._submit_locked(task)
+            except Exception as exc:
+                # Sem despacho o _on_done nunca roda: devolve a vaga e a memória e falha só esta tarefa
+                self._running -= 1
+                self._in_flight_bytes -= task.estimated_bytes
+                task.future.set_exception(exc)
+                continue
+            inner.add_done_callback(lambda f, task=task: self._on_done(task, f))
+
+    def _submit_locked(self, task: _QueuedTask) -> Future:
+        fn = getattr(engine_module(), task.fn_name)
+        try:
+            return self._executor.submit(fn, *task.args)
+        except BrokenProcessPool:
+            # Um processo morreu (ex.: falta de memória) e inutilizou o pool: recria
+            self._executor = self._new_executor()
+            return self._executor.submit(fn, *task.args)
+
+    def _on_done(self, task: _QueuedTask, inner: Future) -> None:
+        with self._lock:
+            self._running -= 1
+            self._in_flight_bytes -= task.estimated_bytes
+            self._dispatch_locked()
+        if inner.exception() is not None:
+            task.future.set_exception(inner.exception())
+        else:
+            task.future.set_result(inner.result())
+
+
+@st.cache_resource
+def get_execution_service() -> ExecutionService:
+    """Instância única por processo do servidor, compartilhada entre sessões"""
+    config = get_execution_config()
+    service = ExecutionService(int(config['max_workers']), int(config['memory_budget_mb']) * 2**20)
+    metrics = get_metrics()
+    metrics.gauge('icmsst_queue_depth', 'Tarefas aguardando na fila do pool de processos',
+                  callback=lambda: service.stats()['queued'])
+    metrics.gauge('icmsst_tasks_running', 'Tarefas em execução no pool de processos',
+                  callback=lambda: service.stats()['running'])
+    return service
+
+
+# =============================================================================
+# PROCESSAMENTO DISTRIBUÍDO (SPOOL)
+# =============================================================================
+
+class SpoolQueue:
+    """Fila de jobs em um diretório compartilhado entre máquinas.
+
+    Cada SPED de um lote vira um manifesto JSON em ``jobs/pending``. Um worker
+    assume o job renomeando o manifesto para ``jobs/running`` com um sufixo
+    próprio da posse (o rename é atômico: só um worker vence) e, ao terminar,
+    grava o mês serializado (JSON compactado, ``dump_processed_month``) e o
+    SPED retificado em ``results/<lote>`` e move o manifesto para
+    ``jobs/done`` ou ``jobs/failed``. Workers mantêm o mtime do manifesto em
+    execução atualizado; jobs sem sinal de vida voltam para a fila, e o
+    worker atrasado que perdeu a posse não mexe mais nos manifestos. O
+    coordenador consolida os meses concluídos no mesmo relatório da interface.
+    Caminhos nos manifestos são relativos à raiz do spool, que pode estar
+    montada em pontos diferentes em cada máquina.
+    """
+
+    STATES = ('pending', 'running', 'done', 'failed')
+    HEARTBEAT_SECONDS = 30
+    # Intervalo mínimo entre as linhas de progresso impressas pelo worker
+    PROGRESS_SECONDS = 5
+    STALE_AFTER_SECONDS = 600
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+        for state in self.STATES:
+            (self.root / 'jobs' / state).mkdir(parents=True, exist_ok=True)
+        for folder in ('batches', 'inputs', 'results'):
+            (self.root / folder).mkdir(exist_ok=True)
+
+    def _state_dir(self, state: str) -> Path:
+        return self.root / 'jobs' / state
+
+    @staticmethod
+    def _write_json(path: Path, data: Dict) -> None:
+        # Gravação atômica: workers nunca leem um manifesto pela metade
+        tmp_path = path.with_name(path.name + '.tmp')
+        tmp_path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding='utf-8')
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _read_json(path: Path) -> Dict:
+        return json.loads(path.read_text(encoding='utf-8'))
+
+    def submit_batch(self, sped_paths: List[str], product_base_path: str, cfops: set,
+                     registers: Tuple[str, ...] = DEFAULT_REGISTERS) -> Tuple[str, List[BatchEntry]]:
+        """Copia as entradas para o spool e enfileira um job por SPED do lote"""
+        batch_id = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{os.urandom(4).hex()}"
+        input_dir = self.root / 'inputs' / batch_id
+        input_dir.mkdir(parents=True)
+
+        files = []
+        for sped_path in sped_paths:
+            file_obj = io.BytesIO(Path(sped_path).read_bytes())
+            file_obj.name = Path(sped_path).name
+            files.append(file_obj)
+        batch_entries, rejected_entries = build_batch_index(expand_uploads(files, str(input_dir)))
+        if not batch_entries:
+            shutil.rmtree(input_dir, ignore_errors=True)
+            raise ValueError('Nenhum arquivo SPED válido para processar')
+
+        # Base de produtos lida uma vez; workers mapeiam a tabela compilada
+        product_base = ProductBaseLoader()
+        product_base.load_file(product_base_path)
+        products_path = input_dir / 'produtos.tbl'
+        ProductTable.write(product_base.products_by_ncm, str(products_path))
+
+        jobs = []
+        for seq, entry in enumerate(batch_entries):
+            spec = entry.file.to_spec()
+            spec['path'] = os.path.relpath(spec['path'], self.root)
+            jobs.append({
+                'batch': batch_id,
+                'job': f'{batch_id}__{seq:05d}',
+                'seq': seq,
+                'source': spec,
+                'products': os.path.relpath(products_path, self.root),
+                'cfops': sorted(cfops),
+                'registers': list(registers),
+            })
+
+        self._write_json(self.root / 'batches' / f'{batch_id}.json', {
+            'batch': batch_id,
+            'created_at': datetime.now().isoformat(),
+            'company_name': batch_entries[0].header.nome if batch_entries else '',
+            'cnpj': batch_entries[0].header.cnpj if batch_entries else '',
+            'cfops': sorted(cfops),
+            'jobs': [job['job'] for job in jobs],
+            'rejected': [{'arquivo': e.name, 'origem': e.file.origin, 'motivo': e.reason}
+                         for e in rejected_entries],
+        })
+        # Manifestos por último: um job nunca aparece antes das suas entradas
+        for job in jobs:
+            self._write_json(self._state_dir('pending') / f"{job['job']}.json", job)
+
+        return batch_id, rejected_entries
+
+    @staticmethod
+    def job_name(path: Path) -> str:
+        """Nome do job a partir do manifesto (``<job>.json`` ou ``<job>.<posse>.json``)"""
+        return path.name.split('.', 1)[0]
+
+    def claim(self) -> Optional[Path]:
+        """Assume o próximo job pendente; devolve o manifesto em execução.
+
+        O nome em ``running`` leva um sufixo aleatório: se o job voltar à fila
+        e for assumido de novo, cada posse tem o seu manifesto.
+        """
+        for path in sorted(self._state_dir('pending').glob('*.json')):
+            target = self._state_dir('running') / f'{self.job_name(path)}.{os.urandom(4).hex()}.json'
+            try:
+                os.rename(path, target)
+            except FileNotFoundError:
+                # Outro worker assumiu o job primeiro
+                continue
+            os.utime(target)
+            return target
+        return None
+
+    def requeue_stale(self, stale_after_seconds: int = STALE_AFTER_SECONDS) -> int:
+        """Devolve à fila jobs cujo worker parou de sinalizar; devolve quantos"""
+        cutoff = datetime.now().timestamp() - stale_after_seconds
+        requeued = 0
+        for path in self._state_dir('running').glob('*.json'):
+            try:
+                if path.stat().st_mtime < cutoff:
+                    os.rename(path, self._state_dir('pending') / f'{self.job_name(path)}.json')
+                    requeued += 1
+            except FileNotFoundError:
+                continue
+        return requeued
+
+    def process_job(self, running_path: Path, worker_id: str,
+                    metrics: Optional[MetricsRegistry] = None) -> Optional[str]:
+        """Processa um job já assumido; devolve o estado final ('done' ou 'failed').
+
+        Devolve ``None`` quando o job voltou à fila durante a execução: o
+        manifesto passou a ser de outro worker e não é alterado.
+        """
+        job = self._read_json(running_path)
+        stop_heartbeat = threading.Event()
+
+        def heartbeat():
+            while not stop_heartbeat.wait(self.HEARTBEAT_SECONDS):
+                try:
+                    os.utime(running_path)
+                except FileNotFoundError:
+                    return
+
+        threading.Thread(target=heartbeat, daemon=True).start()
+        job['worker'] = worker_id
+        job['started_at'] = datetime.now().isoformat()
+        try:
+            spec = dict(job['source'], path=str(self.root / job['source']['path']))
+            source = SpedSource.from_spec(spec)
+            progress = FileProgress(
+                source.name, source.size, min_interval=self.PROGRESS_SECONDS,
+                callback=lambda snap: logger.info('[%s] %s', worker_id, format_file_progress(job['job'], snap)))
+            with ProductTable.open(str(self.root / job['products'])) as product_table:
+                calculator = IcmsStCalculator(product_table, set(job['cfops']),
+                                              registers=tuple(job.get('registers', DEFAULT_REGISTERS)))
+                processed = process_sped_source(source, calculator, progress=progress)
+            if metrics:
+                record_processed_month(metrics, processed, 'calculado')
+
+            result_dir = self.root / 'results' / job['batch']
+            (result_dir / 'SPEDS_RETIFICADOS').mkdir(parents=True, exist_ok=True)
+            result_path = result_dir / f"{job['job']}.json.gz"
+            # Temporário por posse: um job devolvido à fila pode terminar em dois workers ao mesmo tempo
+            tmp_path = result_path.with_name(f'{running_path.name}.tmp')
+            tmp_path.write_bytes(dump_processed_month(processed))
+            os.replace(tmp_path, result_path)
+            sped_path = result_dir / 'SPEDS_RETIFICADOS' / processed.sped_filename
+            sped_path.write_bytes(processed.sped_output)
+
+            job['result'] = os.path.relpath(result_path, self.root)
+            job['summary'] = {f.name: str(v) for f, v in zip(dataclass_fields(MonthSummary),
+                                                             astuple(processed.summary))}
+            state = 'done'
+        except Exception as exc:
+            logger.exception('[%s] %s falhou', worker_id, job['job'])
+            job['error'] = f'{type(exc).__name__}: {exc}'
+            state = 'failed'
+        finally:
+            stop_heartbeat.set()
+
+        # Só quem ainda tem a posse encerra o job: o rename falha se ele voltou à fila
+        closing_path = running_path.with_suffix('.closing')
+        try:
+            os.rename(running_path, closing_path)
+        except FileNotFoundError:
+            logger.warning('[%s] %s devolvido à fila durante a execução; fica com o novo dono',
+                           worker_id, job['job'])
+            return None
+        job['finished_at'] = datetime.now().isoformat()
+        self._write_json(closing_path, job)
+        os.rename(closing_path, self._state_dir(state) / f"{job['job']}.json")
+        return state
+
+    def run_worker(self, once: bool = False, poll_seconds: float = 5,
+                   stale_after_seconds: int = STALE_AFTER_SECONDS, metrics_dir: Optional[str] = None) -> int:
+        """Laço do worker; com ``once`` sai quando a fila esvazia. Devolve os jobs processados.
+
+        Com ``metrics_dir`` cada worker grava ``icmsst_spool_<host>_<pid>.prom`` nesse
+        diretório após cada job, para o textfile collector do node_exporter.
+        """
+        worker_id = f'{socket.gethostname()}:{os.getpid()}'
+        metrics = metrics_path = None
+        if metrics_dir:
+            metrics = build_metrics({'worker': worker_id})
+            metrics.counter('icmsst_spool_jobs_total', 'Jobs do spool encerrados, por estado (done, failed)')
+            metrics_path = os.path.join(metrics_dir, f'icmsst_spool_{socket.gethostname()}_{os.getpid()}.prom')
+        processed_jobs = 0
+        while True:
+            self.requeue_stale(stale_after_seconds)
+            running_path = self.claim()
+            if running_path is None:
+                if once:
+                    return processed_jobs
+                time.sleep(poll_seconds)
+                continue
+            state = self.process_job(running_path, worker_id, metrics)
+            if state is None:
+                continue
+            processed_jobs += 1
+            if metrics:
+                metrics.inc('icmsst_spool_jobs_total', state=state)
+                metrics.write_textfile(metrics_path)
+            logger.info('[%s] %s: %s', worker_id, self.job_name(running_path), 'ok' if state == 'done' else 'falhou')
+
+    def batch_status(self, batch_id: str) -> Dict[str, int]:
+        return {state: len(list(self._state_dir(state).glob(f'{batch_id}__*.json')))
+                for state in self.STATES}
+
+    def merge_batch(self, batch_id: str, split_by_month: bool = False) -> Path:
+        """Consolida os meses concluídos do lote em Excel, PDF e JSON"""
+        batch = self._read_json(self.root / 'batches' / f'{batch_id}.json')
+        done_jobs = sorted((self._read_json(path) for path in
+                            self._state_dir('done').glob(f'{batch_id}__*.json')),
+                           key=lambda job: job['seq'])
+        if not done_jobs:
+            raise ValueError(f'Lote {batch_id} sem jobs concluídos')
+
+        summaries: List[MonthSummary] = []
+        all_results: Dict[str, List[CalculationResult]] = {}
+        rollups = RollupAccumulator()
+        for job in done_jobs:
+            processed = load_processed_month((self.root / job['result']).read_bytes())
+            replay_month(processed, rollups)
+            summaries.append(processed.summary)
+            all_results[processed.sheet_name] = processed.results
+
+        cfops = set(batch['cfops'])
+        result_dir = self.root / 'results' / batch_id
+        (result_dir / 'DE_PARA_CONSOLIDADO.xlsx').write_bytes(
+            generate_excel(all_results, summaries, rollups, split_by_month=split_by_month,
+                           link_detail_workbooks=split_by_month))
+        if split_by_month:
+            for sheet_name, results in all_results.items():
+                path = result_dir / detail_workbook_filename(sheet_name)
+                path.parent.mkdir(exist_ok=True)
+                path.write_bytes(generate_detail_workbook(sheet_name, results))
+        (result_dir / 'RELATORIO_CONSOLIDADO.pdf').write_bytes(
+            generate_pdf(summaries, batch['company_name'], batch['cnpj']))
+        summary_json = generate_summary_json(summaries, batch['company_name'], batch['cnpj'], cfops, rollups)
+        summary_json['meses_pendentes'] = len(batch['jobs']) - len(done_jobs)
+        (result_dir / 'resumo_consolidado.json').write_text(
+            json.dumps(summary_json, ensure_ascii=False, indent=2), encoding='utf-8')
+        return result_dir
+
+
+def run_spool_worker(root: str, once: bool, poll_seconds: float, stale_after_seconds: int,
+                     metrics_dir: Optional[str] = None) -> int:
+    # Também roda em processos novos (spawn), que não herdam a configuração de log
+    setup_logging()
+    return SpoolQueue(root).run_worker(once, poll_seconds, stale_after_seconds, metrics_dir)
+
+
 # =============================================================================
 # AUTENTICAÇÃO
 # =============================================================================
@@ -917,10 +4338,22 @@ def check_password():
     return False
 
 
+def is_admin() -> bool:
+    """Usuário da sessão pode usar as ferramentas de diagnóstico ([auth] admins; padrão: o usuário configurado)"""
+    try:
+        auth = st.secrets.get("auth", {})
+    except Exception:
+        auth = {}
+    admins = auth.get("admins") or [auth.get("username", "admin")]
+    return st.session_state.get("current_user") in admins
+
+
 # =============================================================================
 # INTERFACE STREAMLIT
 # =============================================================================
 
+ROLLUP_UI_LIMIT = 1000
+
 MONTH_NAMES = {
     '01': 'Janeiro', '02': 'Fevereiro', '03': 'Março',
     '04': 'Abril', '05': 'Maio', '06': 'Junho',
@@ -962,7 +4395,326 @@ def extract_month_year(filename: str, header: Optional[SpedHeader] = None) -> Tu
     return '00', '0000'
 
 
+SCENARIO_COLUMNS = ['Cenário', 'MVA', 'Alíquota ICMS (%)', 'CFOPs']
+
+
+def parse_scenarios(df: pd.DataFrame) -> List[Scenario]:
+    """Converte a tabela de cenários da barra lateral; linhas vazias são ignoradas"""
+    scenarios: List[Scenario] = []
+    names = set()
+    for idx, row in enumerate(df.to_dict('records'), 1):
+        use_mva_adjusted = row.get('MVA') == 'Ajustada'
+        aliq = row.get('Alíquota ICMS (%)')
+        aliq_icms = Decimal(str(aliq)) if aliq is not None and pd.notna(aliq) else None
+        cfops_text = str(row.get('CFOPs') or '').strip()
+        cfops = frozenset(re.findall(r'\d{4}', cfops_text)) if cfops_text else None
+        if not use_mva_adjusted and aliq_icms is None and cfops is None:
+            continue
+        
+        name = str(row.get('Cenário') or '').strip() or f'Cenário {idx}'
+        while name in names or name == 'Atual':
+            name += '*'
+        names.add(name)
+        scenarios.append(Scenario(name, use_mva_adjusted, aliq_icms, cfops))
+    return scenarios
+
+
+def render_history_page():
+    """Consulta ao histórico gravado em SQLite"""
+    st.markdown("## 🗂️ Histórico de Resultados")
+    
+    store_path = get_result_store_path()
+    if not Path(store_path).exists():
+        st.info("Nenhum histórico gravado ainda. Marque \"Salvar no histórico\" antes de processar.")
+        return
+    
+    store = ResultStore(store_path)
+    try:
+        companies = store.list_companies()
+        if not companies:
+            st.info("Nenhum histórico gravado ainda.")
+            return
+        
+        col1, col2, col3 = st.columns([2, 1, 1])
+        with col1:
+            cnpj = st.selectbox("Empresa", [c[0] for c in companies],
+                                format_func=lambda c: f"{c} - {dict(companies)[c]}")
+        with col2:
+            year = st.text_input("Ano", placeholder="AAAA")
+        with col3:
+            month = st.selectbox("Mês", [''] + list(MONTH_NAMES.keys()),
+                                 format_func=lambda m: MONTH_NAMES.get(m, 'Todos'))
+        
+        col4, col5, col6 = st.columns(3)
+        with col4:
+            ncm = st.text_input("NCM")
+        with col5:
+            cod_item = st.text_input("Cod Item")
+        with col6:
+            cfop = st.text_input("CFOP")
+        
+        started = datetime.now()
+        totals = store.credit_totals(cnpj=cnpj, year=year.strip() or None, month=month or None,
+                                     ncm=ncm.strip() or None, cod_item=cod_item.strip() or None,
+                                     cfop=cfop.strip() or None)
+        elapsed_ms = (datetime.now() - started).total_seconds() * 1000
+        
+        total_credit = sum((t['credito_total'] for t in totals), Decimal('0'))
+        total_calculated = sum(t['calculados'] for t in totals)
+        
+        col_m1, col_m2 = st.columns(2)
+        with col_m1:
+            st.metric(label="💰 Crédito Total", value=f"R$ {float(total_credit):,.2f}")
+        with col_m2:
+            st.metric(label="📄 Registros Calculados", value=f"{total_calculated:,}")
+        st.caption(f"Consulta em {elapsed_ms:,.0f} ms")
+        
+        if totals:
+            st.dataframe(pd.DataFrame([{
+                'Período': t['periodo'],
+                'Registros': t['registros'],
+                'Calculados': t['calculados'],
+                'Crédito PIS': f"R$ {float(t['credito_pis']):,.2f}",
+                'Crédito COFINS': f"R$ {float(t['credito_cofins']):,.2f}",
+                'Crédito Total': f"R$ {float(t['credito_total']):,.2f}"
+            } for t in totals]), use_container_width=True, hide_index=True)
+        
+        with st.expander("📄 Linhas (até 1.000)"):
+            rows = store.query_results(cnpj=cnpj, year=year.strip() or None, month=month or None,
+                                       ncm=ncm.strip() or None, cod_item=cod_item.strip() or None,
+                                       cfop=cfop.strip() or None, limit=1000)
+            if rows:
+                df_rows = pd.DataFrame(rows)
+                for name in ResultStore.RESULT_MONEY_FIELDS:
+                    df_rows[name] = df_rows[name].astype(float)
+                st.dataframe(df_rows, use_container_width=True, hide_index=True)
+            else:
+                st.write("Nenhuma linha encontrada.")
+    finally:
+        store.close()
+
+
+def render_artifact(batch: BatchArtifacts, name: str, primary: bool = False, help: Optional[str] = None) -> None:
+    """Botão "Preparar" enquanto o arquivo não foi gerado; depois, o download"""
+    label, _, mime = BatchArtifacts.SPECS[name]
+    button_type = "primary" if primary else "secondary"
+    if not batch.is_ready(name):
+        if st.button(f"⚙️ Preparar {label}", key=f"prepare_{name}", use_container_width=True, type=button_type,
+                     help=help):
+            with st.spinner(f"Gerando {label}..."):
+                batch.get(name)
+            # O ZIP completo também prepara Excel, PDF e JSON: redesenha todos os botões
+            st.rerun()
+    if batch.is_ready(name):
+        st.download_button(
+            label=f"⬇️ Baixar {label}",
+            data=batch.get(name),
+            file_name=batch.filename(name),
+            mime=mime,
+            key=f"download_{name}",
+            use_container_width=True,
+            type=button_type,
+            help=help
+        )
+
+
+def render_result_explorer(batch: BatchArtifacts) -> None:
+    """Filtros, ordenação e paginação das linhas do lote; a consulta roda no servidor"""
+    with st.spinner("Indexando as linhas do lote..."):
+        explorer = batch.explorer()
+    
+    col_month, col_ncm, col_item, col_cfop, col_status = st.columns([2, 1, 1, 1, 2])
+    with col_month:
+        months = st.multiselect("Mês", explorer.months, key='explorer_months')
+    with col_ncm:
+        ncm = st.text_input("NCM (prefixo)", key='explorer_ncm')
+    with col_item:
+        cod_item = st.text_input("Cod Item (contém)", key='explorer_item')
+    with col_cfop:
+        cfops = st.multiselect("CFOP", explorer.values('cfop'), key='explorer_cfops')
+    with col_status:
+        situacoes = st.multiselect("Situação", explorer.values('situacao'), key='explorer_status')
+    
+    col_sort, col_desc, col_size, col_page = st.columns([2, 1, 1, 1])
+    with col_sort:
+        sort = st.selectbox("Ordenar por", list(ResultExplorer.SORT_KEYS),
+                            format_func=ResultExplorer.SORT_KEYS.get, key='explorer_sort')
+    with col_desc:
+        descending = st.checkbox("Decrescente", key='explorer_desc')
+    with col_size:
+        page_size = st.selectbox("Linhas por página", ResultExplorer.PAGE_SIZES, index=1, key='explorer_page_size')
+    
+    # Filtro ou ordenação novos voltam para a primeira página
+    signature = (tuple(months), ncm, cod_item, tuple(cfops), tuple(situacoes), sort, descending, page_size)
+    if st.session_state.get('explorer_signature') != signature:
+        st.session_state['explorer_signature'] = signature
+        st.session_state['explorer_page'] = 1
+    with col_page:
+        page = st.number_input("Página", min_value=1, step=1, key='explorer_page')
+    
+    started = time.perf_counter()
+    total, page, df_page = explorer.query(months, ncm, cod_item, cfops, situacoes, sort, descending,
+                                          int(page), page_size)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    
+    st.dataframe(df_page, use_container_width=True, hide_index=True)
+    pages = max(1, -(-total // page_size))
+    st.caption(f"{total:,} de {len(explorer):,} linhas · página {page:,} de {pages:,} · "
+               f"consulta em {elapsed_ms:,.0f} ms")
+
+
+def render_batch_results(batch: BatchArtifacts) -> None:
+    """Resultados do último lote processado na sessão, com os downloads sob demanda"""
+    summaries = batch.summaries
+    scenario_results = batch.scenario_summaries
+    rollups = batch.rollups
+    company_name = batch.company_name
+    cnpj = batch.cnpj
+    
+    st.markdown("---")
+    
+    # Resultados
+    st.markdown("## 📊 Resultados")
+    
+    # Métricas principais
+    total_credit = sum(s.total_credit for s in summaries)
+    total_records = sum(s.total_records for s in summaries)
+    total_calculated = sum(s.total_calculated for s in summaries)
+    total_pis = sum(s.pis_credit for s in summaries)
+    total_cofins = sum(s.cofins_credit for s in summaries)
+    
+    col1, col2, col3, col4 = st.columns(4)
+    
+    with col1:
+        st.metric(
+            label="💰 Crédito Total",
+            value=f"R$ {float(total_credit):,.2f}",
+            delta=f"{(total_calculated/total_records*100):.1f}% aproveitamento"
+        )
+    
+    with col2:
+        st.metric(
+            label="📄 Registros",
+            value=f"{total_records:,}",
+            delta=f"{total_calculated:,} calculados"
+        )
+    
+    with col3:
+        st.metric(
+            label="🔵 Crédito PIS",
+            value=f"R$ {float(total_pis):,.2f}"
+        )
+    
+    with col4:
+        st.metric(
+            label="🟢 Crédito COFINS",
+            value=f"R$ {float(total_cofins):,.2f}"
+        )
+    
+    # Empresa
+    st.markdown(f"""
+    **Empresa:** {company_name}  
+    **CNPJ:** {cnpj}  
+    **Período:** {summaries[0].month_name}/{summaries[0].year} a {summaries[-1].month_name}/{summaries[-1].year}
+    """)
+    
+    # Tabela detalhada
+    st.markdown("### 📅 Detalhamento Mensal")
+    
+    df_summary = pd.DataFrame([{
+        'Mês/Ano': f'{s.month_name}/{s.year}',
+        'Registros': s.total_records,
+        'Calculados': s.total_calculated,
+        'Crédito PIS': f'R$ {float(s.pis_credit):,.2f}',
+        'Crédito COFINS': f'R$ {float(s.cofins_credit):,.2f}',
+        'Crédito Total': f'R$ {float(s.total_credit):,.2f}'
+    } for s in summaries])
+    
+    st.dataframe(df_summary, use_container_width=True, hide_index=True)
+    
+    # Comparação de cenários
+    if scenario_results:
+        st.markdown("### 🔬 Comparação de Cenários")
+        
+        scenario_columns = {'Atual': summaries, **scenario_results}
+        df_scenarios = pd.DataFrame([{
+            'Cenário': name,
+            'Calculados': sum(s.total_calculated for s in month_summaries),
+            'Crédito PIS': f'R$ {float(sum(s.pis_credit for s in month_summaries)):,.2f}',
+            'Crédito COFINS': f'R$ {float(sum(s.cofins_credit for s in month_summaries)):,.2f}',
+            'Crédito Total': f'R$ {float(sum(s.total_credit for s in month_summaries)):,.2f}',
+            'Diferença vs Atual': f'R$ {float(sum(s.total_credit for s in month_summaries) - total_credit):,.2f}'
+        } for name, month_summaries in scenario_columns.items()])
+        st.dataframe(df_scenarios, use_container_width=True, hide_index=True)
+        
+        df_scenario_months = pd.DataFrame([
+            {'Mês/Ano': f'{s.month_name}/{s.year}',
+             **{name: f'R$ {float(month_summaries[idx].total_credit):,.2f}'
+                for name, month_summaries in scenario_columns.items()}}
+            for idx, s in enumerate(summaries)
+        ])
+        st.dataframe(df_scenario_months, use_container_width=True, hide_index=True)
+    
+    # Agregações por NCM, item e CFOP
+    st.markdown("### 🧮 Análise por NCM, Item e CFOP")
+    
+    tab_ncm, tab_item, tab_cfop = st.tabs(["Por NCM", "Por Item", "Por CFOP"])
+    for tab, (dimension, _, key_label, _) in zip((tab_ncm, tab_item, tab_cfop), ROLLUP_SHEETS):
+        with tab:
+            groups = rollups.get_sorted(dimension)
+            df_rollup = pd.DataFrame([{
+                key_label: g.key,
+                'NCM': g.ncm,
+                'Meses': g.months,
+                'Registros': g.total_records,
+                'Calculados': g.total_calculated,
+                'Crédito PIS': f'R$ {float(g.pis_credit):,.2f}',
+                'Crédito COFINS': f'R$ {float(g.cofins_credit):,.2f}',
+                'Crédito Total': f'R$ {float(g.total_credit):,.2f}'
+            } for g in groups[:ROLLUP_UI_LIMIT]])
+            st.dataframe(df_rollup, use_container_width=True, hide_index=True)
+            if len(groups) > ROLLUP_UI_LIMIT:
+                st.caption(f"Exibindo os {ROLLUP_UI_LIMIT:,} maiores de {len(groups):,} grupos. "
+                           "A lista completa está no Excel e no JSON.")
+    
+    # Linhas do lote, filtradas e paginadas no servidor
+    st.markdown("### 🔎 Linhas do Lote")
+    if st.checkbox("Explorar linhas", key='explorer_open',
+                   help="Filtra, ordena e pagina as linhas no servidor; só a página exibida vai para o navegador"):
+        render_result_explorer(batch)
+    
+    # Downloads
+    st.markdown("### 📥 Downloads")
+    st.caption("Cada arquivo é gerado ao clicar em Preparar e fica disponível até o próximo processamento.")
+    
+    col_dl1, col_dl2, col_dl3 = st.columns(3)
+    
+    with col_dl1:
+        render_artifact(batch, 'excel',
+                        help="Somente resumos; os De/Para mensais estão no ZIP completo" if batch.split_by_month else None)
+    
+    with col_dl2:
+        render_artifact(batch, 'pdf')
+    
+    with col_dl3:
+        render_artifact(batch, 'speds')
+    
+    with st.expander("🔧 JSON para Integração"):
+        render_artifact(batch, 'json')
+        if batch.is_ready('json'):
+            st.json(batch.summary_json())
+    
+    # Download de todos os arquivos em um único ZIP
+    st.markdown("---")
+    st.markdown("### 📦 Download Completo")
+    
+    render_artifact(batch, 'completo', primary=True)
+
+
 def main():
+    setup_logging()
+    setup_page()
+    
     # Verifica autenticação
     if not check_password():
         return
@@ -982,8 +4734,14 @@ def main():
         if st.button("🚪 Sair", use_container_width=True):
             st.session_state["authenticated"] = False
             st.session_state["current_user"] = None
+            batch_artifacts = st.session_state.pop('batch_artifacts', None)
+            if batch_artifacts is not None:
+                batch_artifacts.cleanup()
             st.rerun()
 
+        page = st.radio("Página", ["🚀 Processamento", "🗂️ Histórico"], horizontal=True,
+                        label_visibility="collapsed")
+
         st.markdown("---")
         st.markdown("### ⚙️ Configurações")
         
@@ -1003,6 +4761,76 @@ def main():
         if cfop_5102:
             cfops_selecionados.add('5102')
         
+        registros_selecionados = tuple(st.multiselect(
+            "Registros de receita",
+            options=list(SALES_REGISTERS),
+            default=list(DEFAULT_REGISTERS),
+            format_func=lambda register: SALES_REGISTERS[register].description,
+            help="Lidos na mesma passada pelo arquivo. C481/C485 e A170 não têm CFOP: entram sem o filtro acima"
+        )) or DEFAULT_REGISTERS
+        
+        st.markdown("#### 🔬 Cenários (what-if)")
+        scenario_table = st.data_editor(
+            pd.DataFrame(columns=SCENARIO_COLUMNS),
+            num_rows="dynamic",
+            hide_index=True,
+            key='scenarios',
+            column_config={
+                'MVA': st.column_config.SelectboxColumn(options=['Original', 'Ajustada']),
+                'Alíquota ICMS (%)': st.column_config.NumberColumn(min_value=0, max_value=100, step=0.01),
+                'CFOPs': st.column_config.TextColumn(help="Ex.: 5405, 5403 (vazio: CFOPs selecionados acima)"),
+            }
+        )
+        scenarios = parse_scenarios(scenario_table)
+        if scenarios:
+            st.caption(f"{len(scenarios)} cenário(s) calculados na mesma leitura dos arquivos")
+        
+        st.markdown("#### 📦 Exportações")
+        excel_split_by_month = st.checkbox(
+            "Excel: uma planilha por mês",
+            value=False,
+            help="Gera um arquivo De/Para por mês dentro do ZIP completo; o consolidado fica só com os resumos"
+        )
+        export_parquet = st.checkbox(
+            "Linhas em Parquet (ZIP completo)",
+            value=False,
+            help="Inclui no ZIP completo todas as linhas calculadas em Parquet, particionadas por CNPJ/ano/mês"
+        )
+        parquet_include_skipped = st.checkbox(
+            "Incluir linhas não calculadas",
+            value=False,
+            disabled=not export_parquet,
+            help="Inclui também as linhas ignoradas, com o motivo"
+        )
+        keep_batch = st.checkbox(
+            "Manter lote para correções da base",
+            value=False,
+            help="Guarda o último lote na sessão: reenviado com uma base de produtos corrigida, "
+                 "só as linhas dos NCMs alterados são recalculadas. Lê cada arquivo uma vez a mais "
+                 "para identificar o lote"
+        )
+        use_checkpoints = st.checkbox(
+            "Checkpoints para retomar lotes",
+            value=False,
+            help="Grava cada mês concluído em disco; um lote reenviado pula os meses já processados com a mesma configuração"
+        )
+        save_history = st.checkbox(
+            "Salvar no histórico (SQLite)",
+            value=False,
+            help="Grava resumos e linhas em banco local para consulta posterior na página Histórico"
+        )
+        profile_run = is_admin() and st.checkbox(
+            "Perfil de execução (admin)",
+            value=False,
+            help="Amostra as pilhas de chamadas do lote e da geração dos arquivos; o ZIP completo traz o "
+                 "flamegraph e as funções mais lentas em PERFIL/, sem dados fiscais. O lote roda na sessão"
+        )
+        
+        if get_execution_config()['process_pool']:
+            pool_stats = get_execution_service().stats()
+            st.caption(f"🖥️ Servidor: {pool_stats['running']} em execução, "
+                       f"{pool_stats['queued']} na fila ({pool_stats['users']} usuário(s))")
+        
         st.markdown("---")
         
         st.markdown("#### 📊 Sobre")
@@ -1014,24 +4842,29 @@ def main():
         
         st.markdown("#### 📋 Metodologia")
         st.markdown("""
-        1. **Identificação**: Registros C870 com CFOPs selecionados
+        1. **Identificação**: Registros de receita escolhidos (C870 por padrão) com CFOPs selecionados
         2. **Enriquecimento**: NCM → MVA da base de produtos
         3. **Cálculo**: Base ICMS-ST = Valor × (1 + MVA%)
         4. **Exclusão**: Nova BC = BC Original - ICMS-ST
         5. **Crédito**: Diferença dos tributos
         """)
     
+    if page == "🗂️ Histórico":
+        render_history_page()
+        return
+    
     # Main content
     col1, col2 = st.columns(2)
     
     with col1:
         st.markdown("### 📁 Base de Produtos")
-        st.markdown("Upload do arquivo Excel com NCMs e MVAs")
+        st.markdown("Upload da base com NCMs e MVAs (Excel, CSV ou Parquet)")
         produto_file = st.file_uploader(
             "Arraste ou clique para upload",
-            type=['xlsx', 'xls'],
+            type=['xlsx', 'xls', 'csv', 'parquet'],
             key='produtos',
-            help="Arquivo Excel com colunas: NCM (ou Capitulo+Item), MVA, Alíquota ICMS"
+            help="Colunas: NCM (ou Capitulo+Item), MVA, Alíquota ICMS; o cabeçalho pode estar em qualquer das "
+                 "primeiras linhas. Bases grandes carregam mais rápido em CSV ou Parquet"
         )
         
         if produto_file:
@@ -1039,13 +4872,13 @@ def main():
     
     with col2:
         st.markdown("### 📄 Arquivos SPED")
-        st.markdown("Upload dos arquivos SPED Contribuições (.txt)")
+        st.markdown("Upload dos arquivos SPED Contribuições (.txt, .zip ou .gz)")
         sped_files = st.file_uploader(
             "Arraste ou clique para upload",
-            type=['txt'],
+            type=['txt', 'zip', 'gz'],
             accept_multiple_files=True,
             key='sped',
-            help="Arquivos SPED Contribuições no formato TXT"
+            help="Arquivos SPED Contribuições em TXT, ou compactados em ZIP (vários meses por arquivo) / GZIP"
         )
         
         if sped_files:
@@ -1070,299 +4903,363 @@ def main():
     # Processamento
     if process_btn and produto_file and sped_files:
         
+        execution_config = get_execution_config()
+        pool_enabled = bool(execution_config['process_pool'])
+        
+        # Índice do lote a partir do 0000 de cada arquivo, antes de qualquer leitura completa
+        batch_entries, rejected_entries = build_batch_index(expand_uploads(sped_files))
+        
+        if rejected_entries:
+            st.warning(f"⚠️ {len(rejected_entries)} arquivo(s) fora do processamento:")
+            st.dataframe(pd.DataFrame([{
+                'Arquivo': e.name,
+                'Origem': e.file.origin,
+                'Período': f'{e.month}/{e.year}',
+                'CNPJ': e.header.cnpj if e.header else '',
+                'Motivo': e.reason
+            } for e in rejected_entries]), use_container_width=True, hide_index=True)
+        
+        if not batch_entries:
+            st.error("Nenhum arquivo SPED válido para processar.")
+            return
+        
+        profiler = SamplingProfiler() if profile_run else None
+        if profiler:
+            profiler.start('lote')
+        
         with st.spinner("Carregando base de produtos..."):
-            df_produtos = pd.read_excel(produto_file)
             product_base = ProductBaseLoader()
-            ncm_count = product_base.load_dataframe(df_produtos)
+            ncm_count = product_base.load_file(produto_file)
+        
+        if product_base.temporal:
+            st.info(f"📊 Base carregada: **{ncm_count:,}** regras de MVA por NCM, UF e vigência")
+        else:
+            st.info(f"📊 Base carregada: **{ncm_count:,}** NCMs com MVA")
         
-        st.info(f"📊 Base carregada: **{ncm_count:,}** NCMs com MVA")
+        plan = plan_execution([e.file.size or 0 for e in batch_entries], os.cpu_count() or 1,
+                              int(execution_config['max_workers']), int(execution_config['memory_budget_mb']) * 2**20,
+                              execution_config['strategy'], pool_enabled)
+        if profiler:
+            # O amostrador só enxerga as threads deste processo
+            plan = ExecutionPlan('inline', 'perfil de execução ativo', overridden=True)
+        service = get_execution_service() if plan.strategy == 'pool' else None
+        metrics = get_metrics()
+        batch_started = time.perf_counter()
+        st.caption(f"🧭 Execução {plan.describe()}")
+        logger.info('[%s] plano de execução: %s', st.session_state.get('current_user') or 'anônimo', plan.describe())
         
-        # Ordenar arquivos por data
-        sorted_files = sorted(sped_files, key=lambda f: extract_month_year_from_filename(f.name))
+        # Arquivos já ordenados pelo período do registro 0000
+        sorted_files = [e.file for e in batch_entries]
         
         summaries: List[MonthSummary] = []
         all_results: Dict[str, List[CalculationResult]] = {}
-        sped_outputs: Dict[str, str] = {}
+        sped_outputs: Dict[str, bytes] = {}
         company_name = ""
         cnpj = ""
         
         progress_bar = st.progress(0)
         status_text = st.empty()
         
-        calculator = IcmsStCalculator(product_base, cfops_selecionados)
+        calculator = IcmsStCalculator(product_base, cfops_selecionados, registers=registros_selecionados)
+        scenario_evaluator = ScenarioEvaluator(scenarios, product_base, cfops_selecionados) if scenarios else None
+        scenario_results: Dict[str, List[MonthSummary]] = {s.name: [] for s in scenarios}
+        rollups = RollupAccumulator()
+        result_store = ResultStore(get_result_store_path()) if save_history else None
+        parquet_exporter = None
+        if export_parquet:
+            parquet_exporter = ParquetResultExporter(
+                tempfile.mkdtemp(prefix='icmsst_parquet_'),
+                include_skipped=parquet_include_skipped
+            )
         
-        for idx, sped_file in enumerate(sorted_files):
-            status_text.text(f"Processando arquivo {idx + 1} de {len(sorted_files)}...")
-
-            # Parse SPED
-            content = sped_file.read().decode('latin-1')
-            parser = SpedParser()
-            parser.load_content(content)
-
-            # Extrair mês/ano do header do SPED (mais confiável que o nome do arquivo)
-            month, year = extract_month_year(sped_file.name, parser.header)
-            month_name = MONTH_NAMES.get(month, month)
-
-            status_text.text(f"Processando {month_name}/{year}...")
-
-            if parser.header and not company_name:
-                company_name = parser.header.nome
-                cnpj = parser.header.cnpj
-            
-            # Calcular
-            results: List[CalculationResult] = []
-            for record in parser.get_c870_records():
-                ncm = parser.get_ncm_for_item(record.cod_item)
-                result = calculator.calculate(record, ncm)
-                results.append(result)
-            
-            # Estatísticas
-            calculated = [r for r in results if r.status == 'calculated']
-            skipped = [r for r in results if r.status == 'skipped']
-            
-            pis_orig = sum(r.vl_pis_orig for r in calculated)
-            pis_new = sum(r.vl_pis_new for r in calculated)
-            cofins_orig = sum(r.vl_cofins_orig for r in calculated)
-            cofins_new = sum(r.vl_cofins_new for r in calculated)
-            
-            pis_credit = pis_orig - pis_new
-            cofins_credit = cofins_orig - cofins_new
-            total_credit = pis_credit + cofins_credit
-            
-            total_original = pis_orig + cofins_orig
-            savings_pct = (total_credit / total_original * 100) if total_original > 0 else Decimal('0')
-            
-            summary = MonthSummary(
-                month=month,
-                year=year,
-                month_name=month_name,
-                total_records=len(results),
-                total_calculated=len(calculated),
-                total_skipped=len(skipped),
-                pis_original=pis_orig,
-                pis_adjusted=pis_new,
-                pis_credit=pis_credit,
-                cofins_original=cofins_orig,
-                cofins_adjusted=cofins_new,
-                cofins_credit=cofins_credit,
-                total_credit=total_credit,
-                savings_percentage=savings_pct.quantize(Decimal('0.01'), ROUND_HALF_UP) if isinstance(savings_pct, Decimal) else Decimal('0')
+        checkpoints = None
+        resumed_count = 0
+        if use_checkpoints:
+            checkpoints = BatchCheckpoint(
+                get_checkpoint_dir(),
+                BatchCheckpoint.config_fingerprint(product_base, cfops_selecionados, scenarios,
+                                                   registros_selecionados)
             )
-            
-            summaries.append(summary)
-            
-            sheet_name = f'{month_name[:3]}_{year}'
-            all_results[sheet_name] = results
-            
-            # Gerar SPED retificado
-            writer = SpedWriter(parser, results)
-            sped_outputs[f'SPED_RETIFICADO_{month}_{year}.txt'] = writer.generate()
-            
-            progress_bar.progress((idx + 1) / len(sorted_files))
+            checkpoints.prune()
         
-        status_text.text("✅ Processamento concluído!")
-        progress_bar.progress(1.0)
+        # Mesmo lote (conteúdo dos arquivos, CFOPs e cenários) já processado nesta sessão:
+        # só as linhas dos NCMs alterados na base são recalculadas
+        patched_by_idx: Dict[int, ProcessedMonth] = {}
+        batch_signature = None
+        if keep_batch:
+            batch_signature = (
+                tuple(e.file.content_hash() for e in batch_entries),
+                tuple(sorted(cfops_selecionados)),
+                tuple(astuple(s) for s in scenarios),
+                registros_selecionados
+            )
+            incremental = st.session_state.get('incremental_batch')
+            if incremental is not None and incremental.signature == batch_signature:
+                with st.spinner("Aplicando alterações da base de produtos..."):
+                    ncms_changed, lines_recomputed, months_changed = incremental.apply_product_base(
+                        product_base, sorted_files)
+                st.info(f"🔁 Mesmo lote da última execução: {ncms_changed:,} NCM(s) alterado(s) na base, "
+                        f"{lines_recomputed:,} linha(s) recalculada(s) em {months_changed} mês(es)")
+                for idx, processed in enumerate(incremental.months):
+                    if ncms_changed:
+                        # Resultado novo para a nova configuração (grava checkpoint, se ativo)
+                        processed.resumed = False
+                    patched_by_idx[idx] = processed
+        else:
+            st.session_state.pop('incremental_batch', None)
+        batch_months: List[ProcessedMonth] = []
         
-        st.markdown("---")
+        # Meses já em checkpoint; os demais vão para o pool compartilhado (ou rodam na sessão)
+        processed_by_idx: Dict[int, ProcessedMonth] = {}
+        checkpoint_keys: Dict[int, str] = {}
+        pending: Dict[int, Future] = {}
+        current_user = st.session_state.get('current_user') or 'anônimo'
         
-        # Resultados
-        st.markdown("## 📊 Resultados")
+        # Progresso do lote ponderado pelo tamanho de cada arquivo; tarefas do pool informam o seu por arquivo JSON
+        batch_progress = BatchProgress({idx: e.file.size for idx, e in enumerate(batch_entries)})
+        progress_paths: Dict[int, str] = {}
+        product_table_path: Optional[str] = None
         
-        # Métricas principais
-        total_credit = sum(s.total_credit for s in summaries)
-        total_records = sum(s.total_records for s in summaries)
-        total_calculated = sum(s.total_calculated for s in summaries)
-        total_pis = sum(s.pis_credit for s in summaries)
-        total_cofins = sum(s.cofins_credit for s in summaries)
+        def show_progress(month_label: str, snapshot: Optional[Dict]) -> None:
+            batch_snapshot = batch_progress.snapshot()
+            line = format_file_progress(f'📄 {month_label}', snapshot) if snapshot else f'📄 {month_label}'
+            status_text.text(f"{line} · lote {batch_snapshot['fraction']:.0%}, "
+                             f"ETA {format_duration(batch_snapshot['eta'])}")
+            progress_bar.progress(min(1.0, batch_snapshot['fraction']))
         
-        col1, col2, col3, col4 = st.columns(4)
+        # Pool de processos compartilhado entre as sessões: só então os uploads vão para disco, para os workers
+        spool_dir = None
+        if service:
+            spool_dir = tempfile.mkdtemp(prefix='icmsst_spool_')
+        try:
+            if spool_dir:
+                spool_sources([e.file for e in batch_entries], spool_dir)
+            for idx, entry in enumerate(batch_entries):
+                if checkpoints:
+                    checkpoint_keys[idx] = checkpoints.key_for(entry.file)
+                if idx in patched_by_idx:
+                    continue
+                if checkpoints:
+                    processed = checkpoints.load(checkpoint_keys[idx])
+                    metrics.inc('icmsst_cache_requests_total', cache='checkpoint', result='hit' if processed else 'miss')
+                    if processed:
+                        processed_by_idx[idx] = processed
+                        continue
+                if service:
+                    if product_table_path is None:
+                        # Base compilada uma vez por lote; as tarefas mapeiam o arquivo em vez de recebê-la por pickle
+                        product_table_path = os.path.join(spool_dir, 'produtos.tbl')
+                        ProductTable.write(product_base.products_by_ncm, product_table_path)
+                    progress_paths[idx] = os.path.join(spool_dir, f'progress_{idx:04d}.json')
+                    pending[idx] = service.submit(
+                        current_user, 'run_file_task',
+                        (entry.file.to_spec(), product_table_path, sorted(cfops_selecionados),
+                         tuple(astuple(s) for s in scenarios), progress_paths[idx], registros_selecionados),
+                        estimated_bytes=(entry.file.size or 0) * TASK_MEMORY_FACTOR
+                    )
+            
+            for idx, entry in enumerate(batch_entries):
+                month_label = f'{MONTH_NAMES.get(entry.month, entry.month)}/{entry.year}'
+                show_progress(month_label, None)
+                
+                processed = processed_by_idx.pop(idx, None)
+                origin = 'calculado'
+                if processed:
+                    batch_progress.skip(idx)
+                    replay_month(processed, rollups, parquet_exporter, cnpj)
+                    resumed_count += 1
+                    origin = 'checkpoint'
+                elif idx in patched_by_idx:
+                    batch_progress.skip(idx)
+                    processed = patched_by_idx[idx]
+                    replay_month(processed, rollups, parquet_exporter, cnpj)
+                    origin = 'incremental'
+                elif idx in pending:
+                    future = pending.pop(idx)
+                    while not future.done():
+                        # Arquivos seguintes também podem estar rodando em outros processos do pool
+                        for other_idx in [idx, *pending]:
+                            snapshot = read_progress_file(progress_paths[other_idx])
+                            if snapshot:
+                                batch_progress.update(other_idx, snapshot['fraction'])
+                        position = service.queue_position(future)
+                        if position is not None:
+                            stats = service.stats()
+                            status_text.text(f"⏳ {month_label}: posição {position} na fila do servidor "
+                                             f"({stats['running']} em execução)...")
+                        else:
+                            show_progress(month_label, read_progress_file(progress_paths[idx]))
+                        wait([future], timeout=0.5)
+                    processed = decode_processed_month(future.result())
+                    replay_month(processed, rollups, parquet_exporter, cnpj)
+                else:
+                    def on_progress(snapshot: Dict, idx: int = idx, month_label: str = month_label) -> None:
+                        batch_progress.update(idx, snapshot['fraction'])
+                        show_progress(month_label, snapshot)
+                    
+                    processed = process_sped_source(entry.file, calculator, rollups, parquet_exporter, cnpj,
+                                                    scenario_evaluator, FileProgress(entry.name, entry.file.size,
+                                                                                     on_progress))
+                
+                if checkpoints and not processed.resumed:
+                    checkpoints.save(checkpoint_keys[idx], processed)
+                record_processed_month(metrics, processed, origin)
+                
+                if processed.header and not company_name:
+                    company_name = processed.header.nome
+                    cnpj = processed.header.cnpj
+                
+                batch_months.append(processed)
+                summaries.append(processed.summary)
+                for name, month_summaries in scenario_results.items():
+                    month_summaries.append(processed.scenario_summaries[name])
+                
+                if result_store:
+                    result_store.save_month(
+                        processed.header.cnpj if processed.header else cnpj, processed.summary, processed.results,
+                        processed.header.nome if processed.header else company_name, cfops_selecionados
+                    )
+                
+                all_results[processed.sheet_name] = processed.results
+                sped_outputs[processed.sped_filename] = processed.sped_output
+                
+                batch_progress.update(idx, 1.0)
+                show_progress(month_label, None)
+        finally:
+            if service:
+                # Sessão interrompida: libera a fila para os demais usuários
+                service.cancel(list(pending.values()))
+            if spool_dir:
+                shutil.rmtree(spool_dir, ignore_errors=True)
+            if profiler:
+                profiler.stop()
         
-        with col1:
-            st.metric(
-                label="💰 Crédito Total",
-                value=f"R$ {float(total_credit):,.2f}",
-                delta=f"{(total_calculated/total_records*100):.1f}% aproveitamento"
-            )
+        if keep_batch:
+            st.session_state['incremental_batch'] = IncrementalBatch(
+                batch_signature, batch_months, product_base.products_by_ncm, cfops_selecionados, scenarios)
+        else:
+            # Opção desligada: o lote anterior não fica ocupando memória na sessão
+            st.session_state.pop('incremental_batch', None)
         
-        with col2:
-            st.metric(
-                label="📄 Registros",
-                value=f"{total_records:,}",
-                delta=f"{total_calculated:,} calculados"
-            )
+        if resumed_count:
+            st.info(f"♻️ {resumed_count} mês(es) recuperado(s) de checkpoint, sem reprocessamento")
         
-        with col3:
-            st.metric(
-                label="🔵 Crédito PIS",
-                value=f"R$ {float(total_pis):,.2f}"
-            )
+        if parquet_exporter:
+            parquet_exporter.close()
+        if result_store:
+            result_store.close()
         
-        with col4:
-            st.metric(
-                label="🟢 Crédito COFINS",
-                value=f"R$ {float(total_cofins):,.2f}"
-            )
+        status_text.text("✅ Processamento concluído!")
+        progress_bar.progress(1.0)
+        metrics.observe('icmsst_batch_duration_seconds', time.perf_counter() - batch_started, strategy=plan.strategy)
         
-        # Empresa
-        st.markdown(f"""
-        **Empresa:** {company_name}  
-        **CNPJ:** {cnpj}  
-        **Período:** {summaries[0].month_name}/{summaries[0].year} a {summaries[-1].month_name}/{summaries[-1].year}
-        """)
+        memo_stats = calculator.memo_stats()
+        if memo_stats.get('hits'):
+            st.caption(f"Memo de cálculo: {memo_stats['hit_rate']:.0%} das linhas calculadas reaproveitaram "
+                       f"uma combinação de valores já calculada")
+        if profiler:
+            st.caption(f"🔬 Perfil: {profiler.samples:,} amostras em {profiler.phase_seconds.get('lote', 0):.1f}s; "
+                       f"o ZIP completo traz o flamegraph e as funções mais lentas em PERFIL/")
         
-        # Tabela detalhada
-        st.markdown("### 📅 Detalhamento Mensal")
-        
-        df_summary = pd.DataFrame([{
-            'Mês/Ano': f'{s.month_name}/{s.year}',
-            'Registros': s.total_records,
-            'Calculados': s.total_calculated,
-            'Crédito PIS': f'R$ {float(s.pis_credit):,.2f}',
-            'Crédito COFINS': f'R$ {float(s.cofins_credit):,.2f}',
-            'Crédito Total': f'R$ {float(s.total_credit):,.2f}'
-        } for s in summaries])
-        
-        st.dataframe(df_summary, use_container_width=True, hide_index=True)
-        
-        # Downloads
-        st.markdown("### 📥 Downloads")
-
-        # Chave única para identificar este processamento (baseada nos arquivos e CFOPs)
-        cache_key = f"downloads_{hash(tuple(sorted([f.name for f in sorted_files])) + tuple(sorted(cfops_selecionados)))}"
-
-        # Verificar se já temos os arquivos em cache ou se precisa gerar
-        if cache_key not in st.session_state:
-            with st.spinner("Gerando arquivos para download..."):
-                # Excel
-                excel_data = generate_excel(all_results, summaries)
-
-                # PDF
-                pdf_data = generate_pdf(summaries, company_name, cnpj)
-
-                # ZIP com SPEDs
-                zip_buffer = io.BytesIO()
-                with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                    for filename, content in sped_outputs.items():
-                        zip_file.writestr(filename, content.encode('latin-1'))
-                zip_buffer.seek(0)
-                zip_data = zip_buffer.getvalue()
-
-                # JSON para API
-                json_data = {
-                    'empresa': company_name,
-                    'cnpj': cnpj,
-                    'periodo': f'{summaries[0].month_name}/{summaries[0].year} a {summaries[-1].month_name}/{summaries[-1].year}',
-                    'processado_em': datetime.now().isoformat(),
-                    'cfops_utilizados': list(cfops_selecionados),
-                    'total_registros': total_records,
-                    'total_calculados': total_calculated,
-                    'credito_pis': float(total_pis),
-                    'credito_cofins': float(total_cofins),
-                    'credito_total': float(total_credit),
-                    'meses': [
-                        {
-                            'mes': s.month_name,
-                            'ano': s.year,
-                            'registros': s.total_records,
-                            'calculados': s.total_calculated,
-                            'credito_pis': float(s.pis_credit),
-                            'credito_cofins': float(s.cofins_credit),
-                            'credito_total': float(s.total_credit)
-                        }
-                        for s in summaries
-                    ]
-                }
-                json_str = json.dumps(json_data, ensure_ascii=False, indent=2)
-
-                # ZIP completo com todos os arquivos
-                primeiro_arquivo = sorted_files[0].name
-                nome_base = primeiro_arquivo.rsplit('.', 1)[0] if '.' in primeiro_arquivo else primeiro_arquivo
-                nome_zip = f"{nome_base}.zip"
-
-                all_files_buffer = io.BytesIO()
-                with zipfile.ZipFile(all_files_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_all:
-                    zip_all.writestr("DE_PARA_CONSOLIDADO.xlsx", excel_data)
-                    zip_all.writestr("RELATORIO_CONSOLIDADO.pdf", pdf_data)
-                    zip_all.writestr("resumo_consolidado.json", json_str)
-                    for filename, content in sped_outputs.items():
-                        zip_all.writestr(f"SPEDS_RETIFICADOS/{filename}", content.encode('latin-1'))
-                all_files_buffer.seek(0)
-                all_files_data = all_files_buffer.getvalue()
-
-                # Armazenar no session_state
-                st.session_state[cache_key] = {
-                    'excel_data': excel_data,
-                    'pdf_data': pdf_data,
-                    'zip_data': zip_data,
-                    'json_data': json_data,
-                    'json_str': json_str,
-                    'all_files_data': all_files_data,
-                    'nome_zip': nome_zip
-                }
-
-            st.success("Arquivos gerados com sucesso!")
-        else:
-            # Recuperar do cache
-            cached = st.session_state[cache_key]
-            excel_data = cached['excel_data']
-            pdf_data = cached['pdf_data']
-            zip_data = cached['zip_data']
-            json_data = cached['json_data']
-            json_str = cached['json_str']
-            all_files_data = cached['all_files_data']
-            nome_zip = cached['nome_zip']
-
-        col_dl1, col_dl2, col_dl3 = st.columns(3)
-
-        with col_dl1:
-            st.download_button(
-                label="📊 Download Excel (De/Para)",
-                data=excel_data,
-                file_name="DE_PARA_CONSOLIDADO.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                use_container_width=True
-            )
+        # Nome do ZIP completo a partir do primeiro arquivo do lote
+        primeiro_arquivo = Path(sorted_files[0].name).name
+        nome_base = primeiro_arquivo.rsplit('.', 1)[0] if '.' in primeiro_arquivo else primeiro_arquivo
+        
+        previous_batch = st.session_state.get('batch_artifacts')
+        if previous_batch is not None:
+            previous_batch.cleanup()
+        st.session_state['batch_artifacts'] = BatchArtifacts(
+            summaries, all_results, sped_outputs, company_name, cnpj, cfops_selecionados, rollups,
+            scenario_results, split_by_month=excel_split_by_month, parquet_exporter=parquet_exporter,
+            zip_name=f"{nome_base}.zip", metrics=metrics, profiler=profiler
+        )
+    
+    # Resultados ficam na sessão: continuam visíveis ao preparar ou baixar arquivos
+    batch_artifacts = st.session_state.get('batch_artifacts')
+    if batch_artifacts is not None:
+        render_batch_results(batch_artifacts)
 
-        with col_dl2:
-            st.download_button(
-                label="📄 Download PDF (Relatório)",
-                data=pdf_data,
-                file_name="RELATORIO_CONSOLIDADO.pdf",
-                mime="application/pdf",
-                use_container_width=True
-            )
 
-        with col_dl3:
-            st.download_button(
-                label="📦 Download SPEDs Retificados",
-                data=zip_data,
-                file_name="SPEDS_RETIFICADOS.zip",
-                mime="application/zip",
-                use_container_width=True
-            )
+# =============================================================================
+# LINHA DE COMANDO
+# =============================================================================
 
-        with st.expander("🔧 JSON para Integração"):
-            st.json(json_data)
-            st.download_button(
-                label="Download JSON",
-                data=json_str,
-                file_name="resumo_consolidado.json",
-                mime="application/json"
-            )
+CLI_COMMANDS = ('spool-submit', 'spool-worker', 'spool-status', 'spool-merge')
 
-        # Download de todos os arquivos em um único ZIP
-        st.markdown("---")
-        st.markdown("### 📦 Download Completo")
 
-        st.download_button(
-            label="⬇️ Download Todos os Arquivos (ZIP)",
-            data=all_files_data,
-            file_name=nome_zip,
-            mime="application/zip",
-            use_container_width=True,
-            type="primary"
-        )
+def cli_main(argv: List[str]) -> int:
+    """Modo sem interface: fila distribuída em diretório compartilhado"""
+    parser = argparse.ArgumentParser(prog='python app.py', description='OmniAI Fiscal - processamento em lote')
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    submit = commands.add_parser('spool-submit', help='Enfileira um lote (um cliente) no spool')
+    submit.add_argument('--spool', required=True)
+    submit.add_argument('--base', required=True, help='Base de produtos (Excel, CSV ou Parquet)')
+    submit.add_argument('--cfop', action='append', help='CFOP elegível (repetível; padrão: 5405)')
+    submit.add_argument('--registro', action='append', choices=sorted(SALES_REGISTERS),
+                        help='Registro de receita calculado (repetível; padrão: C870)')
+    submit.add_argument('speds', nargs='+', help='Arquivos SPED (.txt, .zip ou .gz)')
+    
+    worker = commands.add_parser('spool-worker', help='Processa jobs do spool')
+    worker.add_argument('--spool', required=True)
+    worker.add_argument('--processes', type=int, default=1, help='Workers neste nó')
+    worker.add_argument('--once', action='store_true', help='Sai quando não houver jobs pendentes')
+    worker.add_argument('--poll', type=float, default=5, help='Intervalo de consulta da fila (s)')
+    worker.add_argument('--stale-after', type=int, default=SpoolQueue.STALE_AFTER_SECONDS,
+                        help='Segundos sem sinal de vida até um job voltar para a fila')
+    worker.add_argument('--metricas', metavar='DIR',
+                        help='Diretório do textfile collector: um arquivo .prom por worker, regravado a cada job')
+    
+    status = commands.add_parser('spool-status', help='Situação dos jobs de um lote')
+    status.add_argument('--spool', required=True)
+    status.add_argument('--batch', required=True)
+    
+    merge = commands.add_parser('spool-merge', help='Consolida os meses concluídos de um lote')
+    merge.add_argument('--spool', required=True)
+    merge.add_argument('--batch', required=True)
+    merge.add_argument('--parcial', action='store_true', help='Consolida mesmo com jobs pendentes ou com falha')
+    merge.add_argument('--por-mes', action='store_true', help='De/Para em um arquivo Excel por mês')
+    
+    args = parser.parse_args(argv)
+    setup_logging()
+    
+    if args.command == 'spool-submit':
+        batch_id, rejected = SpoolQueue(args.spool).submit_batch(args.speds, args.base, set(args.cfop or ['5405']),
+                                                                 tuple(args.registro or DEFAULT_REGISTERS))
+        for entry in rejected:
+            logger.warning('Ignorado: %s (%s)', entry.name, entry.reason)
+        print(batch_id)
+        return 0
+    
+    if args.command == 'spool-worker':
+        if args.processes <= 1:
+            run_spool_worker(args.spool, args.once, args.poll, args.stale_after, args.metricas)
+            return 0
+        context = multiprocessing.get_context('spawn')
+        workers = [context.Process(target=run_spool_worker,
+                                   args=(args.spool, args.once, args.poll, args.stale_after, args.metricas))
+                   for _ in range(args.processes)]
+        for process in workers:
+            process.start()
+        for process in workers:
+            process.join()
+        return 0
+    
+    queue = SpoolQueue(args.spool)
+    counts = queue.batch_status(args.batch)
+    if args.command == 'spool-status':
+        print(' '.join(f'{state}={count}' for state, count in counts.items()))
+        return 0
+    
+    if (counts['pending'] or counts['running'] or counts['failed']) and not args.parcial:
+        print(f"Lote incompleto ({' '.join(f'{s}={c}' for s, c in counts.items())}); "
+              f"use --parcial para consolidar assim mesmo", file=sys.stderr)
+        return 1
+    print(queue.merge_batch(args.batch, split_by_month=args.por_mes))
+    return 0
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS:
+        sys.exit(cli_main(sys.argv[1:]))
     main()
@@ -0,0 +1,64 @@
+"""
+Benchmark do memo de cálculo do IcmsStCalculator.
+
+Gera um SPED sintético com formato de varejo, calcula todas as linhas sem e
+com memo, confere que os resultados são idênticos e mostra a taxa de acerto
+e o ganho de tempo (melhor de N execuções alternadas, para reduzir ruído).
+
+Uso: python scripts/benchmark_memo.py [--linhas 300000] [--itens 3000] [--memo 65536] [--repeticoes 3]
+"""
+
+import argparse
+import io
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app import IcmsStCalculator, ProductBaseLoader, SpedParser  # noqa: E402
+from synthetic_sped import make_product_base, make_sped  # noqa: E402
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--linhas', type=int, default=300000)
+    parser.add_argument('--itens', type=int, default=3000)
+    parser.add_argument('--memo', type=int, default=IcmsStCalculator.MEMO_SIZE)
+    parser.add_argument('--repeticoes', type=int, default=3)
+    args = parser.parse_args()
+
+    content, ncms = make_sped(n_items=args.itens, n_lines=args.linhas)
+    product_base = ProductBaseLoader()
+    product_base.load_dataframe(make_product_base(ncms))
+
+    sped = SpedParser()
+    sped.load_stream(io.BytesIO(content))
+    records = [(record, sped.get_ncm_for_item(record.cod_item)) for record in sped.get_records()]
+
+    timings = {0: float('inf'), args.memo: float('inf')}
+    results = {}
+    for _ in range(args.repeticoes):
+        for memo_size in (0, args.memo):
+            calculator = IcmsStCalculator(product_base, {'5405'}, memo_size=memo_size)
+            start = time.perf_counter()
+            results[memo_size] = [calculator.calculate(record, ncm) for record, ncm in records]
+            timings[memo_size] = min(timings[memo_size], time.perf_counter() - start)
+            if memo_size:
+                stats = calculator.memo_stats()
+
+    if results[0] != results[args.memo]:
+        print('ERRO: resultados com e sem memo diferem', file=sys.stderr)
+        return 1
+
+    print(f"Linhas C870: {len(records):,}")
+    print(f"Sem memo:    {timings[0]:.2f}s")
+    print(f"Com memo:    {timings[args.memo]:.2f}s (memo de {args.memo:,} entradas)")
+    print(f"Acertos:     {stats['hits']:,} de {stats['hits'] + stats['misses']:,} "
+          f"({stats['hit_rate']:.1%}), {stats['size']:,} entradas em uso")
+    print(f"Ganho:       {timings[0] / timings[args.memo]:.2f}x")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,282 @@
+"""
+Verificação diferencial entre o motor de referência e motores alternativos.
+
+O motor de referência é a versão original do app, congelada em
+``reference_engine.py``: não depende do código atual, então uma mudança no
+motor não passa despercebida por mudar também a referência. Cada motor
+recebe o mesmo SPED gerado com casos de borda — arredondamento em meio
+centavo, base negativa zerada, campos vazios, linhas malformadas e linhas
+com campos a mais — e tem que devolver os mesmos resultados, campo a campo
+(inclusive status e motivo), e o mesmo SPED retificado linha a linha. A
+referência perde o ``\r`` das linhas recalculadas; o terminador de cada
+linha é conferido contra o SPED de entrada. O relatório mostra, por campo,
+a primeira linha divergente e o tempo de cada motor (melhor de N execuções)
+em relação à referência.
+
+Motores embutidos: memo (memo de cálculo), tabela (base compilada de
+``ProductTable``) e pipeline (``process_sped_source``). Outros motores são
+funções ``motor(conteudo, base, cfops) -> (resultados, sped)``, informadas
+como ``pacote.modulo:funcao``.
+
+Uso: python scripts/differential.py [--linhas 20000] [--semente 1] [--repeticoes 3] [--motor modulo:funcao]
+"""
+
+import argparse
+import importlib
+import io
+import random
+import sys
+import time
+from collections import Counter
+from dataclasses import fields
+from decimal import ROUND_HALF_UP, Decimal
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import reference_engine  # noqa: E402
+from app import (CalculationResult, IcmsStCalculator, ProductBaseLoader, ProductTable,  # noqa: E402
+                 SpedParser, SpedSource, SpedWriter, process_sped_source)
+from synthetic_sped import fmt_decimal  # noqa: E402
+
+Engine = Callable[[bytes, ProductBaseLoader, set], Tuple[List[CalculationResult], bytes]]
+
+CFOPS = {'5405', '5403'}
+CENT = Decimal('0.01')
+
+# Categoria -> peso na geração das linhas
+CATEGORIES = [
+    ('normal', 40),
+    ('meio centavo', 15),
+    ('base negativa', 8),
+    ('campos vazios', 8),
+    ('malformada', 8),
+    ('campos extras', 6),
+    ('sem cálculo', 15),
+]
+
+# (MVA, alíquota ICMS) dos NCMs da base; MVA 600 com 18% zera a base (exclusão > 100%)
+NCM_RULES = [
+    ('22021000', '50', '18'),
+    ('22030000', '41,0823', '18'),
+    ('21069010', '35,5', '12'),
+    ('33051000', '70', '25'),
+    ('34011190', '46,17', '17,5'),
+    ('40111000', '600', '18'),
+    ('85065010', '0', '18'),
+]
+NEGATIVE_NCM = '40111000'
+ZERO_MVA_NCM = '85065010'
+MISSING_NCM = '96032100'
+
+
+def memo_engine(content: bytes, product_base: ProductBaseLoader, cfops: set) -> Tuple[List[CalculationResult], bytes]:
+    parser = SpedParser()
+    parser.load_stream(io.BytesIO(content))
+    calculator = IcmsStCalculator(product_base, cfops)
+    results = [calculator.calculate(record, parser.get_ncm_for_item(record.cod_item))
+               for record in parser.get_records()]
+    return results, SpedWriter(parser, results).generate(io.BytesIO(content))
+
+
+def table_engine(content: bytes, product_base: ProductBaseLoader, cfops: set) -> Tuple[List[CalculationResult], bytes]:
+    table = ProductTable(ProductTable.compile(product_base.products_by_ncm))
+    return memo_engine(content, table, cfops)
+
+
+def pipeline_engine(content: bytes, product_base: ProductBaseLoader, cfops: set) -> Tuple[List[CalculationResult], bytes]:
+    processed = process_sped_source(SpedSource('SPED_01_2024.txt', data=content),
+                                    IcmsStCalculator(product_base, cfops))
+    return processed.results, processed.sped_output
+
+
+BUILTIN_ENGINES: Dict[str, Engine] = {
+    'memo': memo_engine,
+    'tabela': table_engine,
+    'pipeline': pipeline_engine,
+}
+
+
+def load_engine(spec: str) -> Tuple[str, Engine]:
+    if spec in BUILTIN_ENGINES:
+        return spec, BUILTIN_ENGINES[spec]
+    module_name, _, function_name = spec.partition(':')
+    if not function_name:
+        raise SystemExit(f'Motor inválido: {spec} (use pacote.modulo:funcao)')
+    return spec, getattr(importlib.import_module(module_name), function_name)
+
+
+def _half_cent_base(rnd: random.Random, mva: Decimal, aliq: Decimal) -> Decimal:
+    """Base cuja nova BC (ou novo PIS a 1,65%) cai exatamente em meio centavo, quando houver"""
+    factor = mva / 100 * aliq / 100
+    for _ in range(2000):
+        bc = Decimal(rnd.randrange(1, 100000)) / 100
+        new_bc = bc - bc * factor
+        if (new_bc * 100) % 1 == Decimal('0.5'):
+            return bc
+        rounded = new_bc.quantize(CENT, ROUND_HALF_UP)
+        if rounded > 0 and (rounded * Decimal('1.65')) % 1 == Decimal('0.5'):
+            return bc
+    return bc
+
+
+def _c870(item: str, cfop: str, bc: str, vl_pis: str = '0,00', vl_cofins: str = '0,00',
+          aliq_pis: str = '1,6500', aliq_cofins: str = '7,6000') -> List[str]:
+    return ['C870', item, cfop, bc, '0', '01', bc, aliq_pis, vl_pis, '01', bc, aliq_cofins, vl_cofins, '3.01.01']
+
+
+def make_edge_case_sped(n_lines: int, seed: int) -> Tuple[bytes, pd.DataFrame, Counter]:
+    """SPED com linhas de todas as categorias; devolve (conteúdo, base de produtos, linhas por categoria)"""
+    rnd = random.Random(seed)
+    rules = {ncm: (Decimal(mva.replace(',', '.')), Decimal(aliq.replace(',', '.'))) for ncm, mva, aliq in NCM_RULES}
+    regular_ncms = [ncm for ncm in rules if ncm not in (NEGATIVE_NCM, ZERO_MVA_NCM)]
+    items = {f'IT{ncm}': ncm for ncm in [*rules, MISSING_NCM]}
+    names, weights = zip(*CATEGORIES)
+
+    lines = ['|0000|006|0|||01012024|31012024|EMPRESA DIFERENCIAL LTDA|12345678000199|SP|3550308||0|1|',
+             '|0001|0|']
+    lines += [f'|0200|{item}|PRODUTO {ncm}||||00|{ncm}||{ncm[:2]}||18,00|' for item, ncm in items.items()]
+    lines.append('|C001|0|')
+
+    counts: Counter = Counter()
+    for _ in range(n_lines):
+        category = rnd.choices(names, weights=weights)[0]
+        counts[category] += 1
+        ncm = rnd.choice(regular_ncms)
+        bc = Decimal(rnd.randrange(1, 500000)) / 100
+        if category == 'meio centavo':
+            bc = _half_cent_base(rnd, *rules[ncm])
+        elif category == 'base negativa':
+            ncm = NEGATIVE_NCM
+        cfop = rnd.choice(sorted(CFOPS))
+        item = f'IT{ncm}'
+        if category == 'sem cálculo':
+            # CFOP não elegível, MVA zero, NCM fora da base ou item sem 0200
+            reason = rnd.randrange(4)
+            if reason == 0:
+                cfop = '5102'
+            elif reason == 1:
+                item = f'IT{ZERO_MVA_NCM}'
+            elif reason == 2:
+                item = f'IT{MISSING_NCM}'
+            else:
+                item = 'ITEM_SEM_0200'
+        vl_pis = fmt_decimal((bc * Decimal('1.65') / 100).quantize(CENT))
+        vl_cofins = fmt_decimal((bc * Decimal('7.6') / 100).quantize(CENT))
+        fields_ = _c870(item, cfop, fmt_decimal(bc), vl_pis, vl_cofins)
+
+        if category == 'campos vazios':
+            for position in rnd.sample((3, 4, 6, 7, 8, 10, 11, 12, 13), rnd.randint(1, 3)):
+                fields_[position] = rnd.choice(('', ' '))
+        elif category == 'campos extras':
+            fields_ += [rnd.choice(('', 'X', '0,00')) for _ in range(rnd.randint(1, 4))]
+        elif category == 'malformada':
+            kind = rnd.randrange(6)
+            if kind == 0:
+                fields_ = fields_[:rnd.randint(1, 12)]
+            elif kind == 1:
+                fields_[rnd.choice((6, 7, 10, 11))] = rnd.choice(('abc', '1.234,56', '--1', '1,2,3'))
+            elif kind == 2:
+                fields_[6] = f' {fields_[6]} '
+            elif kind == 3:
+                fields_[6] = fields_[10] = '-' + fields_[6]
+            elif kind == 4:
+                lines.append('|' + '|'.join(fields_))
+                continue
+            else:
+                lines.append(rnd.choice(('|C870|', 'C870', '|C870||||||||||||||', '   ')))
+                continue
+        lines.append('|' + '|'.join(fields_) + '|')
+
+    lines.append(f'|C990|{n_lines + 2}|')
+    lines.append(f'|9999|{len(lines) + 1}|')
+    # Terminadores misturados: o SPED retificado tem que manter o de cada linha
+    content = ''.join(line + rnd.choice(('\r\n', '\r\n', '\n')) for line in lines).encode('latin-1')
+
+    base = pd.DataFrame([{'NCM': ncm, 'MVA': mva, 'MVA Ajustada': mva, 'Aliquota Entrada': aliq}
+                         for ncm, mva, aliq in NCM_RULES])
+    return content, base, counts
+
+
+def first_divergences(content: bytes, reference: tuple,
+                      candidate: Tuple[List[CalculationResult], bytes]) -> Dict[str, str]:
+    """Primeira divergência de cada campo dos resultados e do SPED retificado"""
+    divergences: Dict[str, str] = {}
+    ref_results, ref_sped = reference
+    results, sped = candidate
+    if len(ref_results) != len(results):
+        divergences['registros'] = f'referência {len(ref_results):,}, motor {len(results):,}'
+    # Campos do resultado original; os acrescentados depois (register) não têm referência
+    for ref_result, result in zip(ref_results, results):
+        for field in fields(reference_engine.CalculationResult):
+            if field.name in divergences:
+                continue
+            expected, actual = getattr(ref_result, field.name), getattr(result, field.name)
+            # Decimal('1.0') == Decimal('1.00'): a representação também tem que ser a mesma
+            if expected != actual or str(expected) != str(actual):
+                divergences[field.name] = f'linha {ref_result.line_number}: referência {expected!r}, motor {actual!r}'
+    ref_lines, lines = io.BytesIO(ref_sped).readlines(), io.BytesIO(sped).readlines()
+    input_lines = io.BytesIO(content).readlines()
+    for line_number, (expected, actual, original) in enumerate(zip(ref_lines, lines, input_lines), 1):
+        body = actual.rstrip(b'\r\n')
+        if body != expected.rstrip(b'\r\n'):
+            divergences['sped'] = f'linha {line_number}: referência {expected!r}, motor {actual!r}'
+            break
+        if actual[len(body):] != original[len(original.rstrip(b'\r\n')):]:
+            divergences['sped'] = f'linha {line_number}: terminador {actual[len(body):]!r} no lugar do original'
+            break
+    else:
+        if not len(ref_lines) == len(lines) == len(input_lines):
+            divergences['sped'] = f'referência {len(ref_lines):,} linhas, motor {len(lines):,}'
+    return divergences
+
+
+def timed(engine: Engine, args: tuple, repetitions: int) -> Tuple[float, Tuple[List[CalculationResult], bytes]]:
+    best = float('inf')
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        output = engine(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, output
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--linhas', type=int, default=20000)
+    parser.add_argument('--semente', type=int, default=1)
+    parser.add_argument('--repeticoes', type=int, default=3)
+    parser.add_argument('--motor', action='append',
+                        help='Motor a comparar (repetível): memo, tabela, pipeline ou pacote.modulo:funcao '
+                             '(padrão: os embutidos)')
+    args = parser.parse_args()
+
+    content, base_df, counts = make_edge_case_sped(args.linhas, args.semente)
+    product_base = ProductBaseLoader()
+    product_base.load_dataframe(base_df)
+    print(f"SPED gerado (semente {args.semente}): {args.linhas:,} linhas C870 — "
+          + ', '.join(f'{name} {counts[name]:,}' for name, _ in CATEGORIES))
+
+    engines = [load_engine(spec) for spec in (args.motor or BUILTIN_ENGINES)]
+    width = max(12, *(len(name) for name, _ in engines))
+    engine_args = (content, product_base, set(CFOPS))
+    ref_time, reference = timed(reference_engine.run, (content, base_df, set(CFOPS)), args.repeticoes)
+    calculated = sum(result.status == 'calculated' for result in reference[0])
+    print(f"{'referência':<{width}} {ref_time:8.3f}s          {calculated:,} de {len(reference[0]):,} linhas calculadas")
+
+    failed = False
+    for name, engine in engines:
+        elapsed, output = timed(engine, engine_args, args.repeticoes)
+        divergences = first_divergences(content, reference, output)
+        status = 'idêntico' if not divergences else f'{len(divergences)} campo(s) divergente(s)'
+        print(f"{name:<{width}} {elapsed:8.3f}s {ref_time / elapsed:6.2f}x  {status}")
+        for field_name, detail in divergences.items():
+            print(f"    {field_name}: {detail}")
+        failed = failed or bool(divergences)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,344 @@
+"""
+Teste de carga da interface com várias sessões autenticadas simultâneas.
+
+Cada sessão executa o app pelo AppTest do Streamlit, no mesmo processo e numa
+thread própria, como o servidor faz com as sessões reais: faz login pelo
+formulário com as credenciais do arquivo de secrets de teste, envia uma base
+de produtos e SPEDs sintéticos, clica em "PROCESSAR ARQUIVOS" e aciona os
+botões de download. Os níveis de concorrência rodam em sequência; em cada um
+são medidos os percentis de latência por etapa, a vazão (sessões/min) e o RSS
+e a CPU do processo e dos workers do pool. O ponto de saturação é o primeiro
+nível em que a vazão deixa de crescer ou o p95 do processamento passa do
+limite (--slo).
+
+Uso: python scripts/load_test.py [--sessoes 1,2,4,8] [--arquivos 3] [--linhas 20000]
+                                 [--artefatos pdf,excel] [--saida carga/]
+"""
+
+import argparse
+import csv
+import io
+import json
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+import tomllib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import streamlit as st
+from streamlit import config
+from streamlit.runtime.runtime import Runtime
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.runtime.secrets import Secrets
+from streamlit.testing.v1 import AppTest
+
+from synthetic_sped import make_product_base, make_sped
+
+APP_PATH = str(Path(__file__).resolve().parent.parent / 'app.py')
+
+
+class ResourceSampler(threading.Thread):
+    """Amostra RSS e CPU deste processo e dos seus filhos (workers do pool) pelo /proc"""
+
+    def __init__(self, interval: float = 0.5):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples: List[Dict] = []
+        self._stop_event = threading.Event()
+        self._page_size = os.sysconf('SC_PAGE_SIZE')
+        self._clock_ticks = os.sysconf('SC_CLK_TCK')
+
+    @staticmethod
+    def _stat(pid: int) -> Optional[List[str]]:
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                stat = f.read()
+        except OSError:
+            return None
+        # Campos após o nome do processo: estado, ppid, ... utime (11), stime (12), rss (21)
+        return stat[stat.rindex(')') + 2:].split()
+
+    def _process_tree(self) -> Dict[int, List[str]]:
+        stats = {}
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                fields = self._stat(int(entry))
+                if fields:
+                    stats[int(entry)] = fields
+        tree, frontier = {}, [os.getpid()]
+        while frontier:
+            pid = frontier.pop()
+            if pid in stats:
+                tree[pid] = stats[pid]
+                frontier.extend(child for child, fields in stats.items() if int(fields[1]) == pid)
+        return tree
+
+    @staticmethod
+    def _ticks(tree: Dict[int, List[str]]) -> Dict[int, int]:
+        return {pid: int(fields[11]) + int(fields[12]) for pid, fields in tree.items()}
+
+    def run(self) -> None:
+        started = last_time = time.monotonic()
+        last_ticks = self._ticks(self._process_tree())
+        while not self._stop_event.wait(self.interval):
+            now = time.monotonic()
+            tree = self._process_tree()
+            ticks = self._ticks(tree)
+            # Processos novos contam desde o início; os encerrados no intervalo saem da conta
+            used = sum(t - last_ticks.get(pid, 0) for pid, t in ticks.items())
+            self.samples.append({
+                't': round(now - started, 2),
+                'rss_mb': round(sum(int(f[21]) for f in tree.values()) * self._page_size / 2**20, 1),
+                'cpu_pct': round(used / self._clock_ticks / (now - last_time) * 100, 1),
+                'processos': len(tree),
+            })
+            last_ticks, last_time = ticks, now
+
+    def stop(self) -> List[Dict]:
+        self._stop_event.set()
+        self.join()
+        return self.samples
+
+
+def share_apptest_globals(secrets: Dict) -> None:
+    """Permite várias execuções do AppTest ao mesmo tempo no processo.
+
+    A cada execução o AppTest instala um Runtime simulado, troca ``st.secrets``
+    e liga ``global.appTest``, desfazendo tudo no fim; com sessões em threads,
+    uma sessão que termina desfaz o estado de outra ainda em execução. Aqui os
+    secrets e a opção ficam fixos para o teste inteiro e o Runtime zerado é
+    substituído pelo último instalado. O bytecode do app é compilado uma vez e
+    compartilhado, como no servidor (compilar em várias threads ao mesmo tempo
+    falha no CPython 3.11).
+    """
+    shared_secrets = Secrets()
+    shared_secrets._secrets = secrets
+    st.secrets = shared_secrets
+    config.set_option('global.appTest', True)
+
+    last_runtime = []
+
+    def instance(cls):
+        if cls._instance is not None:
+            last_runtime[:] = [cls._instance]
+        if not last_runtime:
+            raise RuntimeError("Runtime hasn't been created!")
+        return last_runtime[0]
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(lambda cls: cls._instance is not None or bool(last_runtime))
+
+    get_bytecode = ScriptCache.get_bytecode
+    compile_lock = threading.Lock()
+    shared_cache = ScriptCache()
+
+    def shared_get_bytecode(self, script_path):
+        with compile_lock:
+            return get_bytecode(shared_cache, script_path)
+
+    ScriptCache.get_bytecode = shared_get_bytecode
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Percentil pelo método nearest-rank"""
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def build_workload(session_id: int, n_files: int, n_lines: int) -> Tuple[bytes, List[Tuple[str, bytes]]]:
+    """Base de produtos (Excel) e SPEDs sintéticos próprios de uma sessão"""
+    speds, ncms = [], set()
+    for month in range(1, n_files + 1):
+        content, used = make_sped(f'{month:02d}', '2024', f'{10000000 + session_id:08d}000199',
+                                  n_lines=n_lines, seed=session_id * 100 + month)
+        speds.append((f'SPED_{month:02d}_2024.txt', content))
+        ncms.update(used)
+    base = io.BytesIO()
+    make_product_base(sorted(ncms)).to_excel(base, index=False)
+    return base.getvalue(), speds
+
+
+def run_session(session_id: int, workload: Tuple[bytes, List[Tuple[str, bytes]]], secrets: Dict,
+                timeout: float, artifacts: List[str]) -> Dict:
+    """Uma sessão completa; devolve as latências de cada etapa (segundos)"""
+    row: Dict = {'sessao': session_id, 'status': 'ok', 'erro': '', 'downloads': 0}
+    started = time.perf_counter()
+    try:
+        # Secrets vêm de share_apptest_globals, não do AppTest (que os trocaria a cada execução)
+        at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+
+        step = time.perf_counter()
+        at.run()
+        at.text_input(key='username').input(secrets['auth']['username'])
+        at.text_input(key='password').input(secrets['auth']['password'])
+        [b for b in at.button if b.label == 'Entrar'][0].click().run()
+        if not at.session_state['authenticated']:
+            raise RuntimeError('login recusado')
+        # Cada sessão como um analista diferente, para a fila justa do pool se comportar como em produção
+        at.session_state['current_user'] = f"{secrets['auth']['username']}-{session_id:03d}"
+        row['login'] = time.perf_counter() - step
+
+        step = time.perf_counter()
+        base, speds = workload
+        at.file_uploader(key='produtos').set_value(('produtos.xlsx', base, 'application/octet-stream'))
+        at.file_uploader(key='sped').set_value([(name, content, 'text/plain') for name, content in speds])
+        at.run()
+        row['upload'] = time.perf_counter() - step
+
+        step = time.perf_counter()
+        [b for b in at.button if 'PROCESSAR' in b.label][0].click().run()
+        if at.exception:
+            raise RuntimeError(at.exception[0].message)
+        row['processar'] = time.perf_counter() - step
+
+        # Arquivos gerados sob demanda: prepara cada um e baixa (o clique reexecuta o script, como no navegador)
+        step = time.perf_counter()
+        for name in artifacts:
+            at.button(key=f'prepare_{name}').click().run()
+            downloads = [d for d in at.get('download_button') if d.key == f'download_{name}']
+            if not downloads:
+                raise RuntimeError(f'{name}: download indisponível após preparar')
+            downloads[0].click().run()
+            row['downloads'] += 1
+        row['download'] = time.perf_counter() - step
+    except Exception as exc:
+        row['status'] = 'erro'
+        row['erro'] = f'{type(exc).__name__}: {exc}'
+    row['total'] = time.perf_counter() - started
+    return row
+
+
+def run_level(sessions: int, rounds: int, workloads: List, secrets: Dict, timeout: float,
+              artifacts: List[str], sample_interval: float) -> Tuple[List[Dict], List[Dict], float]:
+    sampler = ResourceSampler(sample_interval)
+    sampler.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions) as executor:
+        futures = [executor.submit(run_session, i, workloads[i % len(workloads)], secrets, timeout, artifacts)
+                   for i in range(sessions * rounds)]
+        rows = [f.result() for f in futures]
+    wall = time.perf_counter() - started
+    return rows, sampler.stop(), wall
+
+
+def summarize_level(sessions: int, rows: List[Dict], samples: List[Dict], wall: float) -> Dict:
+    ok_rows = [r for r in rows if r['status'] == 'ok']
+    summary = {
+        'sessoes': sessions,
+        'concluidas': len(ok_rows),
+        'erros': len(rows) - len(ok_rows),
+        'duracao_s': round(wall, 2),
+        'vazao_por_min': round(len(ok_rows) / wall * 60, 2) if wall else 0.0,
+        'rss_pico_mb': max((s['rss_mb'] for s in samples), default=0.0),
+        'cpu_media_pct': round(sum(s['cpu_pct'] for s in samples) / len(samples), 1) if samples else 0.0,
+    }
+    for step in ('login', 'upload', 'processar', 'download', 'total'):
+        values = [r[step] for r in ok_rows if step in r]
+        for pct in (50, 95, 99):
+            summary[f'{step}_p{pct}'] = round(percentile(values, pct), 3)
+    return summary
+
+
+def find_saturation(levels: List[Dict], min_gain: float, slo: Optional[float]) -> Optional[Dict]:
+    """Primeiro nível em que a vazão não cresce ``min_gain`` sobre o melhor anterior ou o p95 estoura o SLO"""
+    best = 0.0
+    for level in levels:
+        if level['erros']:
+            return {'sessoes': level['sessoes'], 'motivo': f"{level['erros']} sessão(ões) com erro"}
+        if slo is not None and level['processar_p95'] > slo:
+            return {'sessoes': level['sessoes'], 'motivo': f"p95 do processamento {level['processar_p95']:.1f}s > {slo}s"}
+        if best and level['vazao_por_min'] < best * (1 + min_gain):
+            return {'sessoes': level['sessoes'],
+                    'motivo': f"vazão {level['vazao_por_min']:.1f}/min não cresce sobre {best:.1f}/min"}
+        best = max(best, level['vazao_por_min'])
+    return None
+
+
+def write_csv(path: Path, rows: List[Dict]) -> None:
+    fieldnames = list(dict.fromkeys(key for row in rows for key in row))
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sessoes', default='1,2,4,8', help='Níveis de concorrência, em ordem (ex.: 1,2,4,8)')
+    parser.add_argument('--rodadas', type=int, default=1, help='Sessões por "usuário" simultâneo em cada nível')
+    parser.add_argument('--arquivos', type=int, default=3, help='SPEDs por sessão')
+    parser.add_argument('--linhas', type=int, default=20000, help='Registros C870 por SPED')
+    parser.add_argument('--artefatos', default='pdf,excel,speds,json',
+                        help='Arquivos preparados e baixados por sessão (excel, pdf, speds, json, completo)')
+    parser.add_argument('--secrets', default=str(Path(__file__).with_name('load_test_secrets.toml')))
+    parser.add_argument('--slo', type=float, default=None, help='Limite do p95 do processamento, em segundos')
+    parser.add_argument('--ganho-minimo', type=float, default=0.1,
+                        help='Ganho mínimo de vazão entre níveis para não considerar saturado (padrão 10%%)')
+    parser.add_argument('--intervalo', type=float, default=0.5, help='Intervalo de amostragem de RSS/CPU')
+    parser.add_argument('--timeout', type=float, default=900, help='Tempo máximo de cada execução do script')
+    parser.add_argument('--saida', default=None, help='Diretório para sessoes.csv, recursos.csv e resumo.json')
+    args = parser.parse_args()
+
+    levels = [int(n) for n in args.sessoes.split(',')]
+    with open(args.secrets, 'rb') as f:
+        secrets = tomllib.load(f)
+    # Histórico e checkpoints do teste ficam num diretório temporário
+    storage_dir = tempfile.mkdtemp(prefix='icmsst_carga_')
+    secrets['storage'] = {'sqlite_path': os.path.join(storage_dir, 'historico.db'),
+                          'checkpoint_dir': os.path.join(storage_dir, 'checkpoints')}
+
+    share_apptest_globals(secrets)
+
+    print(f"Gerando {max(levels)} carga(s) de {args.arquivos} SPED(s) x {args.linhas:,} linhas...")
+    workloads = [build_workload(i, args.arquivos, args.linhas) for i in range(max(levels))]
+
+    # Aquecimento: importa o app, sobe o pool de processos e preenche os caches
+    artifacts = [name for name in args.artefatos.split(',') if name]
+    run_session(-1, workloads[0], secrets, args.timeout, artifacts)
+
+    summaries, all_rows, all_samples = [], [], []
+    for sessions in levels:
+        rows, samples, wall = run_level(sessions, args.rodadas, workloads, secrets, args.timeout,
+                                        artifacts, args.intervalo)
+        summary = summarize_level(sessions, rows, samples, wall)
+        summaries.append(summary)
+        all_rows.extend(dict(row, nivel=sessions) for row in rows)
+        all_samples.extend(dict(sample, nivel=sessions) for sample in samples)
+        print(f"{sessions:>3} sessão(ões): {summary['concluidas']} ok, {summary['erros']} erro(s), "
+              f"{summary['vazao_por_min']:.1f}/min | processar p50 {summary['processar_p50']:.1f}s "
+              f"p95 {summary['processar_p95']:.1f}s p99 {summary['processar_p99']:.1f}s | "
+              f"RSS pico {summary['rss_pico_mb']:,.0f} MB | CPU média {summary['cpu_media_pct']:.0f}%")
+        for row in rows:
+            if row['erro']:
+                print(f"    sessão {row['sessao']}: {row['erro']}")
+
+    saturation = find_saturation(summaries, args.ganho_minimo, args.slo)
+    if saturation:
+        capacity = max((s['sessoes'] for s in summaries if s['sessoes'] < saturation['sessoes']), default=0)
+        print(f"Saturação com {saturation['sessoes']} sessões ({saturation['motivo']}); "
+              f"capacidade sugerida: {capacity} sessão(ões) simultânea(s)")
+    else:
+        print(f"Sem saturação até {levels[-1]} sessões; aumente --sessoes para encontrar o limite")
+
+    if args.saida:
+        out = Path(args.saida)
+        out.mkdir(parents=True, exist_ok=True)
+        write_csv(out / 'sessoes.csv', all_rows)
+        write_csv(out / 'recursos.csv', all_samples)
+        with open(out / 'resumo.json', 'w', encoding='utf-8') as f:
+            json.dump({'niveis': summaries, 'saturacao': saturation, 'cpus': os.cpu_count(),
+                       'arquivos_por_sessao': args.arquivos, 'linhas_por_arquivo': args.linhas},
+                      f, ensure_ascii=False, indent=2)
+        print(f"Resultados em {out}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,341 @@
+"""
+Motor original do app, congelado como referência da verificação diferencial.
+
+Cópia do parser, da base de produtos, da calculadora e do gravador da
+primeira versão do ``app.py`` (só C870, texto decodificado, uma regra por
+NCM), sem as otimizações posteriores. Não importa nada do ``app``: mudanças
+no motor atual não alteram a referência. Diferenças conhecidas, que a
+comparação desconsidera: o gravador original junta as linhas com ``\\n`` e
+perde o ``\\r`` das linhas recalculadas, e os resultados não têm o campo
+``register``.
+"""
+
+from dataclasses import dataclass
+from decimal import ROUND_HALF_UP, Decimal
+from typing import Dict, Generator, List, Optional
+
+import pandas as pd
+
+
+@dataclass
+class C870Record:
+    line_number: int
+    cod_item: str
+    cfop: str
+    vl_item: Decimal
+    vl_desc: Decimal
+    cst_pis: str
+    vl_bc_pis: Decimal
+    aliq_pis: Decimal
+    vl_pis: Decimal
+    cst_cofins: str
+    vl_bc_cofins: Decimal
+    aliq_cofins: Decimal
+    vl_cofins: Decimal
+    cod_cta: str
+    raw_line: str
+
+
+@dataclass
+class CalculationResult:
+    line_number: int
+    cod_item: str
+    ncm: str
+    cfop: str
+    vl_item: Decimal
+    vl_bc_pis_orig: Decimal
+    vl_pis_orig: Decimal
+    vl_bc_cofins_orig: Decimal
+    vl_cofins_orig: Decimal
+    mva: Decimal
+    aliq_icms: Decimal
+    base_icms_st: Decimal
+    valor_icms_st: Decimal
+    vl_bc_pis_new: Decimal
+    vl_pis_new: Decimal
+    vl_bc_cofins_new: Decimal
+    vl_cofins_new: Decimal
+    economia_pis: Decimal
+    economia_cofins: Decimal
+    economia_total: Decimal
+    status: str
+    skip_reason: Optional[str] = None
+
+
+class SpedParser:
+    """Parser original: todas as linhas em memória, registros lidos de novo a cada passada"""
+
+    def __init__(self):
+        self.products: Dict[str, str] = {}
+        self.lines: List[str] = []
+
+    def parse_decimal(self, value: str) -> Decimal:
+        if not value or value.strip() == '':
+            return Decimal('0')
+        clean = value.strip().replace(',', '.')
+        try:
+            return Decimal(clean)
+        except Exception:
+            return Decimal('0')
+
+    @staticmethod
+    def split_fields(line: str) -> List[str]:
+        if line.startswith('|'):
+            line = line[1:]
+        if line.endswith('|'):
+            line = line[:-1]
+        return line.split('|')
+
+    def parse_c870(self, line_number: int, fields: List[str], raw_line: str) -> C870Record:
+        return C870Record(
+            line_number=line_number,
+            cod_item=fields[1] if len(fields) > 1 else '',
+            cfop=fields[2] if len(fields) > 2 else '',
+            vl_item=self.parse_decimal(fields[3]) if len(fields) > 3 else Decimal('0'),
+            vl_desc=self.parse_decimal(fields[4]) if len(fields) > 4 else Decimal('0'),
+            cst_pis=fields[5] if len(fields) > 5 else '',
+            vl_bc_pis=self.parse_decimal(fields[6]) if len(fields) > 6 else Decimal('0'),
+            aliq_pis=self.parse_decimal(fields[7]) if len(fields) > 7 else Decimal('0'),
+            vl_pis=self.parse_decimal(fields[8]) if len(fields) > 8 else Decimal('0'),
+            cst_cofins=fields[9] if len(fields) > 9 else '',
+            vl_bc_cofins=self.parse_decimal(fields[10]) if len(fields) > 10 else Decimal('0'),
+            aliq_cofins=self.parse_decimal(fields[11]) if len(fields) > 11 else Decimal('0'),
+            vl_cofins=self.parse_decimal(fields[12]) if len(fields) > 12 else Decimal('0'),
+            cod_cta=fields[13] if len(fields) > 13 else '',
+            raw_line=raw_line
+        )
+
+    def load_content(self, content: str) -> None:
+        self.lines = content.split('\n')
+        for line in self.lines:
+            line = line.strip()
+            if not line:
+                continue
+            fields = self.split_fields(line)
+            if fields[0] == '0200':
+                cod_item = fields[1] if len(fields) > 1 else ''
+                ncm_raw = fields[7] if len(fields) > 7 else ''
+                self.products[cod_item] = ncm_raw[:8] if ncm_raw else ''
+
+    def get_c870_records(self) -> Generator[C870Record, None, None]:
+        for line_num, line in enumerate(self.lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            fields = self.split_fields(line)
+            if fields[0] == 'C870':
+                yield self.parse_c870(line_num, fields, line)
+
+    def get_ncm_for_item(self, cod_item: str) -> Optional[str]:
+        return self.products.get(cod_item)
+
+
+class ProductBaseLoader:
+    """Base de produtos original: NCM de 8 dígitos, uma regra por NCM (a última da planilha)"""
+
+    def __init__(self):
+        self.products_by_ncm: Dict[str, Dict] = {}
+
+    def load_dataframe(self, df: pd.DataFrame) -> int:
+        col_map = {}
+        for col in df.columns:
+            col_lower = str(col).lower()
+            if col_lower == 'ncm':
+                col_map['ncm'] = col
+            elif col_lower == 'capitulo':
+                col_map['capitulo'] = col
+            elif col_lower == 'item':
+                col_map['item'] = col
+            elif 'mva' in col_lower or 'iva' in col_lower:
+                if 'ajust' in col_lower:
+                    col_map['mva_adjusted'] = col
+                elif 'import' not in col_lower:
+                    col_map['mva'] = col
+            elif 'aliq' in col_lower and 'entrada' in col_lower:
+                col_map['aliq_icms'] = col
+
+        count = 0
+        for _, row in df.iterrows():
+            ncm = None
+            if 'ncm' in col_map and pd.notna(row[col_map['ncm']]):
+                ncm_raw = str(row[col_map['ncm']]).strip()
+                if ncm_raw and ncm_raw not in ['', 'nan']:
+                    ncm = ncm_raw.replace('.', '').replace('-', '').zfill(8)[:8]
+
+            if not ncm and 'capitulo' in col_map and 'item' in col_map:
+                try:
+                    cap = str(int(float(row[col_map['capitulo']]))).zfill(4)
+                    item = str(int(float(row[col_map['item']]))).zfill(4)
+                    ncm = cap + item
+                except Exception:
+                    continue
+
+            if not ncm or len(ncm) != 8:
+                continue
+
+            mva = None
+            if 'mva' in col_map and pd.notna(row[col_map['mva']]):
+                try:
+                    mva = Decimal(str(row[col_map['mva']]).replace(',', '.').replace('%', ''))
+                except Exception:
+                    pass
+
+            aliq = Decimal('18')
+            if 'aliq_icms' in col_map and pd.notna(row[col_map['aliq_icms']]):
+                try:
+                    aliq = Decimal(str(row[col_map['aliq_icms']]).replace(',', '.').replace('%', ''))
+                except Exception:
+                    pass
+
+            if mva is not None:
+                self.products_by_ncm[ncm] = {'ncm': ncm, 'mva': mva, 'aliq_icms': aliq}
+                count += 1
+
+        return count
+
+    def get_product_by_ncm(self, ncm: str) -> Optional[Dict]:
+        return self.products_by_ncm.get(ncm)
+
+
+class IcmsStCalculator:
+    """Calculadora original, sem memo"""
+
+    def __init__(self, product_base: ProductBaseLoader, cfops_elegiveis: set):
+        self.product_base = product_base
+        self.cfops_elegiveis = cfops_elegiveis
+
+    def calculate(self, record: C870Record, ncm: Optional[str]) -> CalculationResult:
+        base = CalculationResult(
+            line_number=record.line_number,
+            cod_item=record.cod_item,
+            ncm=ncm or '',
+            cfop=record.cfop,
+            vl_item=record.vl_item,
+            vl_bc_pis_orig=record.vl_bc_pis,
+            vl_pis_orig=record.vl_pis,
+            vl_bc_cofins_orig=record.vl_bc_cofins,
+            vl_cofins_orig=record.vl_cofins,
+            mva=Decimal('0'),
+            aliq_icms=Decimal('0'),
+            base_icms_st=Decimal('0'),
+            valor_icms_st=Decimal('0'),
+            vl_bc_pis_new=record.vl_bc_pis,
+            vl_pis_new=record.vl_pis,
+            vl_bc_cofins_new=record.vl_bc_cofins,
+            vl_cofins_new=record.vl_cofins,
+            economia_pis=Decimal('0'),
+            economia_cofins=Decimal('0'),
+            economia_total=Decimal('0'),
+            status='skipped'
+        )
+
+        if record.cfop not in self.cfops_elegiveis:
+            base.skip_reason = f'CFOP {record.cfop} não elegível'
+            return base
+
+        if not ncm:
+            base.skip_reason = 'NCM não encontrado'
+            return base
+
+        product = self.product_base.get_product_by_ncm(ncm)
+        if not product:
+            base.skip_reason = 'NCM sem MVA na base'
+            return base
+
+        mva = product['mva']
+        aliq_icms = product.get('aliq_icms', Decimal('18'))
+
+        if mva <= 0:
+            base.skip_reason = 'MVA zero ou negativo'
+            return base
+
+        # Fórmula: VL_BC - ((VL_BC * MVA%) * ALIQ_ICMS%)
+        mva_decimal = mva / Decimal('100')
+        aliq_icms_decimal = aliq_icms / Decimal('100')
+
+        exclusao_pis = record.vl_bc_pis * mva_decimal * aliq_icms_decimal
+        vl_bc_pis_new = (record.vl_bc_pis - exclusao_pis).quantize(Decimal('0.01'), ROUND_HALF_UP)
+        if vl_bc_pis_new < 0:
+            vl_bc_pis_new = Decimal('0')
+
+        exclusao_cofins = record.vl_bc_cofins * mva_decimal * aliq_icms_decimal
+        vl_bc_cofins_new = (record.vl_bc_cofins - exclusao_cofins).quantize(Decimal('0.01'), ROUND_HALF_UP)
+        if vl_bc_cofins_new < 0:
+            vl_bc_cofins_new = Decimal('0')
+
+        vl_pis_new = (vl_bc_pis_new * record.aliq_pis / Decimal('100')).quantize(Decimal('0.01'), ROUND_HALF_UP)
+        vl_cofins_new = (vl_bc_cofins_new * record.aliq_cofins / Decimal('100')).quantize(Decimal('0.01'),
+                                                                                           ROUND_HALF_UP)
+
+        base_icms_st = (record.vl_bc_pis * mva_decimal).quantize(Decimal('0.01'), ROUND_HALF_UP)
+        valor_icms_st = exclusao_pis.quantize(Decimal('0.01'), ROUND_HALF_UP)
+
+        economia_pis = record.vl_pis - vl_pis_new
+        economia_cofins = record.vl_cofins - vl_cofins_new
+
+        return CalculationResult(
+            line_number=record.line_number,
+            cod_item=record.cod_item,
+            ncm=ncm,
+            cfop=record.cfop,
+            vl_item=record.vl_item,
+            vl_bc_pis_orig=record.vl_bc_pis,
+            vl_pis_orig=record.vl_pis,
+            vl_bc_cofins_orig=record.vl_bc_cofins,
+            vl_cofins_orig=record.vl_cofins,
+            mva=mva,
+            aliq_icms=aliq_icms,
+            base_icms_st=base_icms_st,
+            valor_icms_st=valor_icms_st,
+            vl_bc_pis_new=vl_bc_pis_new,
+            vl_pis_new=vl_pis_new,
+            vl_bc_cofins_new=vl_bc_cofins_new,
+            vl_cofins_new=vl_cofins_new,
+            economia_pis=economia_pis,
+            economia_cofins=economia_cofins,
+            economia_total=economia_pis + economia_cofins,
+            status='calculated'
+        )
+
+
+class SpedWriter:
+    """Gravador original: reescreve as linhas calculadas e junta tudo com ``\\n``"""
+
+    def __init__(self, parser: SpedParser, results: List[CalculationResult]):
+        self.parser = parser
+        self.results_by_line = {r.line_number: r for r in results if r.status == 'calculated'}
+
+    def format_decimal(self, value: Decimal) -> str:
+        return str(value.quantize(Decimal('0.01'))).replace('.', ',')
+
+    def generate(self) -> str:
+        modified_lines = []
+        for line_num, line in enumerate(self.parser.lines, 1):
+            original = line.strip()
+            result = self.results_by_line.get(line_num) if original else None
+            if not result:
+                modified_lines.append(line)
+                continue
+
+            fields = SpedParser.split_fields(original)
+            if len(fields) >= 13:
+                fields[6] = self.format_decimal(result.vl_bc_pis_new)
+                fields[8] = self.format_decimal(result.vl_pis_new)
+                fields[10] = self.format_decimal(result.vl_bc_cofins_new)
+                fields[12] = self.format_decimal(result.vl_cofins_new)
+                modified_lines.append('|' + '|'.join(fields) + '|')
+            else:
+                modified_lines.append(line)
+        return '\n'.join(modified_lines)
+
+
+def run(content: bytes, base_df: pd.DataFrame, cfops: set) -> tuple:
+    """Processa o SPED como a versão original; devolve (resultados, SPED retificado em latin-1)"""
+    product_base = ProductBaseLoader()
+    product_base.load_dataframe(base_df)
+    parser = SpedParser()
+    parser.load_content(content.decode('latin-1'))
+    calculator = IcmsStCalculator(product_base, cfops)
+    results = [calculator.calculate(record, parser.get_ncm_for_item(record.cod_item))
+               for record in parser.get_c870_records()]
+    return results, SpedWriter(parser, results).generate().encode('latin-1')
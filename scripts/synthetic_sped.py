@@ -0,0 +1,64 @@
+"""
+Gerador de SPED Contribuições sintético com formato de varejo.
+
+Usado pelos scripts de benchmark e verificação: itens com popularidade
+desigual (Zipf), poucos preços por item e quantidades pequenas, de modo que
+combinações de base e alíquota se repetem como em arquivos reais.
+"""
+
+import random
+from decimal import Decimal
+from typing import List, Tuple
+
+import pandas as pd
+
+CFOP_WEIGHTS = [('5405', 70), ('5102', 20), ('5403', 7), ('5401', 3)]
+
+
+def fmt_decimal(value: Decimal) -> str:
+    """Decimal no formato do SPED (vírgula decimal)"""
+    return str(value).replace('.', ',')
+
+
+def make_sped(month: str = '01', year: str = '2024', cnpj: str = '12345678000199', n_items: int = 2000,
+              n_lines: int = 100000, seed: int = 1, crlf: bool = True,
+              prices_per_item: int = 4) -> Tuple[bytes, List[str]]:
+    """Gera um SPED com ``n_lines`` registros C870; devolve (conteúdo, NCMs usados)"""
+    rnd = random.Random(seed)
+    eol = '\r\n' if crlf else '\n'
+    ncms = [f'{2100 + i % 900:04d}{rnd.randrange(10000):04d}' for i in range(n_items)]
+    prices = [[Decimal(rnd.randrange(199, 49999)) / 100 for _ in range(prices_per_item)] for _ in range(n_items)]
+    weights = [1 / (rank + 1) for rank in range(n_items)]
+    cfops, cfop_weights = zip(*CFOP_WEIGHTS)
+
+    lines = [f'|0000|006|0|||01{month}{year}|28{month}{year}|EMPRESA SINTETICA LTDA|{cnpj}|SP|3550308||0|1|',
+             '|0001|0|']
+    for i in range(n_items):
+        lines.append(f'|0200|ITEM{i:05d}|PRODUTO SINTÉTICO {i}||||00|{ncms[i]}||{ncms[i][:2]}||18,00|')
+    lines.append('|C001|0|')
+
+    items = rnd.choices(range(n_items), weights=weights, k=n_lines)
+    for item in items:
+        bc = rnd.choice(prices[item]) * rnd.choice((1, 1, 1, 2, 3))
+        vl_pis = (bc * Decimal('1.65') / 100).quantize(Decimal('0.01'))
+        vl_cofins = (bc * Decimal('7.6') / 100).quantize(Decimal('0.01'))
+        cfop = rnd.choices(cfops, weights=cfop_weights)[0]
+        lines.append(f'|C870|ITEM{item:05d}|{cfop}|{fmt_decimal(bc)}|0|01|{fmt_decimal(bc)}|1,6500|{fmt_decimal(vl_pis)}|'
+                     f'01|{fmt_decimal(bc)}|7,6000|{fmt_decimal(vl_cofins)}|3.01.01|')
+
+    lines.append(f'|C990|{n_lines + 2}|')
+    lines.append(f'|9999|{len(lines) + 1}|')
+    return (eol.join(lines) + eol).encode('latin-1'), ncms
+
+
+def make_product_base(ncms: List[str], seed: int = 1, missing_every: int = 7) -> pd.DataFrame:
+    """Base de produtos para os NCMs (um em cada ``missing_every`` fica de fora)"""
+    rnd = random.Random(seed)
+    rows = []
+    for i, ncm in enumerate(sorted(set(ncms))):
+        if missing_every and i % missing_every == 0:
+            continue
+        mva = rnd.choice((30, 35.5, 41.08, 46, 52.18, 70))
+        rows.append({'NCM': ncm, 'MVA': mva, 'MVA Ajustada': round(mva * 1.12, 2),
+                     'Aliquota Entrada': rnd.choice((12, 18, 18, 18, 25))})
+    return pd.DataFrame(rows)
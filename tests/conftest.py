@@ -0,0 +1,40 @@
+"""
+Fixtures compartilhadas pelos testes.
+
+Os testes importam ``app`` direto: a interface só é desenhada em ``main()``.
+Os SPEDs e bases de produtos vêm do gerador sintético de ``scripts/``.
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'scripts'))
+
+import app  # noqa: E402
+from synthetic_sped import make_product_base, make_sped  # noqa: E402
+
+CFOPS = {'5405', '5403'}
+
+
+@pytest.fixture(scope='session')
+def sped_content():
+    """SPED sintético de março/2024 e os NCMs usados nos itens"""
+    return make_sped('03', '2024', n_items=60, n_lines=400)
+
+
+@pytest.fixture(scope='session')
+def product_base(sped_content):
+    base = app.ProductBaseLoader()
+    base.load_dataframe(make_product_base(sped_content[1]))
+    return base
+
+
+@pytest.fixture
+def processed(sped_content, product_base):
+    """Mês processado pelo pipeline completo"""
+    source = app.SpedSource('SPED_03_2024.txt', data=sped_content[0])
+    return app.process_sped_source(source, app.IcmsStCalculator(product_base, set(CFOPS)))
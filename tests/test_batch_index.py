@@ -0,0 +1,65 @@
+import gzip
+import io
+import zipfile
+
+import app
+from synthetic_sped import make_sped
+
+
+def _sped(month, year='2024', cnpj='12345678000199', retificadora=False):
+    content, _ = make_sped(month, year, cnpj=cnpj, n_items=5, n_lines=10)
+    if retificadora:
+        content = content.replace(b'|0000|006|0|', b'|0000|006|1|', 1)
+    return content
+
+
+def _source(name, content):
+    return app.SpedSource(name, data=content, size=len(content))
+
+
+def test_orders_by_header_period_and_rejects_files_without_0000():
+    # Nomes trocados: vale o período do 0000, não o do arquivo
+    sources = [_source('SPED_01_2024.txt', _sped('03')), _source('SPED_03_2024.txt', _sped('01')),
+               _source('leiame.txt', b'arquivo qualquer\r\n')]
+    accepted, rejected = app.build_batch_index(sources)
+    assert [(e.month, e.year) for e in accepted] == [('01', '2024'), ('03', '2024')]
+    assert [e.name for e in rejected] == ['leiame.txt']
+
+
+def test_duplicate_period_keeps_retificadora_then_last_sent():
+    original, retificadora, late_original = (_source('orig.txt', _sped('02')),
+                                              _source('retif.txt', _sped('02', retificadora=True)),
+                                              _source('orig_2.txt', _sped('02')))
+    accepted, rejected = app.build_batch_index([original, retificadora, late_original])
+    assert [e.name for e in accepted] == ['retif.txt']
+    assert sorted(e.name for e in rejected) == ['orig.txt', 'orig_2.txt']
+
+    accepted, rejected = app.build_batch_index([_source('a.txt', _sped('02')), _source('b.txt', _sped('02'))])
+    assert [e.name for e in accepted] == ['b.txt']
+    assert 'substituído por b.txt' in rejected[0].reason
+
+
+def test_rejects_other_cnpj():
+    sources = [_source('a.txt', _sped('01')), _source('b.txt', _sped('02')),
+               _source('c.txt', _sped('03', cnpj='99888777000166'))]
+    accepted, rejected = app.build_batch_index(sources)
+    assert [e.name for e in accepted] == ['a.txt', 'b.txt']
+    assert rejected[0].name == 'c.txt' and 'CNPJ 99888777000166' in rejected[0].reason
+
+
+class _Upload(io.BytesIO):
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name = name
+
+
+def test_compressed_uploads_are_indexed_per_member():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr('SPED_04_2024.txt', _sped('04'))
+        archive.writestr('SPED_05_2024.txt', _sped('05'))
+    uploads = [_Upload('lote.zip', buffer.getvalue()), _Upload('SPED_06_2024.txt.gz', gzip.compress(_sped('06')))]
+    accepted, rejected = app.build_batch_index(app.expand_uploads(uploads))
+    assert [(e.name, e.month) for e in accepted] == [
+        ('SPED_04_2024.txt', '04'), ('SPED_05_2024.txt', '05'), ('SPED_06_2024.txt', '06')]
+    assert not rejected
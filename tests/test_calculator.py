@@ -0,0 +1,49 @@
+from decimal import Decimal
+
+import pandas as pd
+import pytest
+
+import app
+
+NCM = '22030000'
+
+
+@pytest.fixture(scope='module')
+def base():
+    loader = app.ProductBaseLoader()
+    loader.load_dataframe(pd.DataFrame([{'NCM': NCM, 'MVA': '70', 'Aliquota Entrada': '18'}]))
+    return loader
+
+
+def _record(register: str, cfop: str) -> app.SalesRecord:
+    return app.SalesRecord(
+        register=register, line_number=10, cod_item='ITEM1', cfop=cfop, vl_item=Decimal('100'),
+        vl_desc=Decimal('0'), cst_pis='01', vl_bc_pis=Decimal('100'), aliq_pis=Decimal('1.65'),
+        vl_pis=Decimal('1.65'), cst_cofins='01', vl_bc_cofins=Decimal('100'), aliq_cofins=Decimal('7.6'),
+        vl_cofins=Decimal('7.60'), cod_cta='', raw_line=b'')
+
+
+@pytest.mark.parametrize('register, cfop, status', [
+    ('C870', '5405', 'calculated'),
+    ('C870', '5102', 'skipped'),
+    # CFOP em branco num registro que tem CFOP não é elegível
+    ('C870', '', 'skipped'),
+    ('C170', '', 'skipped'),
+    # Layouts sem CFOP entram pela escolha do registro
+    ('C481', '', 'calculated'),
+    ('A170', '', 'calculated'),
+])
+def test_cfop_filter(base, register, cfop, status):
+    calculator = app.IcmsStCalculator(base, {'5405'})
+    result = calculator.calculate(_record(register, cfop), NCM)
+    assert result.status == status
+    if status == 'skipped':
+        assert result.skip_reason == f'CFOP {cfop} não elegível'
+
+
+def test_scenarios_follow_the_same_cfop_filter(base):
+    evaluator = app.ScenarioEvaluator([app.Scenario('Base')], base, {'5405'})
+    for register, cfop in (('C870', '5405'), ('C870', ''), ('C481', '')):
+        evaluator.add(_record(register, cfop), NCM)
+    summary = evaluator.month_summaries('03', '2024', 'Março')['Base']
+    assert (summary.total_records, summary.total_calculated) == (3, 2)
@@ -0,0 +1,88 @@
+import gzip
+import json
+import pickle
+from decimal import Decimal
+from pathlib import Path
+
+import app
+from conftest import CFOPS
+
+
+def _processed_with_scenarios(sped_content, product_base):
+    scenarios = [app.Scenario('Alíquota 12%', aliq_icms=Decimal('12')), app.Scenario('MVA ajustada', True)]
+    evaluator = app.ScenarioEvaluator(scenarios, product_base, set(CFOPS))
+    source = app.SpedSource('SPED_03_2024.txt', data=sped_content[0])
+    return app.process_sped_source(source, app.IcmsStCalculator(product_base, set(CFOPS)), scenarios=evaluator)
+
+
+def test_round_trip(tmp_path, sped_content, product_base):
+    processed = _processed_with_scenarios(sped_content, product_base)
+    checkpoints = app.BatchCheckpoint(str(tmp_path), 'config')
+    checkpoints.save('mes', processed)
+
+    # JSON compactado, legível sem o app
+    payload = json.loads(gzip.decompress((tmp_path / 'mes.ckpt').read_bytes()))
+    assert payload['version'] == app.PROCESSED_MONTH_FORMAT
+
+    loaded = checkpoints.load('mes')
+    assert loaded.resumed
+    assert loaded.results == processed.results
+    assert loaded.summary == processed.summary
+    assert loaded.scenario_summaries == processed.scenario_summaries
+    assert loaded.sped_output == processed.sped_output
+    assert loaded.header == processed.header
+    assert all(str(a) == str(b) for old, new in zip(processed.results, loaded.results)
+               for a, b in zip(vars(old).values(), vars(new).values()))
+
+
+class _Payload:
+    def __init__(self, marker: Path):
+        self.marker = marker
+
+    def __reduce__(self):
+        return Path.touch, (self.marker,)
+
+
+def test_never_unpickles(tmp_path):
+    checkpoints = app.BatchCheckpoint(str(tmp_path / 'ck'), 'config')
+    marker = tmp_path / 'executado'
+    for key, data in [('pickle', gzip.compress(pickle.dumps(_Payload(marker)))),
+                      ('corrompido', b'nao e gzip'),
+                      ('versao', gzip.compress(json.dumps({'version': 1}).encode()))]:
+        (tmp_path / 'ck' / f'{key}.ckpt').write_bytes(data)
+        assert checkpoints.load(key) is None
+    assert not marker.exists()
+    assert checkpoints.load('ausente') is None
+
+
+def test_key_follows_content_and_config_and_hashes_once(monkeypatch, sped_content):
+    opened = []
+    original_open = app.SpedSource.open
+
+    def counting_open(self):
+        opened.append(self.name)
+        return original_open(self)
+
+    monkeypatch.setattr(app.SpedSource, 'open', counting_open)
+    checkpoints = app.BatchCheckpoint.__new__(app.BatchCheckpoint)
+    checkpoints.config_hash = 'a'
+    source = app.SpedSource('SPED_03_2024.txt', data=sped_content[0])
+    key = checkpoints.key_for(source)
+    assert checkpoints.key_for(source) == key and source.content_hash() and opened == ['SPED_03_2024.txt']
+
+    assert checkpoints.key_for(app.SpedSource('outro_nome.txt', data=sped_content[0])) == key
+    assert checkpoints.key_for(app.SpedSource('SPED_03_2024.txt', data=sped_content[0] + b'\r\n')) != key
+    checkpoints.config_hash = 'b'
+    assert checkpoints.key_for(source) != key
+
+
+def test_config_fingerprint_tracks_base_and_cfops(sped_content):
+    from synthetic_sped import make_product_base
+    base = app.ProductBaseLoader()
+    base.load_dataframe(make_product_base(sped_content[1]))
+    fingerprint = app.BatchCheckpoint.config_fingerprint(base, set(CFOPS))
+    assert fingerprint == app.BatchCheckpoint.config_fingerprint(base, set(CFOPS))
+    assert fingerprint != app.BatchCheckpoint.config_fingerprint(base, {'5405'})
+    changed = app.ProductBaseLoader()
+    changed.load_dataframe(make_product_base(sped_content[1], seed=2))
+    assert fingerprint != app.BatchCheckpoint.config_fingerprint(changed, set(CFOPS))
@@ -0,0 +1,41 @@
+import pytest
+
+import app
+import reference_engine
+from differential import BUILTIN_ENGINES, CFOPS, first_divergences, make_edge_case_sped
+
+
+@pytest.fixture(scope='module', params=[1, 2])
+def edge_case(request):
+    """SPED com casos de borda e o resultado do motor original"""
+    content, base_df, _ = make_edge_case_sped(1500, request.param)
+    return content, base_df, reference_engine.run(content, base_df, set(CFOPS))
+
+
+@pytest.mark.parametrize('engine', sorted(BUILTIN_ENGINES))
+def test_engine_matches_original(edge_case, engine):
+    content, base_df, reference = edge_case
+    product_base = app.ProductBaseLoader()
+    product_base.load_dataframe(base_df)
+    output = BUILTIN_ENGINES[engine](content, product_base, set(CFOPS))
+    assert first_divergences(content, reference, output) == {}
+
+
+def test_reference_covers_every_outcome(edge_case):
+    results = edge_case[2][0]
+    reasons = {result.skip_reason for result in results}
+    assert any(result.status == 'calculated' for result in results)
+    assert {'NCM não encontrado', 'NCM sem MVA na base', 'MVA zero ou negativo'} <= reasons
+    # Linhas malformadas sem CFOP chegam à referência como não elegíveis
+    assert 'CFOP  não elegível' in reasons
+
+
+def test_divergence_is_reported(edge_case):
+    content, _, reference = edge_case
+    results, sped = reference
+    tampered = results[:]
+    index = next(i for i, result in enumerate(results) if result.status == 'skipped')
+    tampered[index] = reference_engine.CalculationResult(**{**vars(results[index]), 'status': 'calculated',
+                                                            'skip_reason': None})
+    divergences = first_divergences(content, reference, (tampered, sped.replace(b'\r', b'')))
+    assert {'status', 'sped'} <= set(divergences)
@@ -0,0 +1,40 @@
+import io
+import zipfile
+
+from openpyxl import load_workbook
+
+import app
+
+
+def _resumo_links(data: bytes):
+    ws = load_workbook(io.BytesIO(data))['RESUMO']
+    return [cell.value for row in ws.iter_rows() for cell in row
+            if isinstance(cell.value, str) and 'DE_PARA_MENSAL' in cell.value]
+
+
+def _batch(processed, split_by_month):
+    rollups = app.RollupAccumulator()
+    app.replay_month(processed, rollups)
+    return app.BatchArtifacts([processed.summary], {processed.sheet_name: processed.results},
+                              {processed.sped_filename: processed.sped_output}, 'EMPRESA', '12345678000199',
+                              {'5405'}, rollups, split_by_month=split_by_month)
+
+
+def test_split_excel_links_only_inside_full_zip(processed):
+    batch = _batch(processed, split_by_month=True)
+
+    standalone = _resumo_links(batch.get('excel'))
+    assert standalone and not any(value.startswith('=HYPERLINK') for value in standalone)
+
+    with zipfile.ZipFile(io.BytesIO(batch.get('completo'))) as zip_file:
+        names = zip_file.namelist()
+        linked = _resumo_links(zip_file.read(batch.filename('excel')))
+    assert linked and all(value.startswith('=HYPERLINK') for value in linked)
+    assert app.detail_workbook_filename(processed.sheet_name) in names
+
+
+def test_sheet_links_without_split(processed):
+    ws = load_workbook(io.BytesIO(_batch(processed, split_by_month=False).get('excel')))['RESUMO']
+    values = [cell.value for row in ws.iter_rows() for cell in row if isinstance(cell.value, str)]
+    assert any(value.startswith(f'=HYPERLINK("#\'{processed.sheet_name}') for value in values)
+    assert not any('DE_PARA_MENSAL' in value for value in values)
@@ -0,0 +1,78 @@
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+import app
+
+
+class FakeExecutor:
+    """Executor em processo: falha com ``errors`` na ordem e depois roda a função na hora"""
+
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.submitted = []
+
+    def submit(self, fn, *args):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.submitted.append(args)
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+@pytest.fixture
+def service(monkeypatch):
+    executors = []
+
+    def new_executor(self):
+        executors.append(FakeExecutor())
+        return executors[-1]
+
+    monkeypatch.setattr(app.ExecutionService, '_new_executor', new_executor)
+    service = app.ExecutionService(max_workers=1, memory_budget_bytes=100)
+    service.executors = executors
+    return service
+
+
+def _idle(service):
+    stats = service.stats()
+    return stats['running'] == 0 and stats['queued'] == 0 and stats['in_flight_mb'] == 0 \
+        and service._in_flight_bytes == 0
+
+
+@pytest.mark.parametrize('error', [RuntimeError('cannot schedule new futures after shutdown'), ValueError('x')])
+def test_submit_failure_releases_the_slot(service, error):
+    service._executor = FakeExecutor([error])
+    failed = service.submit('ana', 'format_duration', (1,), estimated_bytes=60)
+    with pytest.raises(type(error)):
+        failed.result(timeout=1)
+    assert _idle(service)
+
+    # A vaga e o orçamento voltaram: as próximas tarefas são despachadas
+    assert service.submit('ana', 'format_duration', (5,), estimated_bytes=60).result(timeout=1) == \
+        app.format_duration(5)
+    assert _idle(service)
+
+
+def test_broken_pool_is_recreated_once(service):
+    service._executor = FakeExecutor([BrokenProcessPool()])
+    assert service.submit('ana', 'format_duration', (1,)).result(timeout=1) == app.format_duration(1)
+    assert len(service.executors) == 2
+
+    # Pool recriado que também quebra: a tarefa falha sem prender a vaga
+    service._executor = FakeExecutor([BrokenProcessPool()])
+    service._new_executor = lambda: FakeExecutor([BrokenProcessPool()])
+    with pytest.raises(BrokenProcessPool):
+        service.submit('ana', 'format_duration', (1,)).result(timeout=1)
+    assert _idle(service)
+
+
+def test_unknown_function_fails_only_its_task(service):
+    bad = service.submit('ana', 'funcao_inexistente', ())
+    good = service.submit('bia', 'format_duration', (2,))
+    with pytest.raises(AttributeError):
+        bad.result(timeout=1)
+    assert good.result(timeout=1) == app.format_duration(2)
+    assert _idle(service)
@@ -0,0 +1,77 @@
+import logging
+import os
+import time
+
+import app
+
+
+def _registry():
+    metrics = app.MetricsRegistry({'worker': 'vm:1'})
+    metrics.counter('icmsst_files_total', 'Arquivos')
+    metrics.histogram('icmsst_duration_seconds', 'Duração', (0.5, 2))
+    metrics.gauge('icmsst_queue', 'Fila', callback=lambda: 3)
+    metrics.gauge('icmsst_broken', 'Callback com erro', callback=lambda: 1 / 0)
+    return metrics
+
+
+def test_render_counters_histograms_and_gauges():
+    metrics = _registry()
+    metrics.inc('icmsst_files_total', origin='calculado')
+    metrics.inc('icmsst_files_total', 2, origin='calculado')
+    metrics.inc('icmsst_files_total', origin='check"point\\\n')
+    for value in (0.1, 1, 5):
+        metrics.observe('icmsst_duration_seconds', value, stage='leitura')
+
+    assert metrics.render().splitlines() == [
+        '# HELP icmsst_files_total Arquivos',
+        '# TYPE icmsst_files_total counter',
+        'icmsst_files_total{worker="vm:1",origin="calculado"} 3',
+        'icmsst_files_total{worker="vm:1",origin="check\\"point\\\\\\n"} 1',
+        '# HELP icmsst_duration_seconds Duração',
+        '# TYPE icmsst_duration_seconds histogram',
+        'icmsst_duration_seconds_bucket{worker="vm:1",stage="leitura",le="0.5"} 1',
+        'icmsst_duration_seconds_bucket{worker="vm:1",stage="leitura",le="2.0"} 2',
+        'icmsst_duration_seconds_bucket{worker="vm:1",stage="leitura",le="+Inf"} 3',
+        'icmsst_duration_seconds_sum{worker="vm:1",stage="leitura"} 6.1',
+        'icmsst_duration_seconds_count{worker="vm:1",stage="leitura"} 3',
+        '# HELP icmsst_queue Fila',
+        '# TYPE icmsst_queue gauge',
+        'icmsst_queue{worker="vm:1"} 3',
+        # Callback com erro não derruba a coleta: a métrica sai sem amostra
+        '# HELP icmsst_broken Callback com erro',
+        '# TYPE icmsst_broken gauge',
+    ]
+
+
+def test_write_textfile_replaces_atomically(tmp_path, monkeypatch):
+    metrics = _registry()
+    path = tmp_path / 'icmsst.prom'
+    path.write_text('antigo\n', encoding='utf-8')
+    replaced = []
+    real_replace = os.replace
+
+    def replace(src, dst):
+        # O arquivo final só muda no rename, já com o conteúdo completo
+        assert path.read_text(encoding='utf-8') == 'antigo\n'
+        replaced.append((open(src, encoding='utf-8').read(), dst))
+        real_replace(src, dst)
+
+    monkeypatch.setattr(app.os, 'replace', replace)
+    metrics.write_textfile(str(path))
+    assert replaced == [(metrics.render(), str(path))]
+    assert path.read_text(encoding='utf-8') == metrics.render()
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_textfile_failures_are_logged(tmp_path, caplog):
+    metrics = _registry()
+    target = str(tmp_path / 'inexistente' / 'icmsst.prom')
+    with caplog.at_level(logging.ERROR, logger='icmsst'):
+        # Thread daemon: depois da primeira falha ela só dorme até o fim dos testes
+        thread = metrics.write_textfile_every(target, 3600)
+        deadline = time.monotonic() + 5
+        while not caplog.records and time.monotonic() < deadline:
+            time.sleep(0.01)
+    assert thread.is_alive()
+    assert [r.getMessage() for r in caplog.records] == [f'Métricas: falha ao gravar {target}']
+    assert caplog.records[0].exc_info
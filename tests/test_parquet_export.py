@@ -0,0 +1,38 @@
+from dataclasses import replace
+from decimal import Decimal
+
+import pyarrow.parquet as pq
+
+import app
+
+
+def test_rows_round_trip(tmp_path, processed):
+    exporter = app.ParquetResultExporter(str(tmp_path))
+    exporter.open_partition('12345678000199', '2024', '03')
+    for result in processed.results:
+        exporter.add(result)
+    exporter.close()
+
+    calculated = [r for r in processed.results if r.status == 'calculated']
+    assert exporter.rows_written == len(calculated)
+    assert exporter.files == [tmp_path / 'cnpj=12345678000199' / 'ano=2024' / 'mes=03' / 'part-0.parquet']
+    table = pq.read_table(exporter.files[0])
+    assert table.column('line_number').to_pylist() == [r.line_number for r in calculated]
+    assert table.column('economia_total').to_pylist() == [r.economia_total for r in calculated]
+
+
+def test_extra_decimals_are_rounded(tmp_path, processed):
+    result = next(r for r in processed.results if r.status == 'calculated')
+    # O parser aceita mais casas que as do SPED nos valores originais
+    result = replace(result, vl_item=Decimal('1.234'), vl_pis_orig=Decimal('0.125'),
+                     economia_pis=Decimal('0.0451'), mva=Decimal('41.082345678'))
+    exporter = app.ParquetResultExporter(str(tmp_path), include_skipped=True)
+    exporter.open_partition('', '2024', '03')
+    exporter.add(result)
+    exporter.close()
+
+    row = pq.read_table(exporter.files[0]).to_pylist()[0]
+    assert exporter.files[0].parent.parent.parent.name == 'cnpj=desconhecido'
+    assert (row['vl_item'], row['vl_pis_orig'], row['economia_pis']) == (
+        Decimal('1.23'), Decimal('0.13'), Decimal('0.05'))
+    assert row['mva'] == Decimal('41.08234568')
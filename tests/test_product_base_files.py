@@ -0,0 +1,218 @@
+import io
+import zipfile
+from datetime import datetime
+from decimal import Decimal
+
+import pandas as pd
+import pytest
+from openpyxl import load_workbook
+
+import app
+
+NS = 'xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"'
+REL_NS = 'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"'
+
+# O workbook mínimo não tem estilo padrão; o openpyxl avisa e aplica o dele
+pytestmark = pytest.mark.filterwarnings('ignore:Workbook contains no default style')
+
+# Título acima da tabela, colunas com lacunas (B e D nunca usadas), células vazias e linha em branco
+SHEET_ROWS = [
+    '<row r="1"><c r="A1" t="s"><v>0</v></c></row>',
+    '<row r="3"><c r="A3" t="s"><v>1</v></c><c r="C3" t="inlineStr"><is><t>MVA Ajustada</t></is></c>'
+    '<c r="E3" t="s"><v>2</v></c><c r="F3" t="s"><v>3</v></c><c r="G3" t="s"><v>4</v></c>'
+    '<c r="H3" t="inlineStr"><is><t>Vigência Início</t></is></c></row>',
+    '<row r="4"><c r="A4" t="s"><v>5</v></c><c r="C4"><v>52.18</v></c><c r="E4"><v>46</v></c>'
+    '<c r="F4"><v>18</v></c><c r="G4" t="inlineStr"><is><r><t>S</t></r><r><t>P</t></r></is></c>'
+    '<c r="H4" s="1"><v>45292</v></c></row>',
+    '<row r="5"><c r="A5" t="str"><v>2202*</v></c><c r="C5" s="0"/><c r="E5"><v>3.55E1</v></c>'
+    '<c r="F5" t="s"><v>6</v></c><c r="H5" s="2"><v>45474.5</v></c></row>',
+    '<row r="6"><c r="A6"><v>22021000</v></c><c r="E6" t="e"><v>#N/A</v></c><c r="F6" t="b"><v>1</v></c>'
+    '<c r="G6" t="inlineStr"><is><t>R&amp;J</t></is></c></row>',
+    '<row r="8"><c r="A8" t="s"><v>5</v></c><c r="E8"><v>70</v></c></row>',
+]
+SHARED_STRINGS = [
+    'Base de produtos &amp; MVA',
+    'NCM',
+    'MVA',
+    '<r><rPr><b/></rPr><t>Aliquota</t></r><r><t xml:space="preserve"> Entrada</t></r>'
+    '<rPh sb="0" eb="1"><t>ignorado</t></rPh>',
+    'UF',
+    '22030000',
+    '12,5',
+]
+
+
+def make_xlsx(rows=SHEET_ROWS, date1904=False) -> bytes:
+    """Workbook mínimo escrito à mão, com os recursos do XML que o leitor decodifica"""
+    properties = ' date1904="1"' if date1904 else ''
+    shared = ''.join(f'<si>{s if s.startswith("<") else f"<t>{s}</t>"}</si>' for s in SHARED_STRINGS)
+    files = {
+        '[Content_Types].xml':
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            '<Override PartName="/xl/sharedStrings.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/>'
+            '<Override PartName="/xl/styles.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+            '</Types>',
+        '_rels/.rels':
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Target="xl/workbook.xml" Type="http://schemas.openxmlformats.org/'
+            'officeDocument/2006/relationships/officeDocument"/></Relationships>',
+        'xl/workbook.xml':
+            f'<workbook {NS} {REL_NS}><workbookPr{properties}/>'
+            '<sheets><sheet name="Base" sheetId="1" r:id="rId1"/></sheets></workbook>',
+        'xl/_rels/workbook.xml.rels':
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Target="worksheets/sheet1.xml" Type="http://schemas.openxmlformats.org/'
+            'officeDocument/2006/relationships/worksheet"/>'
+            '<Relationship Id="rId2" Target="sharedStrings.xml" Type="http://schemas.openxmlformats.org/'
+            'officeDocument/2006/relationships/sharedStrings"/>'
+            '<Relationship Id="rId3" Target="styles.xml" Type="http://schemas.openxmlformats.org/'
+            'officeDocument/2006/relationships/styles"/></Relationships>',
+        'xl/styles.xml':
+            f'<styleSheet {NS}><numFmts count="1"><numFmt numFmtId="164" formatCode="dd/mm/yyyy hh:mm"/>'
+            '</numFmts><cellXfs count="3"><xf numFmtId="0"/><xf numFmtId="14"/><xf numFmtId="164"/></cellXfs>'
+            '</styleSheet>',
+        'xl/sharedStrings.xml': f'<sst {NS}>{shared}</sst>',
+        'xl/worksheets/sheet1.xml': f'<worksheet {NS}><sheetData>{"".join(rows)}</sheetData></worksheet>',
+    }
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+    return buffer.getvalue()
+
+
+def openpyxl_rows(data: bytes) -> list:
+    workbook = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        rows = [list(row) for row in workbook.worksheets[0].iter_rows(values_only=True)]
+    finally:
+        workbook.close()
+    # Erros viram vazio no leitor; o openpyxl devolve o texto do erro
+    return [[None if value == '#N/A' else value for value in row] for row in rows]
+
+
+def _trim(row: list) -> list:
+    row = list(row)
+    while row and row[-1] is None:
+        row.pop()
+    return row
+
+
+@pytest.mark.parametrize('date1904', [False, True])
+def test_head_matches_openpyxl(date1904):
+    data = make_xlsx(date1904=date1904)
+    reader = app.XlsxColumnReader(io.BytesIO(data))
+    try:
+        head = reader.head(10)
+    finally:
+        reader.close()
+    expected = openpyxl_rows(data)
+    assert [_trim(row) for row in head[:len(expected)]] == [_trim(row) for row in expected]
+    assert head[3][7] == (datetime(2028, 1, 2) if date1904 else datetime(2024, 1, 1))
+    assert head[2][5] == 'Aliquota Entrada'
+
+
+def test_rows_match_openpyxl_on_mapped_columns():
+    data = make_xlsx()
+    used = [0, 2, 4, 6]
+    reader = app.XlsxColumnReader(io.BytesIO(data))
+    try:
+        rows = reader.rows(used, 4)
+    finally:
+        reader.close()
+    expected = [tuple(row[i] if i < len(row) else None for i in used) for row in openpyxl_rows(data)[3:]]
+    # Linhas sem nenhuma célula nas colunas pedidas não aparecem (o loader as descartaria)
+    assert rows == [row for row in expected if any(value is not None for value in row)]
+
+
+def test_read_xlsx_matches_pandas():
+    df = pd.DataFrame({
+        'Descrição': ['Cerveja', None, 'Refrigerante', 'Água'],
+        'NCM': ['22030000', None, '22021000', '2201*'],
+        'Observação': [None, 'sem uso', None, None],
+        'MVA': [46.5, None, 35, 70],
+        'MVA Ajustada': [52.18, None, None, 80.1],
+        'Aliquota Entrada': [18, None, 12, 25],
+        'Vigência Início': [datetime(2024, 1, 1), None, None, datetime(2023, 7, 1)],
+    })
+    buffer = io.BytesIO()
+    df.to_excel(buffer, index=False)
+    loaded = app.ProductBaseLoader.read_xlsx(io.BytesIO(buffer.getvalue()))
+
+    # Linha sem valores mapeados continua na tabela, como no pandas (o loader a descarta depois)
+    expected = pd.read_excel(io.BytesIO(buffer.getvalue()))[list(loaded.columns)]
+    assert list(loaded.columns) == ['NCM', 'MVA', 'MVA Ajustada', 'Aliquota Entrada', 'Vigência Início']
+    assert loaded.astype(object).where(loaded.notna(), None).values.tolist() == \
+        expected.astype(object).where(expected.notna(), None).values.tolist()
+
+
+def test_cells_without_reference_use_openpyxl():
+    # Alguns geradores omitem r="A1" (e gravam todas as células da linha): o leitor em streaming
+    # não acha o cabeçalho e cai no leitor do openpyxl
+    rows = [
+        '<row><c t="s"><v>1</v></c><c t="s"><v>2</v></c><c t="s"><v>3</v></c></row>',
+        '<row><c t="s"><v>5</v></c><c><v>46</v></c><c><v>18</v></c></row>',
+        '<row><c t="str"><v>2202*</v></c><c><v>35.5</v></c><c t="s"><v>6</v></c></row>',
+    ]
+    data = make_xlsx(rows)
+    reader = app.XlsxColumnReader(io.BytesIO(data))
+    try:
+        assert reader.head(5) == [[] for _ in range(5)]
+    finally:
+        reader.close()
+
+    loaded = app.ProductBaseLoader.read_xlsx(io.BytesIO(data))
+    assert list(loaded.columns) == ['NCM', 'MVA', 'Aliquota Entrada']
+    assert loaded.values.tolist() == [['22030000', 46, 18], ['2202*', 35.5, '12,5']]
+
+
+def test_loader_reads_the_workbook():
+    base = app.ProductBaseLoader()
+    base.load_file(io.BytesIO(make_xlsx()), 'base.xlsx')
+    assert base.get_product_by_ncm('22030000', 'SP', '2024-02-01')['mva_adjusted'] == Decimal('52.18')
+    assert base.get_product_by_ncm('22029900')['aliq_icms'] == Decimal('12.5')
+
+
+CSV_ROWS = [
+    ['Base de produtos', '', ''],
+    ['NCM', 'MVA', 'Aliquota Entrada', 'Descrição'],
+    ['01012100', '41,08', '18', 'Cavalo reprodutor'],
+    ['2202*', '35.5', '12', 'Bebidas não alcoólicas'],
+]
+
+
+@pytest.mark.parametrize('sep', [';', ',', '\t'])
+@pytest.mark.parametrize('encoding', ['utf-8-sig', 'latin-1'])
+def test_read_csv(sep, encoding):
+    text = '\r\n'.join(sep.join(f'"{v}"' if sep in v else v for v in row) for row in CSV_ROWS) + '\r\n'
+    loaded = app.ProductBaseLoader.read_csv(io.BytesIO(text.encode(encoding)))
+    # Só as colunas mapeadas, como texto: zeros à esquerda e vírgula decimal preservados
+    assert list(loaded.columns) == ['NCM', 'MVA', 'Aliquota Entrada']
+    assert loaded.values.tolist() == [['01012100', '41,08', '18'], ['2202*', '35.5', '12']]
+
+    base = app.ProductBaseLoader()
+    assert base.load_file(io.BytesIO(text.encode(encoding)), 'base.csv') == 2
+    assert base.get_product_by_ncm('01012100')['mva'] == Decimal('41.08')
+
+
+def test_read_csv_without_header_is_empty():
+    assert app.ProductBaseLoader.read_csv(io.BytesIO(b'a;b\n1;2\n')).empty
+
+
+def test_read_parquet(tmp_path):
+    path = tmp_path / 'base.parquet'
+    pd.DataFrame({'NCM': ['22030000', '2202*'], 'Descrição': ['x', 'y'], 'MVA': [46.5, 35.5],
+                  'Aliquota Entrada': [18.0, 12.0]}).to_parquet(path)
+    loaded = app.ProductBaseLoader.read_parquet(str(path))
+    assert list(loaded.columns) == ['NCM', 'MVA', 'Aliquota Entrada']
+    base = app.ProductBaseLoader()
+    assert base.load_file(str(path)) == 2
+    assert base.get_product_by_ncm('22029000')['mva'] == Decimal('35.5')
@@ -0,0 +1,72 @@
+from decimal import Decimal
+
+import pandas as pd
+import pytest
+
+import app
+
+
+@pytest.fixture(scope='module')
+def loader():
+    """Base com regra geral, por UF, por vigência e por prefixo de NCM"""
+    base = app.ProductBaseLoader()
+    base.load_dataframe(pd.DataFrame([
+        {'NCM': '22030000', 'UF': None, 'Vigência Início': None, 'Vigência Fim': None,
+         'MVA': '70', 'MVA Ajustada': None, 'Aliquota Entrada': '18'},
+        {'NCM': '22030000', 'UF': 'SP', 'Vigência Início': '2024-01-01', 'Vigência Fim': '2024-06-30',
+         'MVA': '46,5', 'MVA Ajustada': '52,18', 'Aliquota Entrada': '12'},
+        {'NCM': '22030000', 'UF': 'SP', 'Vigência Início': '2024-07-01', 'Vigência Fim': None,
+         'MVA': '41.08', 'MVA Ajustada': None, 'Aliquota Entrada': '25'},
+        {'NCM': '2202*', 'UF': None, 'Vigência Início': None, 'Vigência Fim': None,
+         'MVA': '35.5', 'MVA Ajustada': None, 'Aliquota Entrada': '18'},
+        {'NCM': '22021000', 'UF': 'RJ', 'Vigência Início': None, 'Vigência Fim': None,
+         'MVA': '30', 'MVA Ajustada': None, 'Aliquota Entrada': '20'},
+    ]))
+    return base
+
+
+@pytest.fixture
+def table(loader, tmp_path):
+    path = tmp_path / 'produtos.tbl'
+    app.ProductTable.write(loader.products_by_ncm, str(path))
+    with app.ProductTable.open(str(path)) as product_table:
+        yield product_table
+
+
+def test_rules_round_trip(loader, table):
+    assert len(table) == len(loader.products_by_ncm)
+    for ncm, rules in loader.products_by_ncm.items():
+        assert table.rules_for(ncm) == rules
+    # Decimal preservado com a escala original
+    assert str(table.rules_for('22030000')[-1]['mva']) == str(loader.products_by_ncm['22030000'][-1]['mva'])
+    assert table.rules_for('99999999') == []
+
+
+@pytest.mark.parametrize('ncm, uf, valid_on', [
+    ('22030000', None, None),
+    ('22030000', 'SP', '2024-03-15'),
+    ('22030000', 'SP', '2024-08-01'),
+    ('22030000', 'MG', '2024-03-15'),
+    ('22021000', 'RJ', None),
+    ('22021000', 'SP', None),
+    ('22029900', None, None),
+    ('22040000', None, None),
+])
+def test_lookup_matches_loader(loader, table, ncm, uf, valid_on):
+    assert table.get_product_by_ncm(ncm, uf, valid_on) == loader.get_product_by_ncm(ncm, uf, valid_on)
+
+
+def test_lookup_choices(table):
+    assert table.get_product_by_ncm('22030000', 'SP', '2024-03-15')['mva_adjusted'] == Decimal('52.18')
+    assert table.get_product_by_ncm('22030000', 'SP', '2024-08-01')['aliq_icms'] == Decimal('25')
+    assert table.get_product_by_ncm('22030000', 'MG', '2024-03-15')['mva'] == Decimal('70')
+    # Prefixo cobre os NCMs do capítulo sem regra própria
+    assert table.get_product_by_ncm('22029900')['mva'] == Decimal('35.5')
+    assert table.get_product_by_ncm('22040000') is None
+
+
+def test_rejects_foreign_file(tmp_path):
+    path = tmp_path / 'outro.tbl'
+    path.write_bytes(b'XXXX' + bytes(16))
+    with pytest.raises(ValueError):
+        app.ProductTable.open(str(path))
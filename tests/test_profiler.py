@@ -0,0 +1,93 @@
+import io
+import time
+import types
+import zipfile
+
+import pytest
+
+import app
+
+
+def _busy(seconds: float) -> int:
+    total = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        total += sum(range(200))
+    return total
+
+
+def _wait_idle(profiler: app.SamplingProfiler) -> None:
+    deadline = time.monotonic() + 5
+    while profiler._thread is not None and time.monotonic() < deadline:
+        time.sleep(0.005)
+
+
+def test_start_stop_samples_only_between(tmp_path):
+    profiler = app.SamplingProfiler(interval=0.001)
+    profiler.start('lote')
+    _busy(0.2)
+    # Captura aninhada conta na fase externa
+    with profiler.capture('artefato_excel'):
+        _busy(0.05)
+    profiler.stop()
+    _wait_idle(profiler)
+    assert profiler._thread is None
+
+    samples = profiler.samples
+    assert samples > 0
+    assert sum(profiler.stacks.values()) == samples
+    assert all(stack.split(';')[0] == 'lote' for stack in profiler.stacks)
+    assert any('_busy (test_profiler.py:' in stack for stack in profiler.stacks)
+    assert set(profiler.phase_seconds) == {'lote'} and profiler.phase_seconds['lote'] >= 0.25
+
+    _busy(0.05)
+    assert profiler.samples == samples
+
+
+def test_collapsed_and_top_functions():
+    profiler = app.SamplingProfiler()
+    profiler.stacks = {'lote;main (app.py:1);calc (app.py:9)': 3, 'lote;main (app.py:1)': 1}
+    profiler.samples = 4
+    profiler.phase_seconds = {'lote': 1.5}
+
+    assert profiler.collapsed() == 'lote;main (app.py:1) 1\nlote;main (app.py:1);calc (app.py:9) 3\n'
+    top = profiler.top_functions().splitlines()
+    assert top[:2] == ['Amostras: 4 a cada 5 ms', 'Fase lote: 1.50s']
+    assert top[4].split() == ['3', '75.0%', '3', '75.0%', 'calc', '(app.py:9)']
+    assert top[5].split() == ['1', '25.0%', '4', '100.0%', 'main', '(app.py:1)']
+
+
+def test_full_zip_carries_the_profile(processed):
+    profiler = app.SamplingProfiler(interval=0.001)
+    rollups = app.RollupAccumulator()
+    app.replay_month(processed, rollups)
+    batch = app.BatchArtifacts([processed.summary], {processed.sheet_name: processed.results},
+                               {processed.sped_filename: processed.sped_output}, 'EMPRESA', '12345678000199',
+                               {'5405'}, rollups, profiler=profiler)
+    with zipfile.ZipFile(io.BytesIO(batch.get('completo'))) as zip_file:
+        collapsed = zip_file.read('PERFIL/perfil.collapsed.txt').decode()
+        assert 'PERFIL/funcoes_mais_amostradas.txt' in zip_file.namelist()
+    # A geração dos arquivos é amostrada na fase do artefato pedido
+    assert collapsed and all(line.startswith('artefato_completo;') for line in collapsed.splitlines())
+    assert 'artefato_completo' in profiler.phase_seconds
+
+
+@pytest.mark.parametrize('auth, user, expected', [
+    ({'username': 'admin'}, 'admin', True),
+    ({'username': 'ana'}, 'ana', True),
+    ({'username': 'ana'}, 'bia', False),
+    ({'username': 'ana', 'admins': ['bia']}, 'bia', True),
+    ({'username': 'ana', 'admins': ['bia']}, 'ana', False),
+    (None, 'admin', True),
+    (None, None, False),
+])
+def test_is_admin(monkeypatch, auth, user, expected):
+    class Secrets:
+        def get(self, key, default=None):
+            if auth is None:
+                # Sem secrets.toml o Streamlit levanta ao ler
+                raise FileNotFoundError('secrets.toml')
+            return {'auth': auth}.get(key, default)
+
+    monkeypatch.setattr(app, 'st', types.SimpleNamespace(secrets=Secrets(), session_state={'current_user': user}))
+    assert app.is_admin() is expected
@@ -0,0 +1,116 @@
+import pytest
+
+import app
+from conftest import CFOPS
+from synthetic_sped import make_sped
+
+
+@pytest.fixture(scope='module')
+def batch(product_base):
+    """Dois meses do lote, na ordem em que o explorador os recebe"""
+    all_results = {}
+    for month in ('01', '02'):
+        content, _ = make_sped(month, '2024', n_items=60, n_lines=300)
+        processed = app.process_sped_source(app.SpedSource(f'SPED_{month}_2024.txt', data=content),
+                                            app.IcmsStCalculator(product_base, set(CFOPS)))
+        all_results[processed.sheet_name] = processed.results
+    return all_results
+
+
+@pytest.fixture
+def explorer(batch):
+    return app.ResultExplorer(batch)
+
+
+def _rows(batch):
+    return [(month, result) for month, results in batch.items() for result in results]
+
+
+def _expected(batch, months=(), ncm='', cod_item='', cfops=(), situacoes=(), sort='position', descending=False):
+    """Mesma consulta em Python puro: filtro linha a linha e ordenação estável"""
+    rows = [
+        (month, r) for month, r in _rows(batch)
+        if (not months or month in months)
+        and r.ncm.startswith(ncm)
+        and cod_item.lower() in r.cod_item.lower()
+        and (not cfops or r.cfop in cfops)
+        and (not situacoes or (r.skip_reason or app.ResultExplorer.CALCULATED) in situacoes)
+    ]
+    if sort != 'position':
+        key = (lambda row: getattr(row[1], sort)) if sort in ('ncm', 'cod_item') else \
+            (lambda row: float(getattr(row[1], sort)))
+        # Empates na ordem do arquivo também na ordem decrescente
+        rows = sorted(rows, key=key, reverse=descending)
+    elif descending:
+        rows = rows[::-1]
+    return [(month, r.line_number) for month, r in rows]
+
+
+def _all_pages(explorer, page_size, **query):
+    total, _, frame = explorer.query(page=1, page_size=page_size, **query)
+    keys = []
+    for page in range(1, -(-total // page_size) + 1):
+        page_total, effective, frame = explorer.query(page=page, page_size=page_size, **query)
+        assert (page_total, effective) == (total, page)
+        assert len(frame) == min(page_size, total - (page - 1) * page_size)
+        keys += list(zip(frame['Mês'], frame['Linha']))
+    return total, keys
+
+
+def test_page_boundaries(explorer, batch):
+    rows = len(_rows(batch))
+    total, page, frame = explorer.query(page=0, page_size=50)
+    assert (total, page, len(frame)) == (rows, 1, 50)
+    last = -(-rows // 50)
+    total, page, frame = explorer.query(page=last + 10, page_size=50)
+    assert (page, len(frame)) == (last, rows - (last - 1) * 50)
+    assert list(zip(frame['Mês'], frame['Linha'])) == _expected(batch)[-len(frame):]
+
+    total, page, frame = explorer.query(ncm='nenhum', page=3)
+    assert (total, page, len(frame)) == (0, 1, 0)
+    assert list(frame.columns)[:2] == ['Mês', 'Linha']
+
+
+def test_filters_and_total(explorer, batch):
+    month = list(batch)[1]
+    ncm = next(r.ncm for r in batch[month] if r.status == 'calculated')[:4]
+    # Código em minúsculas e pela metade: o filtro de item é substring sem caixa
+    item = next(r.cod_item for r in batch[month])[2:-1].lower()
+    cases = [
+        {},
+        {'months': (month,)},
+        {'ncm': ncm},
+        {'cod_item': item},
+        {'cfops': ('5405',)},
+        {'situacoes': (app.ResultExplorer.CALCULATED,)},
+        {'situacoes': ('CFOP 5102 não elegível',)},
+        {'months': (month,), 'ncm': ncm, 'cfops': ('5405', '5403'), 'situacoes': (app.ResultExplorer.CALCULATED,)},
+    ]
+    for query in cases:
+        expected = _expected(batch, **query)
+        total, keys = _all_pages(explorer, 100, **query)
+        assert total == len(expected), query
+        assert keys == expected, query
+    assert explorer.values('cfop') == sorted({r.cfop for _, r in _rows(batch)})
+
+
+@pytest.mark.parametrize('sort', sorted(app.ResultExplorer.SORT_KEYS))
+@pytest.mark.parametrize('descending', [False, True])
+@pytest.mark.parametrize('top_k_limit', [app.ResultExplorer.TOP_K_LIMIT, 120])
+def test_sort_order(batch, monkeypatch, sort, descending, top_k_limit):
+    # Limite baixo: as páginas além dele saem da ordenação completa guardada
+    monkeypatch.setattr(app.ResultExplorer, 'TOP_K_LIMIT', top_k_limit)
+    explorer = app.ResultExplorer(batch)
+    query = {'sort': sort, 'descending': descending, 'cfops': ('5405', '5403')}
+    total, keys = _all_pages(explorer, 50, **query)
+    assert keys == _expected(batch, **query)
+    # Voltar a uma página anterior dá as mesmas linhas
+    assert list(zip(*[explorer.query(page=2, page_size=50, **query)[2][c] for c in ('Mês', 'Linha')])) == \
+        keys[50:100]
+
+
+def test_empty_batch():
+    explorer = app.ResultExplorer({})
+    assert len(explorer) == 0 and explorer.values('ncm') == []
+    total, page, frame = explorer.query(sort='economia_total', page=2)
+    assert (total, page, len(frame)) == (0, 1, 0)
@@ -0,0 +1,53 @@
+from copy import copy
+from decimal import Decimal
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def store(tmp_path, processed):
+    store = app.ResultStore(str(tmp_path / 'historico.db'))
+    # O mesmo mês em dois anos e outro mês, para os filtros de período
+    for year, month in [('2023', '03'), ('2024', '03'), ('2024', '04')]:
+        summary = copy(processed.summary)
+        summary.year, summary.month = year, month
+        store.save_month('12345678000199', summary, processed.results, 'EMPRESA', {'5405'})
+    yield store
+    store.close()
+
+
+def _periods(rows):
+    return sorted({row['periodo'] for row in rows})
+
+
+def test_period_filters(store):
+    assert _periods(store.credit_totals()) == ['2023-03', '2024-03', '2024-04']
+    assert _periods(store.credit_totals(year='2024')) == ['2024-03', '2024-04']
+    assert _periods(store.credit_totals(year='2024', month='03')) == ['2024-03']
+    assert _periods(store.credit_totals(month='03')) == ['2023-03', '2024-03']
+    assert {row['period'] for row in store.query_results(month='04')} == {'2024-04'}
+
+
+def test_line_filters_and_exact_totals(store, processed):
+    calculated = [r for r in processed.results if r.status == 'calculated']
+    ncm = calculated[0].ncm
+    rows = store.query_results(year='2024', month='03', ncm=ncm, limit=100_000)
+    assert rows and all(row['ncm'] == ncm for row in rows)
+    assert len(rows) == sum(r.ncm == ncm for r in processed.results)
+
+    cfop_rows = store.query_results(year='2024', month='03', cfop='5102', limit=100_000)
+    assert len(cfop_rows) == sum(r.cfop == '5102' for r in processed.results)
+
+    [totals] = store.credit_totals(year='2024', month='03')
+    assert totals['calculados'] == len(calculated)
+    assert totals['credito_total'] == sum((r.economia_total for r in calculated), Decimal('0'))
+
+
+def test_saving_a_month_again_replaces_it(store, processed):
+    summary = copy(processed.summary)
+    summary.year, summary.month = '2024', '03'
+    store.save_month('12345678000199', summary, processed.results[:10])
+    assert len(store.query_results(year='2024', month='03')) == 10
+    assert len(store.list_summaries('12345678000199')) == 3
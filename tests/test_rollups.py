@@ -0,0 +1,63 @@
+from collections import defaultdict
+from decimal import Decimal
+
+import pytest
+
+import app
+from conftest import CFOPS
+from synthetic_sped import make_sped
+
+
+@pytest.fixture(scope='module')
+def months(product_base):
+    """Dois meses processados com as agregações acumuladas na mesma passada"""
+    rollups = app.RollupAccumulator()
+    processed = []
+    for month in ('01', '02'):
+        content, _ = make_sped(month, '2024', n_items=60, n_lines=400)
+        processed.append(app.process_sped_source(app.SpedSource(f'SPED_{month}_2024.txt', data=content),
+                                                 app.IcmsStCalculator(product_base, set(CFOPS)), rollups=rollups))
+    return processed, rollups
+
+
+@pytest.mark.parametrize('dimension', app.RollupAccumulator.DIMENSIONS)
+def test_groups_add_up_to_the_months(months, dimension):
+    processed, rollups = months
+    groups = rollups.groups[dimension].values()
+    assert all(m.summary.total_calculated for m in processed)
+    assert sum(g.total_records for g in groups) == sum(m.summary.total_records for m in processed)
+    assert sum(g.total_calculated for g in groups) == sum(m.summary.total_calculated for m in processed)
+    assert sum(g.pis_credit for g in groups) == sum(m.summary.pis_credit for m in processed)
+    assert sum(g.cofins_credit for g in groups) == sum(m.summary.cofins_credit for m in processed)
+    assert sum(g.total_credit for g in groups) == sum(m.summary.total_credit for m in processed)
+
+
+@pytest.mark.parametrize('dimension', app.RollupAccumulator.DIMENSIONS)
+def test_groups_match_the_lines(months, dimension):
+    processed, rollups = months
+    expected = defaultdict(lambda: [0, 0, Decimal('0'), Decimal('0'), set()])
+    for month in processed:
+        for result in month.results:
+            totals = expected[getattr(result, dimension) or app.RollupAccumulator.EMPTY_KEY]
+            totals[0] += 1
+            totals[4].add(month.month)
+            if result.status == 'calculated':
+                totals[1] += 1
+                totals[2] += result.valor_icms_st
+                totals[3] += result.economia_total
+
+    assert set(rollups.groups[dimension]) == set(expected)
+    for key, (records, calculated, icms_st, credit, periods) in expected.items():
+        group = rollups.groups[dimension][key]
+        assert (group.total_records, group.total_calculated, group.months) == (records, calculated, len(periods))
+        assert (group.valor_icms_st, group.total_credit) == (icms_st, credit)
+
+
+def test_replay_matches_processing(months):
+    processed, rollups = months
+    replayed = app.RollupAccumulator()
+    for month in processed:
+        app.replay_month(month, replayed)
+    assert replayed.to_json() == rollups.to_json()
+    credits = [g.total_credit for g in rollups.get_sorted('ncm')]
+    assert credits == sorted(credits, reverse=True)
@@ -0,0 +1,67 @@
+import gzip
+import io
+import zipfile
+
+import app
+from conftest import CFOPS
+
+
+class _Upload(io.BytesIO):
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name = name
+
+
+def test_compressed_members_match_plain_file(sped_content, product_base):
+    content = sped_content[0]
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('SPED_03_2024.txt', content)
+    uploads = [_Upload('SPED_03_2024.txt', content), _Upload('lote.zip', buffer.getvalue()),
+               _Upload('SPED_03_2024.txt.gz', gzip.compress(content))]
+
+    outputs = []
+    for source in app.expand_uploads(uploads):
+        processed = app.process_sped_source(source, app.IcmsStCalculator(product_base, set(CFOPS)))
+        outputs.append((processed.sped_output, processed.results))
+    assert outputs[0][0] != content
+    assert all(output == outputs[0] for output in outputs)
+
+
+def test_writer_keeps_untouched_bytes(sped_content, product_base):
+    # Terminadores misturados e última linha sem terminador
+    content = sped_content[0].replace(b'\r\n', b'\n', 50).rstrip(b'\r\n')
+    parser = app.SpedParser()
+    parser.load_content(content)
+    calculator = app.IcmsStCalculator(product_base, set(CFOPS))
+    results = [calculator.calculate(record, parser.get_ncm_for_item(record.cod_item))
+               for record in parser.get_records()]
+    output = app.SpedWriter(parser, results).generate(io.BytesIO(content), chunk_size=64)
+
+    calculated = {r.line_number for r in results if r.status == 'calculated'}
+    original_lines = io.BytesIO(content).readlines()
+    output_lines = io.BytesIO(output).readlines()
+    assert len(original_lines) == len(output_lines) == parser.line_count
+    for line_number, (original, written) in enumerate(zip(original_lines, output_lines), 1):
+        if line_number not in calculated:
+            assert written == original
+        else:
+            assert written.endswith(b'\r\n') == original.endswith(b'\r\n')
+    assert app.SpedWriter(parser, []).generate(io.BytesIO(content)) == content
+
+
+def test_uploads_are_spooled_once_and_only_on_request(tmp_path, sped_content):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr('SPED_03_2024.txt', sped_content[0])
+        archive.writestr('SPED_04_2024.txt', sped_content[0])
+    uploads = [_Upload('lote.zip', buffer.getvalue()), _Upload('SPED_05_2024.txt', sped_content[0])]
+
+    sources = app.expand_uploads(uploads)
+    assert all(source.path is None for source in sources)
+
+    app.spool_sources(sources, str(tmp_path))
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['0000_lote.zip', '0001_SPED_05_2024.txt']
+    assert all(source.data is None and source.path for source in sources)
+    assert all(app.SpedSource.from_spec(source.to_spec()).read_head(16) == sped_content[0][:16]
+               for source in sources)
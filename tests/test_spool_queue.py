@@ -0,0 +1,95 @@
+import gzip
+import json
+import os
+import time
+
+import pytest
+
+import app
+from conftest import CFOPS
+from synthetic_sped import make_product_base, make_sped
+
+
+@pytest.fixture
+def queue(tmp_path):
+    """Spool com um lote de dois meses enfileirado"""
+    ncms = set()
+    paths = []
+    for month in ('01', '02'):
+        content, month_ncms = make_sped(month, '2024', n_items=30, n_lines=200)
+        ncms |= set(month_ncms)
+        path = tmp_path / f'SPED_{month}_2024.txt'
+        path.write_bytes(content)
+        paths.append(str(path))
+    base_path = tmp_path / 'base.xlsx'
+    make_product_base(sorted(ncms)).to_excel(base_path, index=False)
+
+    spool = app.SpoolQueue(str(tmp_path / 'spool'))
+    batch_id, rejected = spool.submit_batch(paths, str(base_path), set(CFOPS))
+    assert not rejected
+    spool.batch_id = batch_id
+    return spool
+
+
+def test_claim_takes_each_job_once(queue):
+    first, second = queue.claim(), queue.claim()
+    assert queue.claim() is None
+    assert queue.job_name(first) != queue.job_name(second)
+    # Cada posse tem o próprio manifesto em execução
+    assert first.name != f'{queue.job_name(first)}.json'
+    assert queue.batch_status(queue.batch_id) == {'pending': 0, 'running': 2, 'done': 0, 'failed': 0}
+
+
+def test_requeue_stale_only_moves_silent_jobs(queue):
+    stale, alive = queue.claim(), queue.claim()
+    old = time.time() - 3600
+    os.utime(stale, (old, old))
+
+    assert queue.requeue_stale(stale_after_seconds=600) == 1
+    assert not stale.exists() and alive.exists()
+    reclaimed = queue.claim()
+    assert queue.job_name(reclaimed) == queue.job_name(stale)
+    assert reclaimed != stale
+
+
+def test_late_worker_keeps_its_hands_off(queue, monkeypatch):
+    stale = queue.claim()
+    owners = []
+    process = app.process_sped_source
+
+    def slow_process(*args, **kwargs):
+        # O job volta à fila no meio do processamento e outro worker o assume
+        old = time.time() - 3600
+        os.utime(stale, (old, old))
+        queue.requeue_stale(stale_after_seconds=600)
+        owners.append(queue.claim())
+        return process(*args, **kwargs)
+
+    monkeypatch.setattr(app, 'process_sped_source', slow_process)
+    # O worker atrasado termina depois da devolução: não recria nem encerra o manifesto
+    assert queue.process_job(stale, 'atrasado') is None
+    assert not stale.exists()
+    assert owners[0].exists()
+    assert queue.batch_status(queue.batch_id)['done'] == 0
+
+    monkeypatch.setattr(app, 'process_sped_source', process)
+    assert queue.process_job(owners[0], 'dono') == 'done'
+    assert not owners[0].exists()
+    assert queue.batch_status(queue.batch_id)['done'] == 1
+
+
+def test_results_are_json_and_merge(queue):
+    assert queue.run_worker(once=True) == 2
+    assert queue.batch_status(queue.batch_id) == {'pending': 0, 'running': 0, 'done': 2, 'failed': 0}
+
+    done = [queue._read_json(path) for path in queue._state_dir('done').glob('*.json')]
+    for job in done:
+        payload = json.loads(gzip.decompress((queue.root / job['result']).read_bytes()))
+        assert payload['version'] == app.PROCESSED_MONTH_FORMAT
+        assert job['worker'] and job['summary']
+
+    result_dir = queue.merge_batch(queue.batch_id)
+    summary = json.loads((result_dir / 'resumo_consolidado.json').read_text(encoding='utf-8'))
+    assert len(summary['meses']) == 2
+    assert summary['meses_pendentes'] == 0
+    assert len(list((result_dir / 'SPEDS_RETIFICADOS').iterdir())) == 2